@@ -48,8 +48,7 @@ def get_secret():
 
 event_names = ["deposit", "borrow", "repay", "liquidation", "withdraw"]
 secrets = get_secret()
-transpose_api_keys = {key: value for key, value in secrets.items() if key.startswith("TRANSPOSE_API_KEY_")}
-event_dict = {event_names[i]: list(transpose_api_keys.values())[i] for i in range(len(transpose_api_keys))}
+transpose_api_keys = [value for key, value in secrets.items() if key.startswith("TRANSPOSE_API_KEY_")]
 
 
 with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, max_active_runs=1, tags=TAGS) as dag:
@@ -58,25 +57,37 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
     teardown = DummyOperator(task_id="teardown")
 
     with TaskGroup(group_id="defi_events", dag=dag) as defi_events:
-        for event_name, transpose_api_key in event_dict.items():
-            raw_layer = ECSOperator(
-                task_id=f"raw_layer_{event_name}",
-                **ecs_task_template(
-                    command_list=[
-                        "python",
-                        "src/pipelines/raw/defi_events.py",
-                        "--event",
-                        event_name,
-                        "--api_key",
-                        transpose_api_key,
-                    ],
-                    stack_name=f"{STACK_NAME}-{ENV}",
-                    project=PROJECT,
-                    stream_log_prefix=f"raw-{STREAM_LOG_PREFIX}-{event_name}",
-                    memory_reservation=MEMORY_RESERVATION,
-                ),
-            )
+        token_price_index = ECSOperator(
+            task_id="token_price_index",
+            **ecs_task_template(
+                command_list=["python", "src/pipelines/analytics/token_prices.py"],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"analytics-{STREAM_LOG_PREFIX}-token-prices",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
 
+        # A single scan of every event type, so that one ApiKeyPool schedules the requests over all the keys
+        raw_layer = ECSOperator(
+            task_id="raw_layer",
+            **ecs_task_template(
+                command_list=[
+                    "python",
+                    "src/pipelines/raw/defi_events.py",
+                    "--event_name",
+                    "all",
+                    "--api_key",
+                    ",".join(transpose_api_keys),
+                ],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"raw-{STREAM_LOG_PREFIX}",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
+
+        for event_name in event_names:
             stage_layer = ECSOperator(
                 task_id=f"stage_layer_{event_name}",
                 **ecs_task_template(
@@ -91,7 +102,15 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
             analytics_layer = ECSOperator(
                 task_id=f"analytics_layer_{event_name}",
                 **ecs_task_template(
-                    command_list=["python", "src/pipelines/analytics/defi_events.py", "--event", event_name],
+                    command_list=[
+                        "python",
+                        "src/pipelines/analytics/defi_events.py",
+                        "--event",
+                        event_name,
+                        # The analytics tasks of every event type share the Athena query quota
+                        "--query_shares",
+                        str(len(event_names)),
+                    ],
                     stack_name=f"{STACK_NAME}-{ENV}",
                     project=PROJECT,
                     stream_log_prefix=f"analytics-{STREAM_LOG_PREFIX}-{event_name}",
@@ -100,6 +119,7 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
             )
 
             raw_layer >> stage_layer >> analytics_layer
+            token_price_index >> analytics_layer
 
     with TaskGroup(group_id="historical_market_data", dag=dag) as historical_market:
         raw_layer = ECSOperator(
@@ -124,7 +144,31 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
             ),
         )
 
-        raw_layer >> stage_layer
+        # Fetches again the blocks dead-lettered by this or a previous run and merges them into the stage table,
+        # which the incremental stage run cannot do once its watermark is past them
+        replay_raw_layer = ECSOperator(
+            task_id=f"replay_raw_layer",
+            **ecs_task_template(
+                command_list=["python", "src/pipelines/raw/historical_market_data.py", "--replay_dead_letters"],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"raw-{STREAM_LOG_PREFIX}-historical_market_data-replay",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
+
+        replay_stage_layer = ECSOperator(
+            task_id=f"replay_stage_layer",
+            **ecs_task_template(
+                command_list=["python", "src/pipelines/stage/historical_market_data.py", "--replay_dead_letters"],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"stage-{STREAM_LOG_PREFIX}-historical_market_data-replay",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
+
+        raw_layer >> stage_layer >> replay_raw_layer >> replay_stage_layer
 
     with TaskGroup(group_id="historical_account_positions", dag=dag) as historical_market_data:
         raw_layer = ECSOperator(
@@ -149,7 +193,31 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
             ),
         )
 
-        raw_layer >> stage_layer
+        # Fetches again the blocks dead-lettered by this or a previous run and merges them into the stage table,
+        # which the incremental stage run cannot do once its watermark is past them
+        replay_raw_layer = ECSOperator(
+            task_id=f"replay_raw_layer",
+            **ecs_task_template(
+                command_list=["python", "src/pipelines/raw/historical_account_positions.py", "--replay_dead_letters"],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"raw-{STREAM_LOG_PREFIX}-historical_account_positions-replay",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
+
+        replay_stage_layer = ECSOperator(
+            task_id=f"replay_stage_layer",
+            **ecs_task_template(
+                command_list=["python", "src/pipelines/stage/historical_account_positions.py", "--replay_dead_letters"],
+                stack_name=f"{STACK_NAME}-{ENV}",
+                project=PROJECT,
+                stream_log_prefix=f"stage-{STREAM_LOG_PREFIX}-historical_account_positions-replay",
+                memory_reservation=MEMORY_RESERVATION,
+            ),
+        )
+
+        raw_layer >> stage_layer >> replay_raw_layer >> replay_stage_layer
 
     wait_for_previous_tasks = DummyOperator(task_id="wait_for_previous_tasks")
 
@@ -175,6 +243,21 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
         ),
     )
 
+    replay_merge_historical_market_date_and_account_positions = ECSOperator(
+        task_id="replay_merge_historical_market_date_and_account_positions",
+        **ecs_task_template(
+            command_list=[
+                "python",
+                "src/pipelines/analytics/historical_market_data_and_account_positions.py",
+                "--replay_dead_letters",
+            ],
+            stack_name=f"{STACK_NAME}-{ENV}",
+            project=PROJECT,
+            stream_log_prefix=f"analytics-{STREAM_LOG_PREFIX}",
+            memory_reservation=MEMORY_RESERVATION,
+        ),
+    )
+
     save_new_wallet_features_set_datalake = ECSOperator(
         task_id="save_new_wallet_features_set_datalake",
         **ecs_task_template(
@@ -215,6 +298,7 @@ with DAG(DAG_ID, schedule_interval=SCHEDULE, default_args=ARGS, catchup=False, m
         >> historical_market
         >> wait_for_previous_tasks
         >> merge_historical_market_date_and_account_positions
+        >> replay_merge_historical_market_date_and_account_positions
         >> save_new_wallet_features_set_datalake
         >> data_quality_check
         >> save_new_wallet_features_set_features_db
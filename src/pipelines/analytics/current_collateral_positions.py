@@ -1,8 +1,9 @@
+import asyncio
+import json
+import re
 import time
-from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
+from collections import deque
 import pandas as pd
-import requests
 import numpy as np
 import awswrangler as wr
 
@@ -10,6 +11,10 @@ from spectral_data_lib.helpers.get_secrets import get_secret
 from spectral_data_lib.data_lakehouse import DataLakehouse
 from spectral_data_lib.log_manager import Logger
 from config import settings
+from src.pipelines.http_client import AsyncHttpClient, endpoint_name
+from src.pipelines.query_cache import cached_does_table_exist, cached_read_sql_query
+from src.pipelines.subgraph import PAGE_SIZE, post_query
+from src.pipelines.watermarks import get_watermark_store
 
 
 data_lakehouse = DataLakehouse()
@@ -17,7 +22,7 @@ logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
 
 
 def reload_data_lake_table(new_data: pd.DataFrame):
-    if wr.catalog.does_table_exist(database="db_analytics_prod", table="the_graph_current_collateral_positions"):
+    if cached_does_table_exist(database="db_analytics_prod", table="the_graph_current_collateral_positions"):
         wr.s3.delete_objects(
             path=f"s3://data-lakehouse-prod/analytics/the_graph/the_graph_current_collateral_positions/"
         )
@@ -29,66 +34,214 @@ def reload_data_lake_table(new_data: pd.DataFrame):
         layer="analytics",
         partition_columns=None,
     )
+    get_watermark_store().touch("db_analytics_prod.the_graph_current_collateral_positions")
 
 
-def get_current_position_data(protocol, urls, list_of_addresses):
+def get_subgraph_urls(api_key: str) -> dict:
+    return {
+        "aave-v2-eth": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/84CvqQHYhydZzr2KSth8s1AFYpBRzUbVJXq6PWuZm9U9",
+        "compound-v2-eth": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/6tGbL7WBx287EZwGUvvcQdL6m67JGMJrma3JSTtt5SV7",
+    }
+
+
+class AddressChunker(object):
+    """Cuts the addresses of a protocol into chunks sized from the positions returned so far.
+
+    Chunks are sized to hold about ``target_rows`` positions, i.e. a single page, from the number of positions
+    per address seen in the pages already fetched. A chunk holding more positions keeps being paged.
+
+    Args:
+        addresses (list): Addresses to fetch the positions of.
+        target_rows (int): Positions a chunk should hold.
+        min_size (int): Minimum addresses per chunk.
+        max_size (int): Maximum addresses per chunk, also the size of the first chunks.
     """
-    For each list of addresses, fetch all current positions these addresses hold on a specific protocol
-    :param protocol:
-    :param urls:
-    :param list_of_addresses:
-    :return:
+
+    def __init__(
+        self,
+        addresses: list,
+        target_rows: int = settings.CURRENT_POSITIONS_TARGET_ROWS_PER_CHUNK,
+        min_size: int = settings.CURRENT_POSITIONS_MIN_ADDRESSES_PER_CHUNK,
+        max_size: int = settings.CURRENT_POSITIONS_MAX_ADDRESSES_PER_CHUNK,
+    ) -> None:
+        self.addresses = addresses
+        self.target_rows = target_rows
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max_size
+        self.offset = 0
+        self.fetched_addresses = 0
+        self.fetched_rows = 0
+
+    def next_chunk(self) -> list:
+        """Returns the next chunk of addresses, None when every address was handed out."""
+        if self.offset >= len(self.addresses):
+            return None
+        chunk = self.addresses[self.offset : self.offset + self.size]
+        self.offset += len(chunk)
+        return chunk
+
+    def record(self, addresses_count: int, rows_count: int) -> None:
+        """Resizes the next chunks from the positions of a fully fetched chunk of ``addresses_count`` addresses."""
+        self.fetched_addresses += addresses_count
+        self.fetched_rows += rows_count
+        rows_per_address = max(self.fetched_rows / self.fetched_addresses, 1e-9)
+        self.size = int(min(self.max_size, max(self.min_size, self.target_rows / rows_per_address)))
+
+
+def build_multi_chunk_query(query: str, cursors: list) -> str:
+    """Rewrites the positions query into one aliased copy per ``(addresses, last_id)`` cursor, values inlined.
+
+    e.g. ``positions(where: {account_in: $address_list, id_gt: $last_id ...})`` becomes
+    ``c0: positions(where: {account_in: ["0x..", ...], id_gt: "0x.." ...})`` for the first cursor.
+    """
+    selection = query[re.search(r"\bpositions\(", query).start() : query.rindex("}")].strip()
+    aliased_fields = [
+        f"c{index}: "
+        + selection.replace("$address_list", json.dumps(addresses))
+        .replace("$last_id", json.dumps(last_id))
+        .replace("$first", str(PAGE_SIZE))
+        for index, (addresses, last_id) in enumerate(cursors)
+    ]
+    return "query current_account_positions {\n" + "\n".join(aliased_fields) + "\n}"
+
+
+class CurrentPositionsFetcher(object):
+    """Fetches all current positions a list of addresses hold on a protocol.
+
+    The addresses are cut into chunks by an :class:`AddressChunker`, and every chunk is paged with an ``id_gt``
+    cursor continuing from the last position of its previous page. A request carries the next page of several
+    chunks as aliased fields: their number is tuned after every response so that a response holds about
+    ``target_rows`` positions, and up to ``requests_in_flight`` requests are sent concurrently.
+
+    Args:
+        http_client (AsyncHttpClient): The shared async HTTP client.
+        protocol (str): The protocol to fetch the positions of.
+        url (str): The URL of the Subgraph of the protocol.
+        query (str): The positions query, filtering on ``$address_list`` and ``$last_id``.
+        addresses (list): Lower case addresses.
+        chunks_per_request (int): Initial number of chunks per request.
+        max_chunks_per_request (int): Maximum number of chunks per request.
+        target_rows (int): Positions per response the number of chunks per request is tuned to.
+        requests_in_flight (int): Maximum number of concurrent requests.
+        min_addresses_per_chunk (int): Minimum addresses per chunk.
+        max_addresses_per_chunk (int): Maximum addresses per chunk, also the size of the first chunks.
     """
-    url = urls.get(protocol)
-    current_positions_for_address_list = open(
-        "src/pipelines/analytics/queries/current_positions_for_address_list.graphql"
-    ).read()
-    total_response_dataframes_list = []
-    more_to_fetch = True
-    while more_to_fetch:
-        query_variables = {"last_id": "", "address_list": list_of_addresses}
-        response = requests.post(
-            url=url, json={"query": current_positions_for_address_list, "variables": query_variables}
+
+    def __init__(
+        self,
+        http_client,
+        protocol: str,
+        url: str,
+        query: str,
+        addresses: list,
+        chunks_per_request: int = settings.CURRENT_POSITIONS_MAX_CHUNKS_PER_REQUEST,
+        max_chunks_per_request: int = settings.CURRENT_POSITIONS_MAX_CHUNKS_PER_REQUEST,
+        target_rows: int = settings.CURRENT_POSITIONS_TARGET_ROWS_PER_REQUEST,
+        requests_in_flight: int = settings.CURRENT_POSITIONS_REQUESTS_IN_FLIGHT,
+        min_addresses_per_chunk: int = settings.CURRENT_POSITIONS_MIN_ADDRESSES_PER_CHUNK,
+        max_addresses_per_chunk: int = settings.CURRENT_POSITIONS_MAX_ADDRESSES_PER_CHUNK,
+    ) -> None:
+        self.http_client = http_client
+        self.protocol = protocol
+        self.url = url
+        self.query = query
+        self.chunker = AddressChunker(addresses, min_size=min_addresses_per_chunk, max_size=max_addresses_per_chunk)
+        self.chunks_per_request = chunks_per_request
+        self.max_chunks_per_request = max_chunks_per_request
+        self.target_rows = target_rows
+        self.requests_in_flight = requests_in_flight
+        # (addresses, last_id, rows fetched so far) of the chunks with more pages to fetch
+        self.cursors = deque()
+        self.positions = []
+        self.requests = 0
+        self.in_flight = 0
+        # Notified when a request completes, which may requeue chunks with more pages
+        self.request_done = asyncio.Condition()
+
+    def next_cursors(self) -> list:
+        """Returns the cursors of the next request: chunks being paged first, then new chunks."""
+        cursors = []
+        while len(cursors) < self.chunks_per_request:
+            if len(self.cursors) > 0:
+                cursors.append(self.cursors.popleft())
+                continue
+            chunk = self.chunker.next_chunk()
+            if chunk is None:
+                break
+            cursors.append((chunk, "", 0))
+        return cursors
+
+    async def send(self, cursors: list) -> None:
+        data = await post_query(
+            self.http_client,
+            url=self.url,
+            query=build_multi_chunk_query(self.query, [(addresses, last_id) for addresses, last_id, _ in cursors]),
+            variables={},
         )
+        self.requests += 1
+        for index, (addresses, last_id, rows_count) in enumerate(cursors):
+            page = data[f"c{index}"]
+            for position in page:
+                position["protocol"] = self.protocol
+            self.positions.extend(page)
+            if len(page) == PAGE_SIZE:
+                self.cursors.append((addresses, page[-1]["id"], rows_count + len(page)))
+            else:
+                self.chunker.record(len(addresses), rows_count + len(page))
+        # Sized from the rows rather than the bytes of the response, which would have to be encoded again
+        rows_per_chunk = max(sum(len(data[f"c{index}"]) for index in range(len(cursors))) / len(cursors), 1)
+        self.chunks_per_request = int(min(self.max_chunks_per_request, max(1, self.target_rows // rows_per_chunk)))
+
+    async def worker(self) -> None:
+        # Nothing to send while requests are in flight only means their chunks are being paged: a worker waits for
+        # them, and stops once every chunk was handed out and no request can requeue one
+        while True:
+            cursors = self.next_cursors()
+            if len(cursors) == 0:
+                if self.in_flight == 0:
+                    return
+                async with self.request_done:
+                    await self.request_done.wait()
+                continue
+            self.in_flight += 1
+            try:
+                await self.send(cursors)
+            finally:
+                self.in_flight -= 1
+                async with self.request_done:
+                    self.request_done.notify_all()
+
+    async def fetch(self) -> list:
+        """Returns the positions of every address, with their ``protocol``."""
+        workers = [asyncio.ensure_future(self.worker()) for _ in range(self.requests_in_flight)]
         try:
-            subgraph_response_dict = response.json()
-            for result in list(subgraph_response_dict.get("data").keys()):
-                if subgraph_response_dict.get("data").get(result):
-                    dataframe_chunk = pd.DataFrame.from_dict(subgraph_response_dict.get("data").get(result))
-                    dataframe_chunk["protocol"] = protocol
-                    total_response_dataframes_list.append(dataframe_chunk)
-                    if len(subgraph_response_dict.get("data").get(result)) < 1000:
-                        more_to_fetch = False
-                    if result == "sixth_results" and more_to_fetch:
-                        print("paginating on sixth_results")
-                        query_variables = {"last_id": dataframe_chunk.iloc[-1]["id"], "address_list": list_of_addresses}
-                else:
-                    more_to_fetch = False
-                    break
+            await asyncio.gather(*workers)
         except Exception as e:
-            logger.error(e)
-            logger.error(subgraph_response_dict)
-            logger.error(
-                f"""
-            Failed to parse response for addresses.
-            Protocol: {protocol}
-            Url: {url}
-            First address: {list_of_addresses[0]}
-            """
-            )
-    total_response_dataframe = pd.concat(total_response_dataframes_list)
-    return total_response_dataframe
-
-
-def divide_chunks(l, max_list_size):
-    """
-    Divide a list into chunks of at most max_list_size
-    :param l: list of items
-    :param max_list_size: int
-    :return: list of lists
-    """
-    for i in range(0, len(l), max_list_size):
-        yield l[i : i + max_list_size]
+            for worker in workers:
+                worker.cancel()
+            logger.error(f"Failed to fetch the current positions on {self.protocol} from {endpoint_name(self.url)}")
+            raise e
+        logger.info(
+            f"Fetched {len(self.positions)} positions of {len(self.chunker.addresses)} addresses on {self.protocol} "
+            f"in {self.requests} requests, {self.chunker.size} addresses per chunk, "
+            f"{self.chunks_per_request} chunks per request"
+        )
+        return self.positions
+
+
+async def fetch_current_positions(addresses: list, api_key: str) -> list:
+    """Fetches the current positions of the addresses on every protocol concurrently, over pooled connections."""
+    query = open("src/pipelines/analytics/queries/current_positions_for_address_list.graphql").read()
+    async with AsyncHttpClient() as http_client:
+        positions_by_protocol = await asyncio.gather(
+            *[
+                CurrentPositionsFetcher(http_client, protocol, url, query, addresses).fetch()
+                for protocol, url in get_subgraph_urls(api_key).items()
+            ]
+        )
+        http_client.log_stats()
+    return [position for positions in positions_by_protocol for position in positions]
 
 
 def fetch_current_data(unique_active_borrowers: pd.DataFrame, api_key: str) -> pd.DataFrame:
@@ -96,37 +249,17 @@ def fetch_current_data(unique_active_borrowers: pd.DataFrame, api_key: str) -> p
 
     Args:
         unique_active_borrowers (pd.DataFrame): Unique active borrowers.
-        api_key (str): API key for the Transpose API.
+        api_key (str): API key for the Subgraph gateway.
 
     Returns:
         pd.DataFrame: All current positions data for all unique_active_borrowers addresses on all protocols.
     """
+    addresses = list(unique_active_borrowers["wallet_address"].str.lower().unique())
+    positions = asyncio.run(fetch_current_positions(addresses, api_key))
+    if len(positions) == 0:
+        raise ValueError(f"No current positions were fetched for {len(addresses)} addresses")
 
-    unique_active_borrowers["id"] = unique_active_borrowers["wallet_address"].str.lower()
-    unique_active_borrowers = pd.DataFrame(unique_active_borrowers["id"])
-    address_list_size = settings.CURRENT_POSITIONS_MAX_PARALLEL_REQUESTS
-
-    address_chunk_lists = list(divide_chunks(l=unique_active_borrowers, max_list_size=address_list_size))
-    address_chunk_lists = [list(address_chunk_list["id"]) for address_chunk_list in address_chunk_lists]
-
-    urls = {
-        "aave-v2-eth": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/84CvqQHYhydZzr2KSth8s1AFYpBRzUbVJXq6PWuZm9U9",
-        "compound-v2-eth": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/6tGbL7WBx287EZwGUvvcQdL6m67JGMJrma3JSTtt5SV7",
-    }
-    protocol_address_chunk_list = [(i, j) for i in urls.keys() for j in address_chunk_lists]
-
-    total_positions_list = []
-    with ThreadPoolExecutor(10) as executor:
-        futures = [
-            executor.submit(
-                get_current_position_data, protocol=protocol, urls=urls, list_of_addresses=list_of_addresses
-            )
-            for protocol, list_of_addresses in protocol_address_chunk_list
-        ]
-        for future in concurrent.futures.as_completed(futures):
-            total_positions_list.append(future.result())
-    total_positions_dataframe = pd.concat(total_positions_list)
-
+    total_positions_dataframe = pd.DataFrame.from_dict(positions)
     total_positions_dataframe["isCollateral"] = total_positions_dataframe["isCollateral"].astype(bool)
     total_positions_dataframe.rename(columns={"isCollateral": "is_collateral"}, inplace=True)
     total_positions_dataframe["market_id"] = total_positions_dataframe["market"].apply(lambda x: x.get("id").lower())
@@ -137,7 +270,7 @@ def fetch_current_data(unique_active_borrowers: pd.DataFrame, api_key: str) -> p
 
 
 def fetch_test_dataset_wallets_addresses() -> pd.DataFrame:
-    return data_lakehouse.read_sql_query(
+    return cached_read_sql_query(
         database_name="db_sandbox_prod", query="SELECT wallet_address FROM db_sandbox_prod.test_set_wallet_addresses"
     )
 
@@ -1,12 +1,20 @@
-from itertools import product
-import numpy as np
-import awswrangler as wr
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, Namespace
 
 from spectral_data_lib.config import settings as sdl_settings
 from spectral_data_lib.log_manager import Logger
+from src.pipelines.chunk_scheduler import (
+    ChunkScheduler,
+    address_partitions_sql,
+    count_rows_by_address_partition,
+    plan_chunks,
+)
+from src.pipelines.engines import DUCKDB, ENGINES, get_engine, partition_columns, set_default_engine
+from src.pipelines.analytics.token_prices import DATABASE as PRICES_DATABASE
+from src.pipelines.analytics.token_prices import TABLE as PRICES_TABLE
+from src.pipelines.analytics.token_prices import add_quantity_in_eth, read_prices_as_of, refresh_token_price_index
+from src.pipelines.partition_planner import TRANSPOSE, partition_predicate, plan_timestamp_partitions
 from src.pipelines.utils import get_latest_timestamp_in_data_lake_table_for_event
+from src.pipelines.watermarks import ALL, event_table, get_watermark_store
 
 
 from config import settings
@@ -15,6 +23,10 @@ from config import settings
 logger = Logger(logger_name="defi_events_ingestion_pipeline")
 event_names = settings.EVENTS_NAMES
 
+TRANSFORMATIONS_SQL = "src/pipelines/analytics/transformations/transformations.sql"
+# The SELECT of transformations.sql without the prices, for the events converted to ETH in process
+EVENTS_WITHOUT_PRICES_SQL = "src/pipelines/analytics/transformations/events_without_prices.sql"
+
 
 def render_sql_template(sql_file_path, params: dict) -> str:
     """Render SQL template with Jinja2.
@@ -54,9 +66,7 @@ def create_table_on_datalake(event_name: str) -> None:
     )
 
     try:
-        wr.athena.start_query_execution(
-            sql=ddl, database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE, wait=True, athena_query_wait_polling_delay=1
-        )
+        get_engine().execute(ddl, database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE)
         logger.debug(f"Table transpose_{event_name}_events created")
     except Exception as e:
         logger.error(f"Error creating table transpose_{event_name}_events - {e}")
@@ -64,114 +74,158 @@ def create_table_on_datalake(event_name: str) -> None:
 
 def insert_data_into_table(
     event_name: str,
-    table_exists: bool,
     last_timestamp: int,
+    max_timestamp: int,
     token_column: str,
     quantity_column: str,
     index_column: str,
-    address_partitions: str,
+    address_partitions: tuple,
 ) -> None:
     """Insert data into table.
 
     Args:
         event_name (str): Event name.
-        table_exists (bool): Table exists.
         last_timestamp (int): Last timestamp inserted.
+        max_timestamp (int): Latest timestamp of the stage table to insert.
         token_column (str): Token column name.
         quantity_column (str): Quantity column name.
         index_column (str): Index column name.
-        address_partitions (str): Address partition.
+        address_partitions (tuple): Address partitions to insert.
 
     Returns:
         None
 
     """
+    logger.debug(f"Table transpose_{event_name}_events exists. Inserting data...")
+
+    params = {
+        "event_name": event_name,
+        "token_column": token_column,
+        "last_timestamp": last_timestamp,
+        "max_timestamp": max_timestamp,
+        "quantity_column": quantity_column,
+        "index_column": index_column,
+        "address_partitions": address_partitions_sql(address_partitions),
+        # Only the stage year/month partitions that can hold events newer than the analytics watermark
+        "partition_predicate": partition_predicate(
+            plan_timestamp_partitions(last_timestamp, max_timestamp), TRANSPOSE, alias="tb"
+        ),
+    }
 
-    if not table_exists:
-        logger.debug(f"Table transpose_{event_name}_events does not exist. Creating table...")
-        create_table_on_datalake(event_name)
-    else:
-        logger.debug(f"Table transpose_{event_name}_events exists. Inserting data...")
-        sql_file_path = f"src/pipelines/analytics/transformations/transformations.sql"
-
-        params = {
-            "event_name": event_name,
-            "token_column": token_column,
-            "last_timestamp": last_timestamp,
-            "quantity_column": quantity_column,
-            "index_column": index_column,
-            "address_partitions": address_partitions,
-        }
-
-        query = render_sql_template(sql_file_path, params)
-
-        try:
-            wr.athena.start_query_execution(
-                sql=query,
-                database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE,
-                wait=True,
-                athena_query_wait_polling_delay=1,
-            )
-            logger.debug(f"Data inserted into {event_name} table")
-
-        except Exception as e:
-            logger.error(f"Error inserting data into table - {e}")
-
-
-def run_insert_in_parallell(event_name: str, address_partitions_chunks: list) -> None:
-    """Run insert in parallell.
-    We need to execute in this way because we will ingest data into 256 partitions, as Athena has a limit of 100 partitions per query.
+    try:
+        engine = get_engine()
+        if engine.name == DUCKDB:
+            insert_events_in_process(event_name, params)
+        else:
+            query = render_sql_template(TRANSFORMATIONS_SQL, params)
+            engine.execute(query, database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE)
+        logger.debug(f"Data inserted into {event_name} table")
+
+    except Exception as e:
+        logger.error(f"Error inserting data into table - {e}")
+        raise e
+
+
+def insert_events_in_process(event_name: str, params: dict) -> None:
+    """Inserts the new events like ``transformations.sql``, with their ``quantity_in_eth`` computed in process.
+
+    DuckDB selects the events without their prices, then ``add_quantity_in_eth`` looks the prices up in the
+    as-of prices of their days with one sorted merge, instead of the two joins of the template.
 
     Args:
-        event (list): Events to be processed.
-        address_partitions_chunks (list): Address partitions chunks.
+        event_name (str): Event name.
+        params (dict): Parameters of the ``transformations.sql`` template.
 
     Returns:
         None
     """
+    engine = get_engine()
+    database = sdl_settings.DATA_LAKE_ANALYTICS_DATABASE
+    table = f"transpose_{event_name}_events"
+    events = engine.read_sql_query(render_sql_template(EVENTS_WITHOUT_PRICES_SQL, params), database=database)
+    if len(events) == 0:
+        logger.info(f"No rows to write into {database}.{table}")
+        return
+    prices = read_prices_as_of(params["last_timestamp"], params["max_timestamp"])
+    events = add_quantity_in_eth(events, prices, params["token_column"], params["quantity_column"])
+    engine.write_table(
+        database, table, engine.match_insert_columns(database, table, events), partition_columns(database)
+    )
+    logger.info(f"Wrote {len(events)} rows into {database}.{table} with their prices computed in process")
+
+
+def run_insert_in_parallell(event_name: str, query_shares: int = 1) -> None:
+    """Run insert in parallell.
+    The new events are inserted in chunks of address partitions sized from their number of rows, as Athena
+    has a limit of 100 partitions per query. Failed chunks are retried and the job fails if one still fails.
+    The inserts skip the events already in the table, so a retried chunk or a re-run job never writes one twice.
 
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        # for event_name in event_list:
-        logger.info(f"Inserting data for {event_name} events")
-        table_exists = wr.catalog.does_table_exist(
-            database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE, table=f"transpose_{event_name}_events"
-        )
-        last_timestamp = get_latest_timestamp_in_data_lake_table_for_event(event_name, "analytics")
-        for address_partitions in address_partitions_chunks:
-            if event_name == "liquidation":
-                token_column = "liquidated_token_address"
-                quantity_column = "quantity_liquidated"
-                index_column = "account_address"
-            else:
-                token_column = "token_address"
-                quantity_column = "quantity"
-                index_column = "sender_address"
-            futures.append(
-                executor.submit(
-                    insert_data_into_table,
-                    event_name,
-                    table_exists,
-                    last_timestamp,
-                    token_column,
-                    quantity_column,
-                    index_column,
-                    tuple(address_partitions),
-                )
-            )
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                logger.error(f"Error executing insert in parallell - {e}")
-        logger.info(f"Finished inserting data for {event_name} events")
-
-
-def update_event_table(event_name: str):
-
-    address_partitions = list(map("".join, product("0123456789abcdef", repeat=2)))
-    address_partitions_chunks = np.array_split(address_partitions, 3)
-    run_insert_in_parallell(address_partitions_chunks=address_partitions_chunks, event_name=event_name)
+    Args:
+        event_name (str): Event name.
+        query_shares (int): Number of jobs running queries on the engine at the same time, each one gets that
+            share of its concurrent query quota.
+
+    Returns:
+        None
+    """
+    logger.info(f"Inserting data for {event_name} events")
+    table_exists = get_engine().does_table_exist(
+        database=sdl_settings.DATA_LAKE_ANALYTICS_DATABASE, table=f"transpose_{event_name}_events"
+    )
+    if not table_exists:
+        logger.debug(f"Table transpose_{event_name}_events does not exist. Creating table...")
+        create_table_on_datalake(event_name)
+        return
+    last_timestamp = get_latest_timestamp_in_data_lake_table_for_event(event_name, "analytics")
+    max_timestamp = get_latest_timestamp_in_data_lake_table_for_event(event_name, "stage")
+    if max_timestamp <= last_timestamp:
+        logger.info(f"No new {event_name} events to move to the analytics layer.")
+        return
+    if event_name == "liquidation":
+        token_column = "liquidated_token_address"
+        quantity_column = "quantity_liquidated"
+        index_column = "account_address"
+    else:
+        token_column = "token_address"
+        quantity_column = "quantity"
+        index_column = "sender_address"
+
+    # The as-of prices are rebuilt once per run by token_prices.py, before the events of every type
+    if not get_engine().does_table_exist(database=PRICES_DATABASE, table=PRICES_TABLE):
+        refresh_token_price_index()
+
+    row_counts = count_rows_by_address_partition(
+        f"""
+        SELECT SUBSTR(tb.{index_column}, 3, 2) AS address_partition, COUNT(*) AS row_count
+        FROM db_stage_prod.transpose_{event_name}_events AS tb
+        WHERE tb.epoch_timestamp > {last_timestamp}
+        AND tb.epoch_timestamp <= {max_timestamp}
+        AND {partition_predicate(plan_timestamp_partitions(last_timestamp, max_timestamp), TRANSPOSE, alias="tb")}
+        GROUP BY 1""",
+        database="db_stage_prod",
+    )
+    engine = get_engine()
+    concurrency = max(1, engine.max_concurrent_queries // query_shares)
+    chunks = plan_chunks(row_counts, max_chunks=concurrency)
+    logger.info(f"Inserting {sum(row_counts.values())} {event_name} events in {len(chunks)} chunks")
+    ChunkScheduler(
+        lambda address_partitions: insert_data_into_table(
+            event_name,
+            last_timestamp,
+            max_timestamp,
+            token_column,
+            quantity_column,
+            index_column,
+            address_partitions,
+        ),
+        concurrency=concurrency,
+    ).run(chunks)
+    get_watermark_store().advance(event_table(event_name, "analytics"), {ALL: max_timestamp})
+    logger.info(f"Finished inserting data for {event_name} events")
+
+
+def update_event_table(event_name: str, query_shares: int = 1):
+    run_insert_in_parallell(event_name=event_name, query_shares=query_shares)
 
 
 def get_args() -> Namespace:
@@ -185,9 +239,23 @@ def get_args() -> Namespace:
         choices=event_names,
         help="Event Name",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default=settings.SQL_ENGINE,
+        choices=ENGINES,
+        help="Engine running the SQL transformation",
+    )
+    parser.add_argument(
+        "--query_shares",
+        type=int,
+        default=1,
+        help="Number of tasks running queries at the same time, each one gets that share of the engine's quota",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
-    update_event_table(args.event_name)
+    set_default_engine(args.engine)
+    update_event_table(args.event_name, query_shares=args.query_shares)
@@ -1,49 +1,92 @@
-from itertools import product
 import time
-import awswrangler as wr
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from argparse import ArgumentParser, Namespace
 
 from spectral_data_lib.log_manager import Logger
 
+from config import settings
+from src.pipelines.analytics.positions_merge import ARROW, merge_positions
+from src.pipelines.chunk_scheduler import (
+    ChunkScheduler,
+    address_partitions_sql,
+    count_rows_by_address_partition,
+    plan_chunks,
+)
+from src.pipelines.engines import ENGINES, get_engine, set_default_engine
+from src.pipelines.partition_planner import THE_GRAPH, block_list_predicate, partition_predicate, plan_block_partitions
+from src.pipelines.watermarks import get_or_rebuild_watermark, get_watermark_store
+from src.pipelines.work_queue import ReplayedBlockStore
+
 logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
 
 
+TABLE_NAME = "db_analytics_prod.the_graph_historical_market_data_and_account_positions"
+STAGE_TABLE_NAME = "db_stage_prod.the_graph_historical_account_positions"
+MARKET_DATA_STAGE_TABLE_NAME = "db_stage_prod.the_graph_historical_market_data"
+
+
 def get_last_block_number() -> int:
     """Get the last block number in the table.
 
+    Read from the watermark store; the table is only scanned the first time the store sees it.
+
     Returns:
         int: Last block number in the table.
     """
-
-    query = """
-    SELECT coalesce(max(block_number), 0) as last_block_number
-    FROM db_analytics_prod.the_graph_historical_market_data_and_account_positions
-    """
-    df = wr.athena.read_sql_query(sql=query, database="db_analytics_prod")
-    return df["last_block_number"][0]
+    return get_or_rebuild_watermark(TABLE_NAME) or 0
 
 
-def insert_data_into_table(address_partitions: tuple, last_block_number: int = 0) -> None:
+def insert_data_into_table(
+    address_partitions: tuple, last_block_number: int = 0, max_block_number: int = 0, blocks: list = None
+) -> None:
     """Insert data into table in data lake. Insert data incrementally based on the latest block number in the table.
 
+    The positions already in the table are skipped, so a retried chunk or a re-run job never writes one twice.
+
     Args:
         address_partitions (tuple): Tuple of address partitions to insert data for.
+        last_block_number (int): Latest block number already in the table.
+        max_block_number (int): Latest block number of the stage account positions to insert.
+        blocks (list): ``{"protocol", "block_number", "year", "month"}`` dicts of replayed blocks to insert
+            instead of the block range.
 
     Returns:
         None
     """
+    partitions = plan_block_partitions(last_block_number, max_block_number) if blocks is None else None
+
+    def blocks_predicate(alias: str) -> str:
+        if blocks is not None:
+            return block_list_predicate(blocks, alias=alias)
+        return f"""{alias}.block_number > {last_block_number}
+            AND {alias}.block_number <= {max_block_number}
+            AND {partition_predicate(partitions, THE_GRAPH, alias=alias)}"""
+
+    engine = get_engine()
+    existing_positions, existing_positions_join, existing_positions_filter = "", "", ""
+    if engine.does_table_exist(database="db_analytics_prod", table=TABLE_NAME.split(".")[1]):
+        existing_positions = f"""
+    existing_positions AS ( -- positions of a retried or re-run chunk that are already inserted
+        SELECT block_number, id
+        FROM {TABLE_NAME} AS existing
+        WHERE {blocks_predicate("existing")}
+        AND address_partition IN {address_partitions_sql(address_partitions)}
+    ),"""
+        existing_positions_join = """LEFT JOIN existing_positions AS ep
+        ON ep.block_number = merged.block_number
+        AND ep.id = merged.id"""
+        existing_positions_filter = "AND ep.block_number IS NULL"
 
     insert_query = f"""
-    INSERT INTO db_analytics_prod.the_graph_historical_market_data_and_account_positions
-    WITH market_data_prices_by_protocol AS (
+    INSERT INTO {TABLE_NAME}
+    WITH {existing_positions}
+    market_data_prices_by_protocol AS (
         SELECT
             hmd.input_token_price_usd,
             hmd.block_number,
             protocol
         FROM db_stage_prod.the_graph_historical_market_data AS hmd
             WHERE hmd.name in ('Aave interest bearing WETH', 'Compound Ether')
-            AND hmd.block_number > {last_block_number}
+            AND {blocks_predicate("hmd")}
     ),
     merged_market_data_and_account_positions as (
     -- we need to create this as a table and ingest incrementing data into it based on the latest block number
@@ -73,43 +116,138 @@ def insert_data_into_table(address_partitions: tuple, last_block_number: int = 0
         on md.id = ap.market_id and md.block_number = ap.block_number
     inner join market_data_prices_by_protocol as mdp
         on mdp.block_number = ap.block_number and mdp.protocol = ap.protocol
-    WHERE ap.block_number > {last_block_number}
+    WHERE {blocks_predicate("ap")}
+    AND {blocks_predicate("md")}
     )
 
-    SELECT * FROM merged_market_data_and_account_positions where address_partition in {address_partitions}
+    SELECT merged.* FROM merged_market_data_and_account_positions AS merged
+    {existing_positions_join}
+    where merged.address_partition in {address_partitions_sql(address_partitions)}
+    {existing_positions_filter}
     """
 
-    wr.athena.start_query_execution(
-        sql=insert_query, database="db_analytics_prod", wait=True, athena_query_wait_polling_delay=1
-    )
+    engine.execute(insert_query, database="db_analytics_prod")
 
 
-def run_insert_in_parallell(address_partitions_chunks: list) -> None:
+def run_insert_in_parallell() -> None:
+    """Inserts the new positions in chunks of address partitions sized from their number of rows.
 
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        logger.info(f"Inserting data for historical market data and account positions.")
-        last_block_number = get_last_block_number()
-        for address_partitions in address_partitions_chunks:
-            futures.append(executor.submit(insert_data_into_table, tuple(address_partitions), last_block_number))
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                logger.error(f"Error executing insert in parallell - {e}")
-        logger.info(f"Finished inserting data for historical market data and account positions.")
+    Failed chunks are retried and the job fails if one still fails, leaving the watermark where it was.
+    """
+    logger.info(f"Inserting data for historical market data and account positions.")
+    last_block_number = get_last_block_number()
+    max_block_number = get_or_rebuild_watermark(STAGE_TABLE_NAME)
+    if max_block_number is None or max_block_number <= last_block_number:
+        logger.info("No new account positions in the stage layer.")
+        return
+    stage_watermarks = get_watermark_store().load(STAGE_TABLE_NAME)
+    partitions = plan_block_partitions(last_block_number, max_block_number)
+    row_counts = count_rows_by_address_partition(
+        f"""
+        SELECT SUBSTR(ap.account, 3, 2) AS address_partition, COUNT(*) AS row_count
+        FROM {STAGE_TABLE_NAME} AS ap
+        WHERE ap.block_number > {last_block_number}
+        AND ap.block_number <= {max_block_number}
+        AND {partition_predicate(partitions, THE_GRAPH, alias="ap")}
+        GROUP BY 1""",
+        database="db_stage_prod",
+    )
+    engine = get_engine()
+    chunks = plan_chunks(row_counts, max_chunks=engine.max_concurrent_queries)
+    logger.info(f"Inserting {sum(row_counts.values())} account positions in {len(chunks)} chunks")
+    ChunkScheduler(
+        lambda address_partitions: insert_data_into_table(address_partitions, last_block_number, max_block_number),
+        concurrency=engine.max_concurrent_queries,
+    ).run(chunks)
+    get_watermark_store().advance(TABLE_NAME, stage_watermarks["watermarks"])
+    logger.info(f"Finished inserting data for historical market data and account positions.")
 
 
-def update_table() -> None:
+def replay_blocks() -> None:
+    """Inserts the positions of the dead-lettered blocks replayed into the stage tables.
 
-    address_partitions = list(map("".join, product("0123456789abcdef", repeat=2)))
-    address_partitions_chunks = np.array_split(address_partitions, 3)
-    run_insert_in_parallell(address_partitions_chunks=address_partitions_chunks)
+    Only the blocks up to the analytics watermark are inserted here, the next incremental run inserts the others.
+    """
+    replayed_blocks_stores = [
+        ReplayedBlockStore(MARKET_DATA_STAGE_TABLE_NAME),
+        ReplayedBlockStore(STAGE_TABLE_NAME),
+    ]
+    replayed_blocks = [store.blocks() for store in replayed_blocks_stores]
+    last_block_number = get_last_block_number()
+    blocks = []
+    for block in sum(replayed_blocks, []):
+        if block["block_number"] <= last_block_number and block not in blocks:
+            blocks.append(block)
+    if len(blocks) > 0:
+        row_counts = count_rows_by_address_partition(
+            f"""
+            SELECT SUBSTR(ap.account, 3, 2) AS address_partition, COUNT(*) AS row_count
+            FROM {STAGE_TABLE_NAME} AS ap
+            WHERE {block_list_predicate(blocks, alias="ap")}
+            GROUP BY 1""",
+            database="db_stage_prod",
+        )
+        engine = get_engine()
+        chunks = plan_chunks(row_counts, max_chunks=engine.max_concurrent_queries)
+        logger.info(f"Inserting {sum(row_counts.values())} account positions of {len(blocks)} replayed blocks")
+        ChunkScheduler(
+            lambda address_partitions: insert_data_into_table(address_partitions, blocks=blocks),
+            concurrency=engine.max_concurrent_queries,
+        ).run(chunks)
+    for store, store_blocks in zip(replayed_blocks_stores, replayed_blocks):
+        store.remove(store_blocks)
+
+
+def merge_in_process() -> None:
+    """Merges the new positions with Arrow from the stage parquet files, without a SQL engine."""
+    logger.info(f"Merging historical market data and account positions in process.")
+    last_block_number = get_last_block_number()
+    max_block_number = get_or_rebuild_watermark(STAGE_TABLE_NAME)
+    if max_block_number is None or max_block_number <= last_block_number:
+        logger.info("No new account positions in the stage layer.")
+        return
+    stage_watermarks = get_watermark_store().load(STAGE_TABLE_NAME)
+    merge_positions(last_block_number, max_block_number, plan_block_partitions(last_block_number, max_block_number))
+    get_watermark_store().advance(TABLE_NAME, stage_watermarks["watermarks"])
+    logger.info(f"Finished merging historical market data and account positions.")
+
+
+def update_table(engine: str = settings.SQL_ENGINE, replay_dead_letters: bool = False) -> None:
+    if engine == ARROW:
+        merge_in_process()
+    else:
+        set_default_engine(engine)
+        if replay_dead_letters:
+            replay_blocks()
+        else:
+            run_insert_in_parallell()
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="Merges the historical market data with the historical account positions.")
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default=settings.SQL_ENGINE,
+        choices=ENGINES + [ARROW],
+        help="SQL engine running the merge, or arrow to merge in process from the stage parquet files",
+    )
+    parser.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="Insert the dead-lettered blocks replayed into the stage tables instead of the new blocks",
+    )
+    args = parser.parse_args()
+    if args.replay_dead_letters and args.engine == ARROW:
+        parser.error("--replay_dead_letters needs a SQL engine")
+    return args
 
 
 if __name__ == "__main__":
+    args = get_args()
 
     start = time.time()
-    update_table()
+    update_table(args.engine, args.replay_dead_letters)
     end = time.time()
     logger.info(f"Elapsed time: {end - start}")
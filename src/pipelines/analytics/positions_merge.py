@@ -0,0 +1,321 @@
+import operator
+import time
+import uuid
+from functools import reduce
+
+import awswrangler as wr
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.engines import table_location
+from src.pipelines.partition_planner import PARTITION_FORMATS, THE_GRAPH
+from src.pipelines.storage import is_s3_path
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+ARROW = "arrow"
+ANALYTICS_DATABASE = "db_analytics_prod"
+ANALYTICS_TABLE = "the_graph_historical_market_data_and_account_positions"
+STAGE_DATABASE = "db_stage_prod"
+MARKET_DATA_TABLE = "the_graph_historical_market_data"
+ACCOUNT_POSITIONS_TABLE = "the_graph_historical_account_positions"
+# Markets whose input token price is the ETH price of their protocol
+ETH_MARKET_NAMES = ["Aave interest bearing WETH", "Compound Ether"]
+
+MARKET_COLUMNS = [
+    "id",
+    "name",
+    "block_number",
+    "protocol",
+    "decimals",
+    "input_token_price_usd",
+    "liquidation_threshold",
+]
+POSITION_COLUMNS = [
+    "balance",
+    "id",
+    "is_collateral",
+    "market_id",
+    "side",
+    "account",
+    "protocol",
+    "block_number",
+    "block_timestamp",
+    "year",
+    "month",
+]
+STAGE_PARTITIONING = ds.partitioning(pa.schema([("year", pa.string()), ("month", pa.string())]), flavor="hive")
+
+
+def filesystem_path(location: str) -> tuple:
+    """Returns the pyarrow ``(filesystem, path)`` of a local or S3 location."""
+    if is_s3_path(location):
+        return pafs.S3FileSystem(region=settings.REGION), location[len("s3://") :]
+    return pafs.LocalFileSystem(), location
+
+
+def open_dataset(location: str) -> ds.Dataset:
+    """Opens the hive partitioned parquet files of a table location; the partition values stay strings."""
+    filesystem, path = filesystem_path(location)
+    return ds.dataset(path, filesystem=filesystem, format="parquet", partitioning=STAGE_PARTITIONING)
+
+
+def block_filter(last_block_number: int, max_block_number: int, partitions: list) -> ds.Expression:
+    """Dataset filter of the rows with a block in ``(last_block_number, max_block_number]``.
+
+    Args:
+        last_block_number (int): Latest block number already merged.
+        max_block_number (int): Latest block number to merge.
+        partitions (list): ``(year, month)`` tuples that can hold the blocks, None for every partition.
+
+    Returns:
+        ds.Expression: The filter, pruning the partitions outside ``partitions``.
+    """
+    expression = (ds.field("block_number") > last_block_number) & (ds.field("block_number") <= max_block_number)
+    if partitions is None:
+        return expression
+    year_format, month_format = PARTITION_FORMATS[THE_GRAPH]
+    months_by_year = {}
+    for year, month in sorted(set(partitions)):
+        months_by_year.setdefault(year_format.format(year), []).append(month_format.format(month))
+    if len(months_by_year) == 0:
+        return ds.scalar(False)
+    return expression & reduce(
+        operator.or_,
+        [(ds.field("year") == year) & ds.field("month").isin(months) for year, months in months_by_year.items()],
+    )
+
+
+class BlockHashIndex(object):
+    """Hash index of table rows on ``(block_number, key column)``.
+
+    The key column is dictionary encoded and combined with the block number into a single int64, so a batch
+    of positions finds its rows with one vectorized hash table probe instead of a join.
+
+    Args:
+        table (pa.Table): Rows to index.
+        key_column (str): Column identifying a row within a block, e.g. the market id.
+    """
+
+    def __init__(self, table: pa.Table, key_column: str) -> None:
+        self.table = table
+        self.key_column = key_column
+        self.keys = pc.unique(table[key_column])
+        index_keys = self.composite_keys(table["block_number"], table[key_column])
+        self.index = pd.Index(index_keys)
+        if not self.index.is_unique:
+            # The stage tables are merged by key, so this only happens with rows loaded before that
+            duplicated = self.index.duplicated()
+            logger.warning(f"{int(duplicated.sum())} rows share their block and {key_column}, keeping the first")
+            self.table = table.filter(pa.array(~duplicated))
+            self.index = pd.Index(index_keys[~duplicated])
+
+    def composite_keys(self, block_numbers: pa.ChunkedArray, keys: pa.ChunkedArray) -> np.ndarray:
+        """Returns ``block_number * len(keys) + key code``, -1 for keys missing from the index."""
+        codes = pc.fill_null(pc.index_in(keys, value_set=self.keys), -1).to_numpy().astype(np.int64)
+        blocks = pc.cast(block_numbers, pa.int64()).to_numpy()
+        return np.where(codes < 0, -1, blocks * len(self.keys) + codes)
+
+    def lookup(self, block_numbers: pa.ChunkedArray, keys: pa.ChunkedArray) -> np.ndarray:
+        """Returns the indexed row of every ``(block_number, key)``, -1 when there is none."""
+        composite = self.composite_keys(block_numbers, keys)
+        rows = self.index.get_indexer(composite)
+        return np.where(composite < 0, -1, rows)
+
+
+def existing_positions(location: str, last_block_number: int, max_block_number: int, partitions: list):
+    """Index of the positions of the blocks already in the analytics table, e.g. written by a run that failed.
+
+    Returns:
+        BlockHashIndex: The positions indexed on ``(block_number, id)``, or None when there are none.
+    """
+    filesystem, path = filesystem_path(location)
+    if filesystem.get_file_info(path).type == pafs.FileType.NotFound:
+        return None
+    # The year/month of the analytics rows are columns of the files, under the address_partition directories
+    dataset = ds.dataset(path, filesystem=filesystem, format="parquet")
+    if len(dataset.files) == 0:
+        return None
+    existing = dataset.to_table(
+        columns=["block_number", "id"], filter=block_filter(last_block_number, max_block_number, partitions)
+    )
+    if existing.num_rows == 0:
+        return None
+    logger.info(f"Skipping the {existing.num_rows} positions of the blocks already merged")
+    return BlockHashIndex(existing, "id")
+
+
+class MarketLookup(object):
+    """Market data of every block, indexed for the positions of the same block.
+
+    Holds the market rows of the blocks being merged (a snapshot per market per block), indexed on
+    ``(block_number, id)``, and the ETH price of each protocol, indexed on ``(block_number, protocol)``.
+
+    Args:
+        markets (pa.Table): ``MARKET_COLUMNS`` of the market data of the blocks to merge.
+    """
+
+    def __init__(self, markets: pa.Table) -> None:
+        self.markets = BlockHashIndex(markets, "id")
+        eth_markets = markets.filter(pc.is_in(markets["name"], value_set=pa.array(ETH_MARKET_NAMES)))
+        self.protocol_prices = BlockHashIndex(eth_markets, "protocol")
+
+    @classmethod
+    def load(cls, location: str, last_block_number: int, max_block_number: int, partitions: list):
+        market_data = open_dataset(location).to_table(
+            columns=MARKET_COLUMNS, filter=block_filter(last_block_number, max_block_number, partitions)
+        )
+        logger.info(f"Indexed {market_data.num_rows} market data rows")
+        return cls(market_data)
+
+    def merge(self, positions: pa.RecordBatch) -> pa.RecordBatch:
+        """Joins a batch of positions to their market and protocol ETH price and computes their balances.
+
+        Computes the columns of ``insert_data_into_table`` with the same null semantics; positions without a
+        market or protocol price in their block are dropped, as by the inner joins of the query.
+        """
+        positions = pa.Table.from_batches([positions])
+        market_rows = self.markets.lookup(positions["block_number"], positions["market_id"])
+        price_rows = self.protocol_prices.lookup(positions["block_number"], positions["protocol"])
+        matched = (market_rows >= 0) & (price_rows >= 0)
+        positions = positions.filter(pa.array(matched))
+        markets = self.markets.table.take(pa.array(market_rows[matched]))
+        protocol_prices = self.protocol_prices.table.take(pa.array(price_rows[matched]))
+
+        input_token_price_usd = markets["input_token_price_usd"]
+        input_token_price_usd_protocol = protocol_prices["input_token_price_usd"]
+        balance_in_usd = pc.divide(
+            pc.multiply(positions["balance"], input_token_price_usd),
+            pc.power(10.0, pc.cast(markets["decimals"], pa.float64())),
+        )
+        # CASE WHEN ... = 0.0 OR ... = 0.0: true if either is zero, even when the other one is null
+        is_zero = pc.or_kleene(pc.equal(balance_in_usd, 0.0), pc.equal(input_token_price_usd_protocol, 0.0))
+        balance_in_eth = pc.if_else(
+            pc.fill_null(is_zero, False),
+            0.0,
+            pc.multiply(pc.divide(1.0, input_token_price_usd_protocol), balance_in_usd),
+        )
+        merged = pa.table(
+            {
+                "balance": positions["balance"],
+                "balance_in_usd": balance_in_usd,
+                "balance_in_eth": balance_in_eth,
+                "id": positions["id"],
+                "is_collateral": positions["is_collateral"],
+                "market_id": positions["market_id"],
+                "side": positions["side"],
+                "account": positions["account"],
+                "liquidation_threshold": pc.multiply(markets["liquidation_threshold"], 0.01),
+                "input_token_price_usd": input_token_price_usd,
+                "input_token_price_usd_protocol": input_token_price_usd_protocol,
+                "decimals": markets["decimals"],
+                "protocol": positions["protocol"],
+                "block_number": positions["block_number"],
+                "block_timestamp": positions["block_timestamp"],
+                "year": positions["year"],
+                "month": positions["month"],
+                "address_partition": pc.utf8_slice_codeunits(positions["account"], 2, 4),
+            }
+        )
+        return merged.combine_chunks().to_batches()[0] if merged.num_rows > 0 else None
+
+
+def merge_positions(
+    last_block_number: int,
+    max_block_number: int,
+    partitions: list,
+    data_root: str = settings.DUCKDB_DATA_ROOT,
+    batch_rows: int = settings.ARROW_BATCH_ROWS,
+    min_rows_per_group: int = settings.ARROW_MIN_ROWS_PER_GROUP,
+) -> int:
+    """Appends the positions of blocks ``(last_block_number, max_block_number]`` merged with their market data.
+
+    Does in process what ``insert_data_into_table`` does in SQL, from the stage parquet files: the market data
+    of the blocks is indexed once, then the positions are streamed in batches of ``batch_rows`` rows, merged
+    and written to the ``address_partition`` partitions of the analytics table, so memory is bounded by the
+    market data and a few batches rather than by the positions. The positions of the blocks already in the
+    table, written by a run that failed half way, are skipped, so a re-run never writes one twice.
+
+    Args:
+        last_block_number (int): Latest block number already in the analytics table.
+        max_block_number (int): Latest block number of the stage account positions.
+        partitions (list): ``(year, month)`` tuples that can hold the blocks, None for every partition.
+        data_root (str): Local directory of the tables, or empty to use the Glue catalog locations.
+        batch_rows (int): Positions merged at a time.
+        min_rows_per_group (int): Rows buffered per address partition before writing a row group, so up to 256
+            times as many rows are held in memory; smaller row groups make the write much slower.
+
+    Returns:
+        int: Rows written.
+    """
+    start = time.time()
+    lookup = MarketLookup.load(
+        table_location(STAGE_DATABASE, MARKET_DATA_TABLE, data_root), last_block_number, max_block_number, partitions
+    )
+    positions = open_dataset(table_location(STAGE_DATABASE, ACCOUNT_POSITIONS_TABLE, data_root)).to_batches(
+        columns=POSITION_COLUMNS,
+        filter=block_filter(last_block_number, max_block_number, partitions),
+        batch_size=batch_rows,
+    )
+    location = table_location(ANALYTICS_DATABASE, ANALYTICS_TABLE, data_root)
+    existing = existing_positions(location, last_block_number, max_block_number, partitions)
+
+    def new_positions(merged: pa.RecordBatch) -> pa.RecordBatch:
+        if merged is None or existing is None:
+            return merged
+        merged = merged.filter(pa.array(existing.lookup(merged["block_number"], merged["id"]) < 0))
+        return merged if merged.num_rows > 0 else None
+
+    merged_batches = (merged for merged in map(new_positions, map(lookup.merge, positions)) if merged is not None)
+    first_batch = next(merged_batches, None)
+    if first_batch is None:
+        logger.info("No account positions to merge")
+        return 0
+
+    written = {"rows": 0, "address_partitions": set()}
+
+    def count(batch: pa.RecordBatch) -> pa.RecordBatch:
+        written["rows"] += batch.num_rows
+        written["address_partitions"].update(pc.unique(batch["address_partition"]).to_pylist())
+        return batch
+
+    def batches():
+        yield count(first_batch)
+        for batch in merged_batches:
+            yield count(batch.cast(first_batch.schema))
+
+    filesystem, base_dir = filesystem_path(location)
+    ds.write_dataset(
+        batches(),
+        base_dir=base_dir,
+        schema=first_batch.schema,
+        format="parquet",
+        filesystem=filesystem,
+        partitioning=["address_partition"],
+        partitioning_flavor="hive",
+        basename_template=f"{uuid.uuid4().hex}-{{i}}.snappy.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        min_rows_per_group=min_rows_per_group,
+        file_options=ds.ParquetFileFormat().make_write_options(compression="snappy"),
+    )
+    if is_s3_path(location):
+        wr.catalog.add_parquet_partitions(
+            database=ANALYTICS_DATABASE,
+            table=ANALYTICS_TABLE,
+            partitions_values={
+                f"{location}/address_partition={address_partition}/": [address_partition]
+                for address_partition in sorted(written["address_partitions"])
+            },
+        )
+    logger.info(
+        f"Merged {written['rows']} account positions into {len(written['address_partitions'])} address partitions "
+        f"in {time.time() - start:.1f}s"
+    )
+    return written["rows"]
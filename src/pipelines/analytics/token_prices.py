@@ -0,0 +1,153 @@
+import time
+from argparse import ArgumentParser, Namespace
+
+import numpy as np
+import pandas as pd
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.engines import ENGINES, get_engine, set_default_engine
+from src.pipelines.watermarks import get_watermark_store
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+DATABASE = "db_analytics_prod"
+TABLE = "features_token_prices_as_of"
+SECONDS_PER_DAY = 86400
+# Events are converted with the latest price of the 7 days before them
+PRICE_LOOKBACK_DAYS = 7
+ETH_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+token_price_index_query = f"""
+WITH prices AS (
+    SELECT
+        address,
+        timestamp AS price_timestamp,
+        price,
+        CAST(timestamp AS BIGINT) / {SECONDS_PER_DAY} AS day
+    FROM db_analytics_prod.features_daily_token_prices
+),
+carried_prices AS (
+    -- latest price of the {PRICE_LOOKBACK_DAYS} days before each day
+    SELECT
+        p.address,
+        p.day + offsets.day_offset AS day,
+        MAX(p.price_timestamp) AS price_timestamp
+    FROM prices AS p
+    CROSS JOIN (VALUES {", ".join(f"({day})" for day in range(1, PRICE_LOOKBACK_DAYS + 1))}) AS offsets (day_offset)
+    GROUP BY 1, 2
+)
+SELECT c.address, c.day, p.price_timestamp, p.price
+FROM carried_prices AS c
+INNER JOIN prices AS p
+    ON p.address = c.address AND p.price_timestamp = c.price_timestamp
+UNION ALL
+SELECT address, day, price_timestamp, price
+FROM prices
+"""
+
+
+def refresh_token_price_index() -> None:
+    """Rebuilds the as-of token price table from ``features_daily_token_prices``.
+
+    For every token and day the table holds the latest price of the 7 days before the day, forward filled,
+    and the prices of the day itself. The latest price of the week before an event is then the latest of the
+    rows of its (token, day) up to the event timestamp, which ``transformations.sql`` finds with an equi-join
+    instead of a range join over every price of the token.
+
+    The engine builds the table with a ``CREATE TABLE AS`` into a new location and swaps it in, so the prices
+    never go through the process and the inserts never read a half written table.
+    """
+    start = time.time()
+    location = f"{settings.DATA_LAKE_BUCKET_S3}/analytics/features/{TABLE}/"
+    get_engine().replace_table(DATABASE, TABLE, token_price_index_query, location=location)
+    get_watermark_store().touch(f"{DATABASE}.{TABLE}")
+    logger.info(f"Rebuilt {DATABASE}.{TABLE} in {time.time() - start:.1f}s")
+
+
+def read_prices_as_of(first_timestamp: int, last_timestamp: int) -> pd.DataFrame:
+    """Reads the as-of prices of the days of the events from ``first_timestamp`` to ``last_timestamp``."""
+    return get_engine().read_sql_query(
+        f"""SELECT address, day, price_timestamp, price
+        FROM {DATABASE}.{TABLE}
+        WHERE day BETWEEN {first_timestamp // SECONDS_PER_DAY} AND {last_timestamp // SECONDS_PER_DAY}""",
+        database=DATABASE,
+    )
+
+
+def add_prices_as_of(events: pd.DataFrame, prices: pd.DataFrame, token_column: str) -> pd.DataFrame:
+    """Adds the latest price of the 7 days up to each event, with one sorted merge instead of a range join.
+
+    The events and the as-of prices are matched on their (token, day), the equi-join of ``transformations.sql``,
+    and each event takes the latest price of its (token, day) up to its timestamp.
+
+    Args:
+        events (pd.DataFrame): Events with ``epoch_timestamp`` and ``token_column`` columns.
+        prices (pd.DataFrame): As-of prices, with ``address``, ``day``, ``price_timestamp`` and ``price`` columns.
+        token_column (str): Token column of the events.
+
+    Returns:
+        pd.DataFrame: ``events`` (sorted by timestamp) with ``price_timestamp`` and ``price``, NaN without price.
+    """
+    event_timestamps = events["epoch_timestamp"].astype("int64")
+    events = events.assign(event_timestamp=event_timestamps, day=event_timestamps // SECONDS_PER_DAY).sort_values(
+        "event_timestamp", kind="stable"
+    )
+    prices = (
+        prices.rename(columns={"address": token_column})
+        .astype({"day": "int64", "price_timestamp": "int64"})
+        .sort_values("price_timestamp")
+    )
+    return pd.merge_asof(
+        events,
+        prices[[token_column, "day", "price_timestamp", "price"]],
+        left_on="event_timestamp",
+        right_on="price_timestamp",
+        by=[token_column, "day"],
+        direction="backward",
+        tolerance=PRICE_LOOKBACK_DAYS * SECONDS_PER_DAY,
+    ).drop(columns=["event_timestamp", "day"])
+
+
+def add_quantity_in_eth(
+    events: pd.DataFrame, prices: pd.DataFrame, token_column: str, quantity_column: str
+) -> pd.DataFrame:
+    """Computes ``quantity_in_eth`` of the events like ``transformations.sql``, in memory.
+
+    Args:
+        events (pd.DataFrame): Events with ``epoch_timestamp``, ``token_column``, ``quantity_column`` and
+            ``token_decimal`` columns.
+        prices (pd.DataFrame): As-of prices, see ``add_prices_as_of``.
+        token_column (str): Token column of the events.
+        quantity_column (str): Quantity column of the events.
+
+    Returns:
+        pd.DataFrame: The events, sorted by timestamp, with their ``quantity_in_eth``; NaN without price.
+    """
+    with_prices = add_prices_as_of(events, prices, token_column)
+    quantity = with_prices[quantity_column].astype("float64") / np.power(
+        10.0, with_prices["token_decimal"].astype("float64")
+    )
+    quantity_in_eth = np.where(with_prices[token_column] == ETH_ADDRESS, quantity, quantity * with_prices["price"])
+    return with_prices[events.columns].assign(quantity_in_eth=quantity_in_eth)
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="As-of token prices used to convert the DeFi events to ETH.")
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default=settings.SQL_ENGINE,
+        choices=ENGINES,
+        help="Engine building the as-of price table",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    set_default_engine(args.engine)
+    refresh_token_price_index()
@@ -0,0 +1,47 @@
+WITH {event_name}_events AS (
+    SELECT
+        tb.block_number,
+        tb.log_index,
+        tb.transaction_hash,
+        tb.timestamp,
+        tb.epoch_timestamp,
+        tb.protocol_name,
+        tb.contract_version,
+        tb.market_address,
+        tb.{token_column},
+        tm.decimals AS token_decimal,
+        tb.category,
+        tb.account_address,
+        tb.{quantity_column},
+        CAST(NULL AS DOUBLE) AS quantity_in_eth, -- computed in process from the as-of prices
+        tb.sender_address,
+        tb.{index_column} AS index_address,
+        tb.year,
+        tb.month,
+        SUBSTR(tb.{index_column}, 3, 2) AS address_partition
+    FROM db_stage_prod.transpose_{event_name}_events AS tb
+    INNER JOIN db_stage_prod.ethereum_tokens_metadata AS tm -- tokens_metadata
+        ON tm.contract_address = tb.{token_column}
+    LEFT JOIN db_sandbox_prod.defi_events_tokens_to_drop AS ttd -- tokens_to_drop
+        ON ttd.contract_address = tb.{token_column}
+    WHERE tb.epoch_timestamp > {last_timestamp}
+    AND tb.epoch_timestamp <= {max_timestamp}
+    AND SUBSTR(tb.{index_column}, 3, 2) IN {address_partitions}
+    AND {partition_predicate}
+    AND ttd.contract_address IS NULL
+    AND tm.decimals > 0
+),
+existing_events AS ( -- events of a retried or re-run chunk that are already inserted
+    SELECT block_number, log_index, transaction_hash
+    FROM db_analytics_prod.transpose_{event_name}_events
+    WHERE epoch_timestamp > {last_timestamp}
+    AND epoch_timestamp <= {max_timestamp}
+    AND address_partition IN {address_partitions}
+)
+SELECT events.*
+FROM {event_name}_events AS events
+LEFT JOIN existing_events AS ee
+    ON ee.block_number = events.block_number
+    AND ee.log_index = events.log_index
+    AND ee.transaction_hash = events.transaction_hash
+WHERE ee.block_number IS NULL
@@ -2,13 +2,16 @@ INSERT INTO db_analytics_prod.transpose_{event_name}_events
 WITH max_token_prices AS (
     SELECT tb.epoch_timestamp,
         tb.{token_column},
-        MAX(tp.timestamp) as max_price_timestamp
-    FROM db_analytics_prod.features_daily_token_prices AS tp -- tokens_price
+        MAX(tp.price_timestamp) as max_price_timestamp
+    FROM db_analytics_prod.features_token_prices_as_of AS tp -- prices of the week up to each day
     INNER JOIN db_stage_prod.transpose_{event_name}_events AS tb -- borrow_events
         ON tp.address = tb.{token_column}
-        AND tp.timestamp BETWEEN (tb.epoch_timestamp - (86400 * 7)) AND tb.epoch_timestamp -- get price from a week period
+        AND tp.day = CAST(tb.epoch_timestamp AS BIGINT) / 86400
+        AND tp.price_timestamp BETWEEN (tb.epoch_timestamp - (86400 * 7)) AND tb.epoch_timestamp -- get price from a week period
     WHERE tb.epoch_timestamp > {last_timestamp}
+    AND tb.epoch_timestamp <= {max_timestamp}
     AND SUBSTR(tb.{index_column}, 3, 2) IN {address_partitions}
+    AND {partition_predicate}
     GROUP BY tb.epoch_timestamp, tb.{token_column}
 ),
 {event_name}_events_with_quantity_in_eth AS (
@@ -43,12 +46,28 @@ WITH max_token_prices AS (
         ON ttd.contract_address = tb.{token_column}
     LEFT JOIN max_token_prices AS mtp -- max_tokens_price
         ON mtp.epoch_timestamp = tb.epoch_timestamp AND mtp.{token_column} = tb.{token_column}
-    LEFT JOIN db_analytics_prod.features_daily_token_prices as tp -- token_prices
-        ON tp.timestamp = mtp.max_price_timestamp
+    LEFT JOIN db_analytics_prod.features_token_prices_as_of as tp -- token_prices
+        ON tp.price_timestamp = mtp.max_price_timestamp
         AND tp.address = mtp.{token_column}
+        AND tp.day = CAST(mtp.epoch_timestamp AS BIGINT) / 86400
     WHERE tb.epoch_timestamp > {last_timestamp}
+    AND tb.epoch_timestamp <= {max_timestamp}
     AND SUBSTR(tb.{index_column}, 3, 2) IN {address_partitions}
+    AND {partition_predicate}
     AND ttd.contract_address IS NULL
     AND tm.decimals > 0
+),
+existing_events AS ( -- events of a retried or re-run chunk that are already inserted
+    SELECT block_number, log_index, transaction_hash
+    FROM db_analytics_prod.transpose_{event_name}_events
+    WHERE epoch_timestamp > {last_timestamp}
+    AND epoch_timestamp <= {max_timestamp}
+    AND address_partition IN {address_partitions}
 )
-SELECT * FROM {event_name}_events_with_quantity_in_eth
+SELECT events.*
+FROM {event_name}_events_with_quantity_in_eth AS events
+LEFT JOIN existing_events AS ee
+    ON ee.block_number = events.block_number
+    AND ee.log_index = events.log_index
+    AND ee.transaction_hash = events.transaction_hash
+WHERE ee.block_number IS NULL
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from requests.auth import AuthBase
+
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.rate_limit import TokenBucket
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+REMAINING_HEADERS = ["X-RateLimit-Remaining", "RateLimit-Remaining", "X-Ratelimit-Remaining-Requests"]
+RESET_HEADERS = ["X-RateLimit-Reset", "RateLimit-Reset", "X-Ratelimit-Reset-Requests"]
+
+
+def parse_header_number(headers, names: list) -> float:
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            continue
+    return None
+
+
+class ApiKeyState(object):
+    """Budget tracked for one API key."""
+
+    def __init__(self, api_key: str, requests_per_second: float) -> None:
+        self.api_key = api_key
+        self.bucket = TokenBucket(rate=requests_per_second)
+        self.remaining = None
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+
+    def spare_quota(self, now: float) -> float:
+        """Returns how many requests the key can take right now, or a negative number when it must not be used."""
+        if now < self.blocked_until:
+            return -1
+        tokens = self.bucket.available()
+        if self.remaining is not None:
+            tokens = min(tokens, self.remaining)
+        return tokens
+
+
+class ApiKeyPool(AuthBase):
+    """Schedules requests over a pool of API keys so that they share their combined quota.
+
+    Every request is sent with the key that has the most spare quota: each key has its own token bucket, the
+    remaining budget reported by the rate limit response headers, and a cool-down after a 429. Keys are picked
+    again for every retry, so a throttled key's work moves to the others for the rest of the run.
+
+    Used as ``auth`` of a requests call; it sets the key header and watches the response.
+
+    Args:
+        api_keys (list): API keys of the pool.
+        requests_per_second (float): Sustained requests per second allowed for each key.
+        header_name (str): Header carrying the API key.
+        throttle_seconds (float): Cool-down applied to a key after a 429 without Retry-After/reset headers.
+    """
+
+    def __init__(
+        self,
+        api_keys: list,
+        requests_per_second: float,
+        header_name: str = "X-API-KEY",
+        throttle_seconds: float = 10,
+    ) -> None:
+        if len(api_keys) == 0:
+            raise ValueError("ApiKeyPool needs at least one API key")
+        self.header_name = header_name
+        self.throttle_seconds = throttle_seconds
+        self.keys = [ApiKeyState(api_key, requests_per_second) for api_key in dict.fromkeys(api_keys)]
+        self.lock = threading.Lock()
+
+    def acquire(self) -> str:
+        """Blocks until a key has spare quota and returns it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                state = max(self.keys, key=lambda key_state: key_state.spare_quota(now))
+                if state.spare_quota(now) >= 1:
+                    state.bucket.reserve()
+                    state.requests += 1
+                    if state.remaining is not None:
+                        state.remaining -= 1
+                    return state.api_key
+                wait_seconds = min(
+                    max(key_state.blocked_until - now, 1 / key_state.bucket.rate) for key_state in self.keys
+                )
+            time.sleep(wait_seconds)
+
+    def observe(self, api_key: str, response) -> None:
+        """Updates the budget of ``api_key`` from the headers and status of its response."""
+        with self.lock:
+            state = next(key_state for key_state in self.keys if key_state.api_key == api_key)
+            now = time.monotonic()
+            remaining = parse_header_number(response.headers, REMAINING_HEADERS)
+            reset = parse_header_number(response.headers, RESET_HEADERS)
+            if reset is not None and reset > 1e9:  # epoch timestamp instead of seconds from now
+                reset = max(reset - time.time(), 0)
+            if remaining is not None:
+                state.remaining = remaining
+                if remaining <= 0:
+                    state.blocked_until = now + (reset if reset is not None else self.throttle_seconds)
+                    state.remaining = None
+            if response.status_code == 429:
+                state.throttled += 1
+                retry_after = parse_header_number(response.headers, ["Retry-After"])
+                cool_down = retry_after if retry_after is not None else reset
+                state.blocked_until = now + (cool_down if cool_down is not None else self.throttle_seconds)
+                logger.warning(f"API key ...{api_key[-4:]} throttled, cooling down until it recovers")
+
+    def __call__(self, request):
+        api_key = self.acquire()
+        request.headers[self.header_name] = api_key
+        request.register_hook("response", lambda response, *args, **kwargs: self.observe(api_key, response))
+        return request
+
+    def log_stats(self) -> None:
+        for state in self.keys:
+            logger.info(f"API key ...{state.api_key[-4:]}: {state.requests} requests, {state.throttled} throttled")
@@ -0,0 +1,153 @@
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.query_cache import cached_read_sql_query
+from src.pipelines.storage import read_bytes, write_bytes
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+_block_calendar = None
+_block_calendar_lock = threading.Lock()
+
+
+class BlockCalendar(object):
+    """Sorted index of the first and last Ethereum block of every day.
+
+    The calendar is three aligned arrays (``days`` as ``yyyymmdd`` integers, ``first_blocks`` and
+    ``last_blocks``), kept in a local ``.npz`` file with a copy on S3. It is built once from
+    ``db_raw_prod.ethereum_blocks`` and then only extended with the days after its last one, so day to block
+    and block to day lookups are binary searches instead of a GROUP BY over every Ethereum block.
+
+    Args:
+        path (str): Local ``.npz`` file of the calendar.
+        s3_path (str): Optional ``s3://`` copy, used when the local file does not exist yet.
+    """
+
+    def __init__(
+        self, path: str = settings.BLOCK_CALENDAR_PATH, s3_path: str = settings.BLOCK_CALENDAR_S3_PATH
+    ) -> None:
+        self.path = path
+        self.s3_path = s3_path
+        self.days = np.array([], dtype=np.int32)
+        self.first_blocks = np.array([], dtype=np.int64)
+        self.last_blocks = np.array([], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def load(self) -> None:
+        """Loads the calendar from the local file, or from its S3 copy."""
+        content = read_bytes(self.path) if os.path.exists(self.path) else None
+        if content is None and self.s3_path:
+            content = read_bytes(self.s3_path)
+        if content is None:
+            return
+        arrays = np.load(io.BytesIO(content))
+        self.days, self.first_blocks, self.last_blocks = arrays["days"], arrays["first_blocks"], arrays["last_blocks"]
+
+    def save(self) -> None:
+        buffer = io.BytesIO()
+        np.savez(buffer, days=self.days, first_blocks=self.first_blocks, last_blocks=self.last_blocks)
+        write_bytes(self.path, buffer.getvalue())
+        if self.s3_path:
+            write_bytes(self.s3_path, buffer.getvalue())
+
+    def refresh(self) -> int:
+        """Extends the calendar with the days after its last complete day.
+
+        The last day of the calendar may have been indexed before it ended, so it is queried again together
+        with the new days.
+
+        Returns:
+            int: Number of days added.
+        """
+        known_days = max(len(self) - 1, 0)
+        from_block = int(self.first_blocks[known_days]) if len(self) > 0 else 0
+        query = f"""
+        SELECT
+                CAST(date_format(timestamp, '%Y%m%d') AS INTEGER) AS day,
+                MIN(number) AS first_block,
+                MAX(number) AS last_block
+        FROM db_raw_prod.ethereum_blocks
+        WHERE number >= {from_block}
+        GROUP BY 1
+        ORDER BY 1 ASC"""
+        # Every task of a DAG run extends the calendar from the same day, so the query is answered once
+        new_days = cached_read_sql_query(database_name="db_raw_prod", query=query)
+        if len(new_days) == 0:
+            return 0
+        self.days = np.concatenate([self.days[:known_days], new_days["day"].to_numpy(dtype=np.int32)])
+        self.first_blocks = np.concatenate(
+            [self.first_blocks[:known_days], new_days["first_block"].to_numpy(dtype=np.int64)]
+        )
+        self.last_blocks = np.concatenate(
+            [self.last_blocks[:known_days], new_days["last_block"].to_numpy(dtype=np.int64)]
+        )
+        self.save()
+        logger.info(f"Block calendar refreshed: {len(self) - known_days} days from block {from_block}")
+        return len(self) - known_days
+
+    def day_index(self, block_number: int) -> int:
+        """Index of the day holding ``block_number``, -1 if it is before the calendar."""
+        return int(np.searchsorted(self.first_blocks, block_number, side="right")) - 1
+
+    def block_to_day(self, block_number: int) -> tuple:
+        """Returns the ``(year, month, day)`` of ``block_number``, or None if it is outside the calendar."""
+        index = self.day_index(block_number)
+        if index < 0 or block_number > self.last_blocks[index]:
+            return None
+        day = int(self.days[index])
+        return day // 10000, day // 100 % 100, day % 100
+
+    def day_to_blocks(self, year: int, month: int, day: int) -> tuple:
+        """Returns the ``(first_block, last_block)`` of a day, or None if it is not in the calendar."""
+        yyyymmdd = year * 10000 + month * 100 + day
+        index = int(np.searchsorted(self.days, yyyymmdd))
+        if index >= len(self) or self.days[index] != yyyymmdd:
+            return None
+        return int(self.first_blocks[index]), int(self.last_blocks[index])
+
+    def daily_first_blocks(self, from_block: int) -> pd.DataFrame:
+        """Returns the first block at or after ``from_block`` of every day from the day of ``from_block`` on.
+
+        Args:
+            from_block (int): First block to consider.
+
+        Returns:
+            pd.DataFrame: ``year`` (yy), ``month`` (mm), ``day`` (dd) and ``first_eth_block_of_the_day`` columns.
+        """
+        if len(self) == 0 or from_block > self.last_blocks[-1]:
+            return pd.DataFrame(columns=["year", "month", "day", "first_eth_block_of_the_day"])
+        index = max(self.day_index(from_block), 0)
+        days = self.days[index:]
+        first_blocks = self.first_blocks[index:].copy()
+        if len(first_blocks) > 0:
+            first_blocks[0] = max(first_blocks[0], from_block)
+        return pd.DataFrame(
+            {
+                "year": pd.Series(days // 10000 % 100).map("{:02d}".format),
+                "month": pd.Series(days // 100 % 100).map("{:02d}".format),
+                "day": pd.Series(days % 100).map("{:02d}".format),
+                "first_eth_block_of_the_day": first_blocks,
+            }
+        )
+
+
+def get_block_calendar() -> BlockCalendar:
+    """Returns the block calendar of the process, loaded and refreshed once on first use."""
+    global _block_calendar
+    with _block_calendar_lock:
+        if _block_calendar is None:
+            block_calendar = BlockCalendar()
+            block_calendar.load()
+            block_calendar.refresh()
+            _block_calendar = block_calendar
+        return _block_calendar
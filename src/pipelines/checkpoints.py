@@ -0,0 +1,43 @@
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.storage import delete, read_json, write_json
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+
+class CheckpointManifest(object):
+    """Durable record of the units of work (pages, shards, blocks) a job has already persisted.
+
+    The manifest is a small JSON document stored locally or on S3 (``CHECKPOINT_LOCATION``). It is saved after
+    every unit that reaches the Data Lakehouse and deleted when the job completes, so a retried job skips
+    straight to the first unfinished unit. A unit persisted right before a crash but not yet recorded is
+    written again on retry (at-least-once).
+
+    Args:
+        job_name (str): Unique name of the job, used as the manifest file name.
+        location (str): Local directory or ``s3://`` prefix holding the manifests.
+    """
+
+    def __init__(self, job_name: str, location: str = settings.CHECKPOINT_LOCATION) -> None:
+        self.job_name = job_name
+        self.path = f"{location.rstrip('/')}/{job_name}.json"
+        self.state = None
+
+    def load(self) -> dict:
+        """Returns the state saved by an unfinished previous run, or None."""
+        self.state = read_json(self.path)
+        if self.state is not None:
+            logger.info(f"Resuming {self.job_name} from checkpoint {self.path}")
+        return self.state
+
+    def save(self, state: dict) -> None:
+        """Persists the current state of the job."""
+        self.state = state
+        write_json(self.path, state)
+
+    def clear(self) -> None:
+        """Deletes the manifest once the job completed."""
+        self.state = None
+        delete(self.path)
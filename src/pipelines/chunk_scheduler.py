@@ -0,0 +1,126 @@
+import heapq
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import product
+
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.engines import get_engine
+from src.pipelines.work_queue import retry_delay_seconds
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+ADDRESS_PARTITIONS = list(map("".join, product("0123456789abcdef", repeat=2)))
+
+
+def address_partitions_sql(address_partitions: tuple) -> str:
+    """Renders address partitions as a SQL list, e.g. ``('0a', '0b')``, valid for a single partition too."""
+    return "(" + ", ".join(f"'{address_partition}'" for address_partition in address_partitions) + ")"
+
+
+def count_rows_by_address_partition(query: str, database: str) -> dict:
+    """Runs ``query``, returning ``address_partition`` and ``row_count`` columns, on the configured engine.
+
+    The counts are cached until the tables they read get a new version, so a retried job does not count again.
+
+    Returns:
+        dict: Rows to insert of every address partition that has some.
+    """
+    row_counts = get_engine().read_sql_query(query, database=database, cached=True)
+    return {
+        str(row["address_partition"]): int(row["row_count"])
+        for _, row in row_counts.iterrows()
+        if row["address_partition"] in ADDRESS_PARTITIONS and row["row_count"] > 0
+    }
+
+
+def plan_chunks(
+    row_counts: dict, max_chunks: int, max_partitions: int = settings.ATHENA_MAX_PARTITIONS_PER_QUERY
+) -> list:
+    """Groups the address partitions with rows into chunks of similar size.
+
+    Partitions are assigned from the largest to the smallest to the chunk with the fewest rows that has room
+    for one more partition, so the chunks are balanced and none writes more than ``max_partitions``
+    partitions (Athena's limit per ``INSERT INTO``). There are ``max_chunks`` chunks (enough to run them all
+    at once), or more when the partitions do not fit in them.
+
+    Args:
+        row_counts (dict): Rows to insert per address partition; partitions without rows are not scheduled.
+        max_chunks (int): Number of chunks that can run at the same time.
+        max_partitions (int): Maximum partitions of a chunk.
+
+    Returns:
+        list: Tuples of address partitions, the largest chunk first.
+    """
+    partitions = sorted(row_counts, key=lambda partition: (-row_counts[partition], partition))
+    if len(partitions) == 0:
+        return []
+    chunk_count = min(len(partitions), max(max_chunks, math.ceil(len(partitions) / max_partitions)))
+    # (rows, chunk index) of the chunks that can take one more partition
+    chunk_sizes = [(0, index) for index in range(chunk_count)]
+    chunks = [[] for _ in range(chunk_count)]
+    rows = [0] * chunk_count
+    for partition in partitions:
+        _, index = heapq.heappop(chunk_sizes)
+        chunks[index].append(partition)
+        rows[index] += row_counts[partition]
+        if len(chunks[index]) < max_partitions:
+            heapq.heappush(chunk_sizes, (rows[index], index))
+    order = sorted(range(chunk_count), key=lambda index: -rows[index])
+    return [tuple(sorted(chunks[index])) for index in order]
+
+
+class ChunkScheduler(object):
+    """Runs the chunks of an address partitioned insert concurrently, retrying only the chunks that failed.
+
+    A failed chunk is retried after an exponential backoff while the other chunks keep running. Once a chunk
+    failed ``max_attempts`` times the scheduler raises, so the job fails instead of silently missing rows.
+    ``run_chunk`` must be idempotent: a failed attempt may have written part of its rows, and the chunks that
+    succeeded are run again by the next run of the job.
+
+    Args:
+        run_chunk (callable): Function inserting one chunk, receiving the tuple of its address partitions.
+        concurrency (int): Chunks running at the same time, e.g. the concurrent query quota of the engine.
+        max_attempts (int): Attempts of a chunk before the job fails.
+    """
+
+    def __init__(self, run_chunk, concurrency: int, max_attempts: int = settings.ANALYTICS_CHUNK_MAX_ATTEMPTS) -> None:
+        self.run_chunk = run_chunk
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+    def attempt(self, chunk: tuple, attempt: int) -> float:
+        if attempt > 1:
+            time.sleep(retry_delay_seconds(attempt - 1))
+        start = time.time()
+        self.run_chunk(chunk)
+        return time.time() - start
+
+    def run(self, chunks: list) -> None:
+        """Runs every chunk.
+
+        Raises:
+            RuntimeError: When a chunk still fails after ``max_attempts`` attempts.
+        """
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.attempt, chunk, 1): (chunk, 1) for chunk in chunks}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk, attempt = futures.pop(future)
+                    try:
+                        elapsed = future.result()
+                        logger.info(f"Inserted {len(chunk)} address partitions in {elapsed:.1f}s: {chunk[:3]}...")
+                    except Exception as e:
+                        if attempt < self.max_attempts:
+                            logger.warning(f"Attempt {attempt} of chunk {chunk[:3]}... failed, retrying - {e}")
+                            futures[executor.submit(self.attempt, chunk, attempt + 1)] = (chunk, attempt + 1)
+                        else:
+                            logger.error(f"Chunk {chunk} failed {attempt} times - {e}")
+                            failed.append(chunk)
+        if len(failed) > 0:
+            raise RuntimeError(f"{len(failed)} of {len(chunks)} chunks failed: {failed}")
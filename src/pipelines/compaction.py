@@ -0,0 +1,367 @@
+import io
+import math
+import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.storage import (
+    data_file_sizes,
+    delete,
+    list_paths,
+    list_sizes,
+    read_bytes,
+    read_json,
+    write_bytes,
+    write_json,
+)
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+# The address column a table is sorted by (the first one it has), then the block number
+SORT_COLUMN_CANDIDATES = ["index_address", "sender_address", "account", "id"]
+TIME_PARTITION_KEYS = ["year", "month"]
+
+
+def partition_sort_key(keys: list, values: list) -> tuple:
+    """Orders partitions numerically on year/month (month=1 < month=10) and lexically on other keys."""
+    return tuple(int(value) if key in TIME_PARTITION_KEYS else value for key, value in zip(keys, values))
+
+
+def sort_columns(schema: pa.Schema) -> list:
+    columns = [column for column in SORT_COLUMN_CANDIDATES if column in schema.names][:1]
+    if "block_number" in schema.names:
+        columns.append("block_number")
+    return columns
+
+
+def read_parquet_files(paths: list, workers: int = settings.COMPACTION_READ_WORKERS) -> pa.Table:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(lambda path: pq.read_table(io.BytesIO(read_bytes(path))), paths))
+    return pa.concat_tables(tables, promote=True)
+
+
+class PartitionCompactor(object):
+    """Rewrites the small parquet files of a table's partitions into a few sorted, target-sized files.
+
+    Each partition is read, sorted by address and block, and written as files of about ``target_file_bytes``
+    with row groups of about ``row_group_bytes`` under ``{compaction_location}/{database}/{table}/``, outside the
+    table's prefix so that the readers listing the table's files never see both copies. The files are read back to check the row count, and the Glue location of the partition is then flipped to them in one
+    call, so queries see either all the old files or all the new ones. A partition that received files while
+    it was being compacted is left unchanged.
+
+    The writers keep appending to the partition's own location (its "home", e.g. ``year=2023/month=1``), so
+    a flipped partition is settled once ``grace_seconds`` have passed, i.e. once no query started before the
+    flip can still be reading the replaced files: they are deleted from the home, the compacted files are
+    copied there and the partition is flipped back. Files appended to the home in the meantime by a backfill
+    or a re-ingest are kept and reported, and visible again from then on. The compacted prefix is deleted
+    after another grace period. Every flip is recorded in a manifest under ``_manifests/`` of the compaction
+    prefix, and each run settles the flips that are due before compacting.
+
+    Open partitions (the recent months, or every ``address_partition``) are only compacted with
+    ``include_open``, preferably with ``wait`` so that appends are not hidden until the next run. Partitions
+    that already have the expected number of files are skipped.
+
+    Args:
+        database (str): Database of the table.
+        table (str): Table name.
+        target_file_bytes (int): Target size of a compacted file.
+        row_group_bytes (int): Target size of a row group.
+        closed_after_days (int): Days after the end of a month from which its partition is closed.
+        include_open (bool): Also compact open partitions.
+        grace_seconds (int): Time after a flip before the files it replaced are deleted.
+        wait (bool): Wait for the grace period at the end of a run and settle the partitions it flipped.
+        compaction_location (str): Local directory or ``s3://`` prefix of the compacted files of every table.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        table: str,
+        target_file_bytes: int = settings.COMPACTION_TARGET_FILE_BYTES,
+        row_group_bytes: int = settings.COMPACTION_ROW_GROUP_BYTES,
+        closed_after_days: int = settings.COMPACTION_CLOSED_AFTER_DAYS,
+        include_open: bool = False,
+        grace_seconds: int = settings.COMPACTION_GRACE_SECONDS,
+        wait: bool = False,
+        compaction_location: str = settings.COMPACTION_LOCATION,
+    ) -> None:
+        self.database = database
+        self.table = table
+        self.target_file_bytes = target_file_bytes
+        self.row_group_bytes = row_group_bytes
+        self.closed_after_days = closed_after_days
+        self.include_open = include_open
+        self.grace_seconds = grace_seconds
+        self.wait = wait
+        self.glue_client = boto3.client("glue", region_name=settings.REGION)
+        table_description = self.glue_client.get_table(DatabaseName=database, Name=table)["Table"]
+        self.location = table_description["StorageDescriptor"]["Location"].rstrip("/")
+        self.partition_keys = [key["Name"] for key in table_description.get("PartitionKeys", [])]
+        self.compacted_location = f"{compaction_location.rstrip('/')}/{database}/{table}"
+        self.manifest_location = f"{self.compacted_location}/_manifests"
+
+    def partitions(self, from_partition: list = None, to_partition: list = None) -> list:
+        """Returns the Glue partitions of the table between two partition values (inclusive), in order."""
+        partitions = []
+        paginator = self.glue_client.get_paginator("get_partitions")
+        for page in paginator.paginate(DatabaseName=self.database, TableName=self.table):
+            partitions.extend(page["Partitions"])
+        partitions = sorted(partitions, key=lambda p: partition_sort_key(self.partition_keys, p["Values"]))
+        if from_partition:
+            from_key = partition_sort_key(self.partition_keys, from_partition)
+            partitions = [p for p in partitions if partition_sort_key(self.partition_keys, p["Values"]) >= from_key]
+        if to_partition:
+            to_key = partition_sort_key(self.partition_keys, to_partition)
+            partitions = [p for p in partitions if partition_sort_key(self.partition_keys, p["Values"]) <= to_key]
+        return partitions
+
+    def is_closed(self, values: list) -> bool:
+        """Whether no pipeline appends to the partition anymore: only year/month partitions of past months."""
+        if self.partition_keys != TIME_PARTITION_KEYS:
+            return False
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.closed_after_days)
+        return partition_sort_key(self.partition_keys, values) < (cutoff.year, cutoff.month)
+
+    def partition_path(self, values: list) -> str:
+        return "/".join(f"{key}={value}" for key, value in zip(self.partition_keys, values))
+
+    def home_location(self, values: list) -> str:
+        """Location the writers append the partition's files to."""
+        return f"{self.location}/{self.partition_path(values)}"
+
+    def flip_location(self, values: list, location: str) -> None:
+        """Points the Glue partition to ``location`` in a single catalog update."""
+        partition = self.glue_client.get_partition(
+            DatabaseName=self.database, TableName=self.table, PartitionValues=values
+        )["Partition"]
+        partition_input = {key: partition[key] for key in ["Values", "Parameters"] if key in partition}
+        partition_input["StorageDescriptor"] = {**partition["StorageDescriptor"], "Location": f"{location}/"}
+        self.glue_client.update_partition(
+            DatabaseName=self.database,
+            TableName=self.table,
+            PartitionValueList=values,
+            PartitionInput=partition_input,
+        )
+
+    def manifests(self) -> dict:
+        """Returns the manifests of the flips not settled or cleaned up yet, by manifest path."""
+        return {path: read_json(path) for path in list_paths(self.manifest_location) if path.endswith(".json")}
+
+    def compact_partition(self, partition: dict, flipped_paths: set = frozenset()) -> dict:
+        """Compacts one partition and flips its location to the compacted files.
+
+        Args:
+            partition (dict): The Glue partition.
+            flipped_paths (set): Partitions flipped and not settled yet, which are left as they are.
+
+        Returns:
+            dict: Report with the status (``compacted``, ``compact``, ``open``, ``flipped`` or ``appended``),
+            files and bytes before and after, and the seconds to scan the partition before and after.
+        """
+        values = partition["Values"]
+        partition_path = self.partition_path(values)
+        home = self.home_location(values)
+        location = partition["StorageDescriptor"]["Location"].rstrip("/")
+        report = {"partition": partition_path}
+        if partition_path in flipped_paths:
+            return {**report, "status": "flipped"}
+        closed = self.is_closed(values)
+        if not closed and not self.include_open:
+            return {**report, "status": "open"}
+        # A partition flipped by an older run may also hold files appended to its home since
+        sizes = {**data_file_sizes(location), **data_file_sizes(home)}
+        bytes_before = sum(sizes.values())
+        file_count = max(1, math.ceil(bytes_before / self.target_file_bytes))
+        report = {**report, "files_before": len(sizes), "bytes_before": bytes_before}
+        if len(sizes) <= file_count:
+            return {**report, "status": "compact"}
+
+        start = time.time()
+        data = read_parquet_files(sorted(sizes))
+        scan_seconds_before = time.time() - start
+        data = data.sort_by([(column, "ascending") for column in sort_columns(data.schema)])
+        rows_per_file = max(1, math.ceil(data.num_rows / file_count))
+        bytes_per_row = max(bytes_before / max(data.num_rows, 1), 1)
+        rows_per_group = max(1, min(rows_per_file, int(self.row_group_bytes / bytes_per_row)))
+
+        version = int(time.time())
+        new_location = f"{self.compacted_location}/{partition_path}/{version}"
+        new_paths = []
+        for index, offset in enumerate(range(0, data.num_rows, rows_per_file)):
+            buffer = io.BytesIO()
+            pq.write_table(
+                data.slice(offset, rows_per_file), buffer, row_group_size=rows_per_group, compression="snappy"
+            )
+            new_paths.append(f"{new_location}/compacted-{version}-{index:05d}.snappy.parquet")
+            write_bytes(new_paths[-1], buffer.getvalue())
+
+        start = time.time()
+        compacted_rows = read_parquet_files(new_paths).num_rows
+        scan_seconds_after = time.time() - start
+        if compacted_rows != data.num_rows:
+            for path in new_paths:
+                delete(path)
+            raise ValueError(
+                f"Compaction of {self.database}.{self.table}/{partition_path} read back {compacted_rows} rows "
+                f"instead of {data.num_rows}, the partition was left unchanged"
+            )
+        # Files written while the partition was compacted would be hidden by the flip
+        appended = set(data_file_sizes(location)) | set(data_file_sizes(home))
+        appended = appended - set(sizes)
+        if len(appended) > 0:
+            for path in new_paths:
+                delete(path)
+            logger.warning(
+                f"{len(appended)} files were appended to {self.database}.{self.table}/{partition_path} while it "
+                f"was compacted, the partition was left unchanged"
+            )
+            return {**report, "status": "appended"}
+
+        self.flip_location(values, new_location)
+        manifest = {
+            "values": values,
+            "home": home,
+            "location": new_location,
+            "replaced": sorted(sizes),
+            "flipped_at": time.time(),
+            "settled_at": None,
+        }
+        write_json(f"{self.manifest_location}/{partition_path}/{version}.json", manifest)
+        return {
+            **report,
+            "status": "compacted",
+            "files_after": len(new_paths),
+            "bytes_after": sum(list_sizes(new_location)[path] for path in new_paths),
+            "scan_seconds_before": round(scan_seconds_before, 3),
+            "scan_seconds_after": round(scan_seconds_after, 3),
+        }
+
+    def settle(self, manifest_path: str, manifest: dict) -> bool:
+        """Moves a flipped partition back to its home once the grace period has passed, then cleans up.
+
+        Every step can be repeated, so a settlement interrupted half way is completed by the next run.
+
+        Returns:
+            bool: Whether the partition is still flipped.
+        """
+        now = time.time()
+        partition_path = self.partition_path(manifest["values"])
+        if manifest["settled_at"] is not None:
+            if now - manifest["settled_at"] >= self.grace_seconds:
+                for path in data_file_sizes(manifest["location"]):
+                    delete(path)
+                delete(manifest_path)
+            return False
+        if now - manifest["flipped_at"] < self.grace_seconds:
+            return True
+
+        replaced = set(manifest["replaced"])
+        late_appends = [path for path in data_file_sizes(manifest["home"]) if path not in replaced]
+        # Queries started before the flip are over, so the replaced files are no longer read
+        for path in manifest["replaced"]:
+            delete(path)
+        # Includes the files a writer may have added to the flipped location
+        for path in data_file_sizes(manifest["location"]):
+            write_bytes(f"{manifest['home']}/{os.path.basename(path)}", read_bytes(path))
+        self.flip_location(manifest["values"], manifest["home"])
+        write_json(manifest_path, {**manifest, "settled_at": now})
+        if len(late_appends) > 0:
+            logger.warning(
+                f"{len(late_appends)} files were appended to {self.database}.{self.table}/{partition_path} "
+                f"while it was flipped, they are visible again from now on"
+            )
+        logger.info(f"Settled {self.database}.{self.table}/{partition_path} back to {manifest['home']}")
+        return False
+
+    def settle_due(self) -> set:
+        """Settles and cleans up the flips that are due.
+
+        Returns:
+            set: The partitions still flipped.
+        """
+        flipped_paths = set()
+        for manifest_path, manifest in self.manifests().items():
+            if self.settle(manifest_path, manifest):
+                flipped_paths.add(self.partition_path(manifest["values"]))
+        return flipped_paths
+
+    def run(self, from_partition: list = None, to_partition: list = None) -> list:
+        """Compacts the partitions between ``from_partition`` and ``to_partition`` and logs a report.
+
+        Returns:
+            list: The report of every partition.
+        """
+        flipped_paths = self.settle_due()
+        reports = []
+        for partition in self.partitions(from_partition, to_partition):
+            report = self.compact_partition(partition, flipped_paths)
+            logger.info(f"{self.database}.{self.table}/{report.pop('partition')}: {report}")
+            reports.append(report)
+        compacted = [report for report in reports if report["status"] == "compacted"]
+        if len(compacted) > 0:
+            logger.info(
+                f"Compacted {len(compacted)} of {len(reports)} partitions of {self.database}.{self.table}: "
+                f"{sum(report['files_before'] for report in compacted)} files -> "
+                f"{sum(report['files_after'] for report in compacted)} files, scan time "
+                f"{sum(report['scan_seconds_before'] for report in compacted):.1f}s -> "
+                f"{sum(report['scan_seconds_after'] for report in compacted):.1f}s"
+            )
+            if self.wait:
+                logger.info(f"Waiting {self.grace_seconds}s before settling the flipped partitions")
+                time.sleep(self.grace_seconds)
+                self.settle_due()
+        else:
+            logger.info(f"No partition of {self.database}.{self.table} to compact among {len(reports)}")
+        return reports
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="Compacts the small parquet files of a Data Lakehouse table.")
+
+    parser.add_argument("--table", type=str, required=True, help="database.table to compact")
+    parser.add_argument(
+        "--from_partition",
+        type=str,
+        default=None,
+        help="First partition to compact, its values separated by '/' (e.g. 2023/1)",
+    )
+    parser.add_argument(
+        "--to_partition",
+        type=str,
+        default=None,
+        help="Last partition to compact, its values separated by '/' (e.g. 2023/12)",
+    )
+    parser.add_argument(
+        "--include_open",
+        action="store_true",
+        help="Also compact open partitions (use with --wait)",
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for the grace period and settle the flipped partitions before exiting",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    database, table = args.table.split(".")
+    compactor = PartitionCompactor(database, table, include_open=args.include_open, wait=args.wait)
+    compactor.run(
+        from_partition=args.from_partition.split("/") if args.from_partition else None,
+        to_partition=args.to_partition.split("/") if args.to_partition else None,
+    )
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import numpy as np
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+class AimdController(object):
+    """Additive-increase / multiplicative-decrease controller of the number of requests in flight.
+
+    Every ``window`` completed requests the limit grows by one if the p95 latency and the error rate of the
+    window are healthy. A 429/5xx/timeout, or an unhealthy window, cuts the limit by ``decrease_factor``
+    (at most once per ``latency_target`` seconds, so one burst of errors counts as a single congestion signal).
+
+    Args:
+        name (str): Name used in the metrics logs.
+        initial_limit (int): Limit at start.
+        min_limit (int): Lowest limit.
+        max_limit (int): Highest limit.
+        latency_target (float): p95 latency in seconds above which the window is unhealthy.
+        max_error_rate (float): Share of failed requests above which the window is unhealthy.
+        window (int): Number of requests evaluated together.
+        decrease_factor (float): Factor applied to the limit on congestion.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = settings.HTTP_CONCURRENCY_INITIAL,
+        min_limit: int = settings.HTTP_CONCURRENCY_MIN,
+        max_limit: int = settings.HTTP_CONCURRENCY_MAX,
+        latency_target: float = settings.HTTP_LATENCY_P95_TARGET_SECONDS,
+        max_error_rate: float = settings.HTTP_MAX_ERROR_RATE,
+        window: int = settings.HTTP_CONCURRENCY_WINDOW,
+        decrease_factor: float = 0.5,
+    ) -> None:
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.decrease_factor = decrease_factor
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.failures = 0
+        self.completed = 0
+        self.started_at = time.monotonic()
+        self.last_decrease_at = 0.0
+        self.last_report_at = time.monotonic()
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def throughput(self) -> float:
+        """Successful requests per second since the controller was created."""
+        return self.completed / max(time.monotonic() - self.started_at, 1e-9)
+
+    def _decrease(self, now: float) -> None:
+        if now - self.last_decrease_at >= self.latency_target:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.last_decrease_at = now
+        self.latencies = []
+        self.failures = 0
+
+    def record(self, latency: float, failed: bool) -> None:
+        """Records the outcome of one request and adapts the limit."""
+        with self.lock:
+            now = time.monotonic()
+            self.latencies.append(latency)
+            if failed:
+                self.failures += 1
+                self._decrease(now)
+            else:
+                self.completed += 1
+            if len(self.latencies) >= self.window:
+                p95_latency = float(np.percentile(self.latencies, 95))
+                error_rate = self.failures / len(self.latencies)
+                if p95_latency <= self.latency_target and error_rate <= self.max_error_rate:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self.latencies = []
+                    self.failures = 0
+                else:
+                    self._decrease(now)
+            if now - self.last_report_at >= 30:
+                self.last_report_at = now
+                self.log_metrics()
+
+    def log_metrics(self) -> None:
+        logger.info(
+            f"Concurrency {self.name}: limit {self.current_limit}, "
+            f"throughput {self.throughput():.2f} requests/s, {self.completed} requests completed"
+        )
+
+
+class ConcurrencyGate(object):
+    """Blocks threads while the number of requests in flight reaches the controller's limit."""
+
+    def __init__(self, controller: AimdController) -> None:
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.in_flight >= self.controller.current_limit:
+                self.condition.wait(timeout=1)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+
+class AsyncConcurrencyGate(object):
+    """Asyncio counterpart of :class:`ConcurrencyGate`, bound to the event loop it is used in."""
+
+    def __init__(self, controller: AimdController) -> None:
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.controller.current_limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+
+def get_controller(name: str) -> AimdController:
+    """Returns the controller of ``name`` (usually a host), shared by every client of this process."""
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = AimdController(name=name)
+        return _controllers[name]
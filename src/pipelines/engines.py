@@ -0,0 +1,413 @@
+import os
+import re
+import shutil
+import threading
+import time
+
+import awswrangler as wr
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.query_cache import cached_does_table_exist, get_query_cache, referenced_tables
+from src.pipelines.storage import data_file_sizes, delete, list_paths, read_json, write_json
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+ATHENA = "athena"
+DUCKDB = "duckdb"
+ENGINES = [ATHENA, DUCKDB]
+
+INSERT_PATTERN = re.compile(r"^\s*INSERT\s+INTO\s+(\w+)\.(\w+)\s+(.*)$", re.IGNORECASE | re.DOTALL)
+CTAS_PATTERN = re.compile(
+    r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\.(\w+)\s+WITH\s*\((.*?)\)\s*AS\s+(.*)$",
+    re.IGNORECASE | re.DOTALL,
+)
+TABLE_PROPERTY_PATTERN = re.compile(r"(\w+)\s*=\s*(array\s*\[[^\]]*\]|'[^']*')", re.IGNORECASE)
+
+# Presto functions used by the SQL templates, defined as DuckDB macros so the templates run unchanged
+ATHENA_MACROS = [
+    "CREATE OR REPLACE MACRO to_unixtime(ts) AS epoch(ts)",
+    "CREATE OR REPLACE MACRO from_unixtime(seconds) AS to_timestamp(seconds)",
+    "CREATE OR REPLACE MACRO date_format(ts, format) AS strftime(ts, format)",
+]
+
+_engines = {}
+_engines_lock = threading.Lock()
+_default_engine = None
+
+
+def partition_columns(database: str) -> list:
+    """Partition columns of the tables written by ``INSERT INTO`` in ``database``, as declared by their DDL."""
+    if "analytics" in database:
+        return ["address_partition"]
+    return ["year", "month"]
+
+
+def table_location(database: str, table: str, data_root: str = settings.DUCKDB_DATA_ROOT) -> str:
+    """Location of ``database.table``: ``{data_root}/{database}/{table}`` locally, its Glue location otherwise.
+
+    Args:
+        database (str): Database of the table.
+        table (str): Table name.
+        data_root (str): Local directory of the tables, or empty to use the Glue catalog locations.
+
+    Returns:
+        str: Location of the table, without a trailing slash.
+    """
+    if not data_root:
+        return wr.catalog.get_table_location(database=database, table=table).rstrip("/")
+    return f"{data_root.rstrip('/')}/{database}/{table}"
+
+
+def parse_table_properties(properties: str) -> dict:
+    """Parses the ``WITH (...)`` properties of an Athena ``CREATE TABLE AS``, e.g. ``partitioned_by``.
+
+    Returns:
+        dict: Property name to value, a list for ``array [...]`` values.
+    """
+    table_properties = {}
+    for name, value in TABLE_PROPERTY_PATTERN.findall(properties):
+        if value.lower().startswith("array"):
+            table_properties[name.lower()] = re.findall(r"'([^']*)'", value)
+        else:
+            table_properties[name.lower()] = value.strip("'")
+    return table_properties
+
+
+class AthenaEngine(object):
+    """Runs the SQL templates on Athena, which scales to full reloads and backfills."""
+
+    name = ATHENA
+    max_concurrent_queries = settings.ATHENA_MAX_CONCURRENT_QUERIES
+    # Time after replace_table swaps a table before the files it replaced are deleted
+    grace_seconds = settings.COMPACTION_GRACE_SECONDS
+
+    def execute(self, sql: str, database: str) -> None:
+        wr.athena.start_query_execution(sql=sql, database=database, wait=True, athena_query_wait_polling_delay=1)
+
+    def read_sql_query(self, sql: str, database: str, cached: bool = False) -> pd.DataFrame:
+        """Runs the ``SELECT`` ``sql``; a ``cached`` lookup is served by the query cache shared by the tasks."""
+        query_cache = get_query_cache() if cached else None
+        if query_cache is None:
+            return wr.athena.read_sql_query(sql=sql, database=database)
+        return query_cache.read_sql_query(sql, lambda query: wr.athena.read_sql_query(sql=query, database=database))
+
+    def does_table_exist(self, database: str, table: str) -> bool:
+        return cached_does_table_exist(database=database, table=table)
+
+    def replace_table(self, database: str, table: str, sql: str, location: str) -> None:
+        """Replaces the unpartitioned table ``database.table`` with the result of ``sql``, computed by Athena.
+
+        A ``CREATE TABLE AS`` writes the rows to a new ``{location}/{version}/`` as a staging table, then
+        ``ALTER TABLE ... SET LOCATION`` points the table at them in one catalog update, so its readers see either
+        the previous or the new rows. The staging table is dropped (its files are the table's now). The files of
+        the previous location are recorded in a manifest under ``{location}/_manifests/`` and deleted by a later
+        replace once ``grace_seconds`` have passed, like the files replaced by the compaction, so the queries
+        started before the swap can still read them.
+
+        Args:
+            database (str): Database of the table.
+            table (str): Table name.
+            sql (str): ``SELECT`` of the new content of the table.
+            location (str): S3 prefix of the versions of the table.
+        """
+        location = location.rstrip("/")
+        manifest_location = f"{location}/_manifests"
+        self.delete_replaced_files(manifest_location)
+        version = int(time.time())
+        new_location = f"{location}/{version}/"
+        staging_table = table if not self.does_table_exist(database, table) else f"{table}_{version}"
+        self.execute(
+            f"CREATE TABLE {database}.{staging_table} WITH (format = 'PARQUET', external_location = '{new_location}') "
+            f"AS {sql}",
+            database,
+        )
+        if staging_table == table:
+            return
+        previous_location = wr.catalog.get_table_location(database=database, table=table)
+        self.execute(f"ALTER TABLE {database}.{table} SET LOCATION '{new_location}'", database)
+        self.execute(f"DROP TABLE {database}.{staging_table}", database)
+        # The previous location may be the versions prefix itself, which holds the new files and the manifests too
+        replaced = [
+            path
+            for path in data_file_sizes(previous_location)
+            if not path.startswith((new_location, f"{manifest_location}/"))
+        ]
+        write_json(f"{manifest_location}/{version}.json", {"replaced": sorted(replaced), "replaced_at": time.time()})
+
+    def delete_replaced_files(self, manifest_location: str) -> None:
+        """Deletes the files replaced by ``replace_table`` whose grace period has passed, with their manifest."""
+        now = time.time()
+        for manifest_path in list(list_paths(manifest_location)):
+            manifest = read_json(manifest_path)
+            if now - manifest["replaced_at"] < self.grace_seconds:
+                continue
+            # Queries started before the swap are over, so the replaced files are no longer read
+            for path in manifest["replaced"]:
+                delete(path)
+            delete(manifest_path)
+            logger.info(f"Deleted the {len(manifest['replaced'])} files replaced at {manifest_location}")
+
+
+class DuckDBEngine(object):
+    """Runs the SQL templates in process with DuckDB, directly over the parquet files of the Data Lakehouse.
+
+    Every ``database.table`` referenced by a query is exposed as a DuckDB view over its parquet files, and a few
+    Presto functions are defined as macros, so the Athena templates run without changes. An
+    ``INSERT INTO database.table SELECT ...`` (or Athena ``CREATE TABLE ... WITH (...) AS SELECT ...``) is split:
+    DuckDB runs the ``SELECT`` and the result is appended to the table's partitions, its columns taken by position
+    like Athena does. Small incremental batches
+    then skip the Athena queue and polling, which leaves Athena for the large jobs.
+
+    With an empty ``data_root`` the tables are read from and written to their Glue catalog location on S3. A
+    local ``data_root`` holds the tables as ``{data_root}/{database}/{table}/`` instead, which runs the
+    pipelines offline end to end.
+
+    Args:
+        data_root (str): Local directory of the tables, or empty to use the Glue catalog locations.
+        memory_limit (str): DuckDB memory limit, e.g. ``4GB``.
+    """
+
+    name = DUCKDB
+    # DuckDB parallelizes each query itself, so the inserts of a job run one at a time
+    max_concurrent_queries = 1
+
+    def __init__(
+        self, data_root: str = settings.DUCKDB_DATA_ROOT, memory_limit: str = settings.DUCKDB_MEMORY_LIMIT
+    ) -> None:
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError("The duckdb engine needs the duckdb extra: poetry install --extras duckdb") from e
+
+        self.data_root = data_root.rstrip("/") if data_root else None
+        self.lock = threading.Lock()
+        self.glue_client = boto3.client("glue", region_name=settings.REGION) if self.data_root is None else None
+        self.connection = duckdb.connect(database=":memory:")
+        self.connection.execute(f"SET memory_limit = '{memory_limit}'")
+        # Presto divides integers without a remainder, e.g. the day of an epoch timestamp, in every cursor too
+        self.connection.execute("SET GLOBAL integer_division = true")
+        if self.data_root is None:
+            self.connection.execute("INSTALL httpfs; LOAD httpfs; INSTALL aws; LOAD aws;")
+            self.connection.execute(f"CREATE SECRET (TYPE S3, PROVIDER CREDENTIAL_CHAIN, REGION '{settings.REGION}')")
+        for macro in ATHENA_MACROS:
+            self.connection.execute(macro)
+
+    def table_location(self, database: str, table: str) -> str:
+        return table_location(database, table, data_root=self.data_root)
+
+    def table_sources(self, database: str, table: str) -> list:
+        """Returns the data files of ``database.table`` with the values of the partition holding them.
+
+        Every file is read whatever its extension, as the files written by Athena have none, except the hidden
+        (``_``/``.`` prefixed) ones. Locally the partition values are taken from the hive paths of the files. On
+        S3 the partitions and their locations are read from the Glue catalog, like Athena does, since a partition
+        can be located outside the prefix of its table.
+
+        Returns:
+            list: ``(paths, {partition key: value})`` tuples, without values when they are in the paths.
+        """
+        if self.data_root is not None:
+            return [(sorted(data_file_sizes(self.table_location(database, table))), {})]
+        glue_table = self.glue_client.get_table(DatabaseName=database, Name=table)["Table"]
+        location = glue_table["StorageDescriptor"]["Location"].rstrip("/")
+        partition_keys = [key["Name"] for key in glue_table.get("PartitionKeys", [])]
+        table_paths = sorted(data_file_sizes(location))
+        if len(partition_keys) == 0:
+            return [(table_paths, {})]
+        sources = []
+        paginator = self.glue_client.get_paginator("get_partitions")
+        for page in paginator.paginate(DatabaseName=database, TableName=table):
+            for partition in page["Partitions"]:
+                partition_location = partition["StorageDescriptor"]["Location"].rstrip("/") + "/"
+                if partition_location.startswith(f"{location}/"):
+                    # A single listing of the table prefix serves the partitions under it
+                    paths = [path for path in table_paths if path.startswith(partition_location)]
+                else:
+                    paths = sorted(data_file_sizes(partition_location))
+                sources.append((paths, dict(zip(partition_keys, partition["Values"]))))
+        return sources
+
+    def register_tables(self, sql: str) -> None:
+        """Creates or refreshes the views of the tables referenced by ``sql`` over their current data files."""
+        with self.lock:
+            for table_reference in referenced_tables(sql):
+                database, table = table_reference.split(".")
+                selects = []
+                for paths, values in self.table_sources(database, table):
+                    if len(paths) == 0:
+                        continue
+                    files = ", ".join(f"'{path}'" for path in paths)
+                    # Glue partitions are strings, so the hive partition values are not cast to numbers
+                    partition_values = "".join(f", '{value}' AS {key}" for key, value in values.items())
+                    selects.append(
+                        f"""SELECT *{partition_values} FROM read_parquet([{files}],
+                        hive_partitioning = {'false' if values else 'true'}, hive_types_autocast = false,
+                        union_by_name = true)"""
+                    )
+                if len(selects) == 0:
+                    raise FileNotFoundError(f"{table_reference} has no data files")
+                self.connection.execute(f"CREATE SCHEMA IF NOT EXISTS {database}")
+                self.connection.execute(
+                    f"CREATE OR REPLACE VIEW {database}.{table} AS {' UNION ALL BY NAME '.join(selects)}"
+                )
+
+    def read_sql_query(self, sql: str, database: str, cached: bool = False) -> pd.DataFrame:
+        """Runs the ``SELECT`` ``sql``; ``cached`` is ignored, the query never waits on Athena."""
+        self.register_tables(sql)
+        # A cursor per call, as the pipelines run their inserts from several threads
+        return self.connection.cursor().execute(sql).df()
+
+    def write_table(
+        self, database: str, table: str, data: pd.DataFrame, partition_cols: list, location: str = None
+    ) -> None:
+        """Appends ``data`` to the partitions of ``database.table``, creating the table if needed.
+
+        Args:
+            database (str): Database of the table.
+            table (str): Table name.
+            data (pd.DataFrame): Rows to append.
+            partition_cols (list): Partition columns of the table.
+            location (str): S3 location of a table missing from the catalog, used by ``CREATE TABLE AS``.
+        """
+        if self.data_root is None:
+            wr.s3.to_parquet(
+                df=data,
+                path=f"{(location or self.table_location(database, table)).rstrip('/')}/",
+                dataset=True,
+                mode="append",
+                database=database,
+                table=table,
+                partition_cols=partition_cols,
+            )
+        else:
+            pq.write_to_dataset(
+                pa.Table.from_pandas(data, preserve_index=False),
+                root_path=self.table_location(database, table),
+                partition_cols=partition_cols,
+            )
+
+    def table_columns(self, database: str, table: str) -> list:
+        """Columns of ``database.table`` in order, partition columns last, or None if the table has no schema yet.
+
+        Read from the Glue catalog, or from the parquet files of a local ``data_root``.
+        """
+        if self.data_root is None:
+            column_types = wr.catalog.get_table_types(database=database, table=table)
+            return None if column_types is None else list(column_types)
+        location = self.table_location(database, table)
+        for directory, _, file_names in os.walk(location):
+            parquet_files = sorted(name for name in file_names if name.endswith(".parquet"))
+            if len(parquet_files) > 0:
+                # Hive partition directories, outermost first, e.g. year=2023/month=1
+                partition_names = [
+                    part.split("=")[0] for part in os.path.relpath(directory, location).split(os.sep) if "=" in part
+                ]
+                schema = pq.read_schema(os.path.join(directory, parquet_files[0]))
+                return [name for name in schema.names if name not in partition_names] + partition_names
+        return None
+
+    def match_insert_columns(self, database: str, table: str, data: pd.DataFrame) -> pd.DataFrame:
+        """Names the columns of an ``INSERT INTO`` result after the table's, by position, as Athena does.
+
+        Raises:
+            ValueError: When the query selects more or fewer columns than the table has.
+        """
+        columns = self.table_columns(database, table)
+        if columns is None:
+            return data
+        if len(columns) != len(data.columns):
+            raise ValueError(
+                f"INSERT INTO {database}.{table} selects {len(data.columns)} columns, the table has {len(columns)}: "
+                f"{list(data.columns)} into {columns}"
+            )
+        renamed = {selected: column for selected, column in zip(data.columns, columns) if selected != column}
+        if len(renamed) > 0:
+            logger.warning(f"INSERT INTO {database}.{table} writes columns by position: {renamed}")
+        return data.set_axis(columns, axis=1)
+
+    def execute(self, sql: str, database: str) -> None:
+        insert = INSERT_PATTERN.match(sql)
+        ctas = CTAS_PATTERN.match(sql)
+        if insert is not None:
+            target_database, target_table, select = insert.groups()
+            partition_cols = partition_columns(target_database)
+            location = None
+        elif ctas is not None:
+            target_database, target_table, properties, select = ctas.groups()
+            table_properties = parse_table_properties(properties)
+            partition_cols = table_properties.get("partitioned_by")
+            location = table_properties.get("external_location")
+            if self.data_root is not None:
+                # The table exists from now on, even if the query returns no rows
+                os.makedirs(self.table_location(target_database, target_table), exist_ok=True)
+        else:
+            self.register_tables(sql)
+            self.connection.cursor().execute(sql)
+            return
+        data = self.read_sql_query(select, database)
+        if len(data) == 0:
+            logger.info(f"No rows to write into {target_database}.{target_table}")
+            return
+        if insert is not None:
+            data = self.match_insert_columns(target_database, target_table, data)
+        self.write_table(target_database, target_table, data, partition_cols, location)
+        logger.info(f"Wrote {len(data)} rows into {target_database}.{target_table} with DuckDB")
+
+    def replace_table(self, database: str, table: str, sql: str, location: str) -> None:
+        """Replaces the unpartitioned table ``database.table`` with the result of ``sql``.
+
+        Locally the result is written to a staging table, whose directory then takes the place of the table's.
+        Without a local ``data_root`` the table is replaced by Athena at ``location``, see
+        ``AthenaEngine.replace_table``.
+        """
+        if self.data_root is None:
+            AthenaEngine().replace_table(database, table, sql, location)
+            return
+        staging_table = f"{table}_{int(time.time())}"
+        self.execute(f"CREATE TABLE {database}.{staging_table} WITH (format = 'PARQUET') AS {sql}", database)
+        table_location = self.table_location(database, table)
+        replaced_location = f"{table_location}_replaced"
+        if os.path.isdir(table_location):
+            os.rename(table_location, replaced_location)
+        os.rename(self.table_location(database, staging_table), table_location)
+        shutil.rmtree(replaced_location, ignore_errors=True)
+
+    def does_table_exist(self, database: str, table: str) -> bool:
+        if self.data_root is None:
+            return cached_does_table_exist(database=database, table=table)
+        return os.path.isdir(self.table_location(database, table))
+
+
+def set_default_engine(name: str) -> None:
+    """Overrides ``SQL_ENGINE`` for the process, e.g. from the ``--engine`` argument of a pipeline."""
+    global _default_engine
+    if name not in ENGINES:
+        raise ValueError(f"Unknown SQL engine {name}, expected one of {ENGINES}")
+    _default_engine = name
+
+
+def get_engine(name: str = None):
+    """Returns the SQL engine ``name``, by default the one of ``--engine`` or ``SQL_ENGINE``.
+
+    Args:
+        name (str): ``athena`` or ``duckdb``.
+
+    Returns:
+        AthenaEngine | DuckDBEngine: The engine, created once per process.
+    """
+    name = name or _default_engine or settings.SQL_ENGINE
+    with _engines_lock:
+        if name not in _engines:
+            if name == ATHENA:
+                _engines[name] = AthenaEngine()
+            elif name == DUCKDB:
+                _engines[name] = DuckDBEngine()
+            else:
+                raise ValueError(f"Unknown SQL engine {name}, expected one of {ENGINES}")
+        return _engines[name]
@@ -0,0 +1,290 @@
+import asyncio
+import json as json_module
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.concurrency import AsyncConcurrencyGate, ConcurrencyGate, get_controller
+from src.pipelines.rate_limit import TokenBucket
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_HEADERS = {"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_http_client = None
+
+
+class RetryableResponseError(Exception):
+    """Raised when a response has a status code worth retrying (429/5xx)."""
+
+    def __init__(self, status: int, retry_after: float = None) -> None:
+        super().__init__(f"Retryable HTTP status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def requests_per_second_by_host() -> dict:
+    """Returns the request quota configured for each upstream host."""
+    return {
+        urlparse(settings.TRANSPOSE_SQL_URL).netloc: settings.TRANSPOSE_REQUESTS_PER_SECOND,
+        urlparse(settings.SUBGRAPH_GATEWAY_URL).netloc: settings.SUBGRAPH_REQUESTS_PER_SECOND,
+    }
+
+
+def get_rate_limiter(url: str) -> TokenBucket:
+    """Returns the token bucket of the host of ``url``, shared by every client of this process."""
+    host = urlparse(url).netloc
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            rate = requests_per_second_by_host().get(host, settings.HTTP_DEFAULT_REQUESTS_PER_SECOND)
+            _rate_limiters[host] = TokenBucket(rate=rate)
+        return _rate_limiters[host]
+
+
+def endpoint_name(url: str) -> str:
+    """Returns the url used to label metrics, without the API key embedded in gateway urls."""
+    parsed_url = urlparse(url)
+    return parsed_url.netloc + re.sub(r"/api/[^/]+/", "/api/***/", parsed_url.path)
+
+
+def backoff_seconds(attempt: int, retry_after: float = None) -> float:
+    """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+    backoff_cap = min(settings.HTTP_BACKOFF_MAX_SECONDS, settings.HTTP_BACKOFF_BASE_SECONDS * 2**attempt)
+    backoff = random.uniform(0, backoff_cap)
+    return max(backoff, retry_after or 0)
+
+
+def parse_retry_after(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class EndpointStats(object):
+    """Thread-safe request, byte and retry counters per endpoint."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = defaultdict(lambda: {"requests": 0, "bytes": 0, "retries": 0, "errors": 0})
+
+    def add(self, url: str, counter: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[endpoint_name(url)][counter] += amount
+
+    def log(self) -> None:
+        with self.lock:
+            for endpoint, counters in self.counters.items():
+                logger.info(
+                    f"HTTP {endpoint}: {counters['requests']} requests, {counters['bytes']} bytes, "
+                    f"{counters['retries']} retries, {counters['errors']} errors"
+                )
+
+
+class HttpClient(object):
+    """Synchronous HTTP client shared by the ingestors.
+
+    Keeps a pool of keep-alive connections per host, asks for gzip responses, waits on the host's token bucket
+    before every request and retries 429/5xx responses and connection errors with exponential backoff and jitter.
+    The number of requests in flight per host is adapted by an AIMD controller fed with every request's latency
+    and outcome.
+
+    Args:
+        pool_size (int): Maximum number of pooled connections per host.
+        max_retries (int): Number of retries before the last error is raised.
+        timeout (float): Request timeout in seconds.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = settings.HTTP_POOL_SIZE,
+        max_retries: int = settings.HTTP_MAX_RETRIES,
+        timeout: float = settings.HTTP_TIMEOUT_SECONDS,
+    ) -> None:
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.stats = EndpointStats()
+        self.concurrency_gates = {}
+        self.concurrency_gates_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(
+        self, url: str, json: dict = None, headers: dict = None, auth=None, rate_limited: bool = True
+    ) -> requests.Response:
+        """POSTs ``json`` to ``url`` and returns the first successful response.
+
+        ``rate_limited=False`` skips the host token bucket, for callers whose ``auth`` already schedules requests
+        against per-key quotas (see :class:`src.pipelines.api_keys.ApiKeyPool`).
+
+        Raises:
+            requests.RequestException: When the request still fails after ``max_retries`` retries.
+        """
+        rate_limiter = get_rate_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            if rate_limited:
+                rate_limiter.acquire()
+            try:
+                response = self.send(url, json=json, headers=headers, auth=auth)
+                self.stats.add(url, "requests")
+                self.stats.add(url, "bytes", len(response.content))
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise RetryableResponseError(
+                        response.status_code, parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                response.raise_for_status()
+                return response
+            except (RetryableResponseError, requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    self.stats.add(url, "errors")
+                    raise requests.RequestException(f"{endpoint_name(url)} failed after {attempt} retries: {e}") from e
+                self.stats.add(url, "retries")
+                time.sleep(backoff_seconds(attempt, getattr(e, "retry_after", None)))
+
+    def send(self, url: str, json: dict = None, headers: dict = None, auth=None) -> requests.Response:
+        """Sends one request through the host's concurrency gate and reports its outcome to the controller."""
+        gate = self.get_concurrency_gate(url)
+        with gate.slot():
+            started_at = time.monotonic()
+            try:
+                response = self.session.post(url, json=json, headers=headers, auth=auth, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                gate.controller.record(time.monotonic() - started_at, failed=True)
+                raise e
+            gate.controller.record(time.monotonic() - started_at, failed=response.status_code in RETRY_STATUS_CODES)
+            return response
+
+    def post_json(
+        self, url: str, json: dict = None, headers: dict = None, auth=None, rate_limited: bool = True
+    ) -> dict:
+        """POSTs ``json`` to ``url`` and returns the decoded JSON body."""
+        return self.post(url, json=json, headers=headers, auth=auth, rate_limited=rate_limited).json()
+
+    def get_concurrency_gate(self, url: str) -> ConcurrencyGate:
+        host = urlparse(url).netloc
+        with self.concurrency_gates_lock:
+            if host not in self.concurrency_gates:
+                self.concurrency_gates[host] = ConcurrencyGate(get_controller(host))
+            return self.concurrency_gates[host]
+
+    def log_stats(self) -> None:
+        self.stats.log()
+        for gate in self.concurrency_gates.values():
+            gate.controller.log_metrics()
+
+
+class AsyncHttpClient(object):
+    """Asyncio counterpart of :class:`HttpClient`, to be used as an async context manager.
+
+    Args:
+        pool_size (int): Maximum number of pooled connections.
+        max_retries (int): Number of retries before the last error is raised.
+        timeout (float): Request timeout in seconds.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = settings.HTTP_POOL_SIZE,
+        max_retries: int = settings.HTTP_MAX_RETRIES,
+        timeout: float = settings.HTTP_TIMEOUT_SECONDS,
+    ) -> None:
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.stats = EndpointStats()
+        self.concurrency_gates = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+
+    async def post_json(self, url: str, json: dict = None, headers: dict = None) -> dict:
+        """POSTs ``json`` to ``url`` and returns the decoded JSON body of the first successful response.
+
+        Raises:
+            aiohttp.ClientError: When the request still fails after ``max_retries`` retries.
+        """
+        rate_limiter = get_rate_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            wait_seconds = rate_limiter.reserve()
+            if wait_seconds > 0:
+                await asyncio.sleep(wait_seconds)
+            try:
+                response, body = await self.send(url, json=json, headers=headers)
+                self.stats.add(url, "requests")
+                self.stats.add(url, "bytes", len(body))
+                if response.status in RETRY_STATUS_CODES:
+                    raise RetryableResponseError(
+                        response.status, parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                response.raise_for_status()
+                return json_module.loads(body)
+            except (RetryableResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    self.stats.add(url, "errors")
+                    raise aiohttp.ClientError(f"{endpoint_name(url)} failed after {attempt} retries: {e}") from e
+                self.stats.add(url, "retries")
+                await asyncio.sleep(backoff_seconds(attempt, getattr(e, "retry_after", None)))
+
+    async def send(self, url: str, json: dict = None, headers: dict = None) -> tuple:
+        """Sends one request through the host's concurrency gate, reads its body and reports its outcome.
+
+        Returns:
+            tuple: The released response and its body; the body cannot be read again from the response.
+        """
+        gate = self.get_concurrency_gate(url)
+        async with gate.slot():
+            started_at = time.monotonic()
+            try:
+                async with self.session.post(url, json=json, headers=headers) as response:
+                    body = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                gate.controller.record(time.monotonic() - started_at, failed=True)
+                raise e
+            gate.controller.record(time.monotonic() - started_at, failed=response.status in RETRY_STATUS_CODES)
+            return response, body
+
+    def get_concurrency_gate(self, url: str) -> AsyncConcurrencyGate:
+        host = urlparse(url).netloc
+        if host not in self.concurrency_gates:
+            self.concurrency_gates[host] = AsyncConcurrencyGate(get_controller(host))
+        return self.concurrency_gates[host]
+
+    def log_stats(self) -> None:
+        self.stats.log()
+        for gate in self.concurrency_gates.values():
+            gate.controller.log_metrics()
+
+
+def get_http_client() -> HttpClient:
+    """Returns the synchronous client shared by every thread of this process."""
+    global _http_client
+    with _rate_limiters_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
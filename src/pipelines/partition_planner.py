@@ -0,0 +1,127 @@
+from datetime import date, datetime, timedelta, timezone
+
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.block_calendar import get_block_calendar
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+TRANSPOSE = "transpose"
+THE_GRAPH = "the_graph"
+
+# How each source writes its partition values: Transpose events derive integer year/month from the event
+# timestamp (month=1), The Graph tables take them from the block calendar (month=01)
+PARTITION_FORMATS = {
+    TRANSPOSE: ("{:04d}", "{:d}"),
+    THE_GRAPH: ("{:04d}", "{:02d}"),
+}
+ALL_PARTITIONS = "1 = 1"
+
+
+def months_between(first_day: date, last_day: date) -> list:
+    """Returns the ``(year, month)`` of every month from the month of ``first_day`` to the one of ``last_day``."""
+    months = []
+    year, month = first_day.year, first_day.month
+    while (year, month) <= (last_day.year, last_day.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def partition_predicate(months: list, source: str, alias: str = None) -> str:
+    """Returns the SQL predicate selecting the year/month partitions of ``months``.
+
+    Args:
+        months (list): ``(year, month)`` tuples, None for every partition.
+        source (str): ``transpose`` or ``the_graph``, the format of the partition values.
+        alias (str): Optional alias of the table in the query.
+
+    Returns:
+        str: e.g. ``((raw.year = '2023' AND raw.month IN ('11', '12')) OR (raw.year = '2024' AND ...))``.
+    """
+    if months is None:
+        return ALL_PARTITIONS
+    if len(months) == 0:
+        return "1 = 0"
+    year_format, month_format = PARTITION_FORMATS[source]
+    prefix = f"{alias}." if alias else ""
+    months_by_year = {}
+    for year, month in sorted(set(months)):
+        months_by_year.setdefault(year, []).append(f"'{month_format.format(month)}'")
+    predicates = [
+        f"({prefix}year = '{year_format.format(year)}' AND {prefix}month IN ({', '.join(year_months)}))"
+        for year, year_months in months_by_year.items()
+    ]
+    return f"({' OR '.join(predicates)})"
+
+
+def block_partitions(blocks: list) -> list:
+    """Returns the ``(year, month)`` partitions of ``{"protocol", "block_number", "year", "month"}`` block dicts."""
+    return sorted({(2000 + int(block["year"]) % 100, int(block["month"])) for block in blocks})
+
+
+def block_list_predicate(blocks: list, alias: str = None) -> str:
+    """Returns the SQL predicate selecting exactly the The Graph snapshots of ``blocks``.
+
+    Args:
+        blocks (list): ``{"protocol", "block_number", "year", "month"}`` dicts, e.g. replayed dead letters.
+        alias (str): Optional alias of the table in the query.
+
+    Returns:
+        str: e.g. ``((ap.protocol = 'aave-v2-eth' AND ap.block_number IN (16000000, 16007200))) AND (ap.year ...)``.
+    """
+    if len(blocks) == 0:
+        return "1 = 0"
+    prefix = f"{alias}." if alias else ""
+    block_numbers_by_protocol = {}
+    for block in blocks:
+        block_numbers_by_protocol.setdefault(block["protocol"], set()).add(int(block["block_number"]))
+    predicates = [
+        f"({prefix}protocol = '{protocol}' AND {prefix}block_number IN ({', '.join(map(str, sorted(block_numbers)))}))"
+        for protocol, block_numbers in sorted(block_numbers_by_protocol.items())
+    ]
+    return f"({' OR '.join(predicates)}) AND {partition_predicate(block_partitions(blocks), THE_GRAPH, alias)}"
+
+
+def plan_timestamp_partitions(after_timestamp: int, until_timestamp: int) -> list:
+    """Returns the months that can hold rows with a timestamp in ``(after_timestamp, until_timestamp]``.
+
+    The Transpose partitions are the UTC month of the event timestamp.
+
+    Args:
+        after_timestamp (int): Watermark of the target table, in seconds; 0 or None for a first load.
+        until_timestamp (int): Watermark of the source table, in seconds.
+
+    Returns:
+        list: ``(year, month)`` tuples, None when every partition must be read.
+    """
+    if not after_timestamp:
+        return None
+    first_day = datetime.fromtimestamp(after_timestamp, tz=timezone.utc).date()
+    last_day = datetime.fromtimestamp(until_timestamp, tz=timezone.utc).date()
+    return months_between(first_day, last_day)
+
+
+def plan_block_partitions(after_block: int, until_block: int) -> list:
+    """Returns the months that can hold The Graph snapshots of blocks in ``(after_block, until_block]``.
+
+    The months come from the block calendar. A market snapshot taken at the first block of a day is stored in
+    the partition of the day before, so the plan starts one day before the day of ``after_block``.
+
+    Args:
+        after_block (int): Watermark of the target table; 0 or None for a first load.
+        until_block (int): Watermark of the source table.
+
+    Returns:
+        list: ``(year, month)`` tuples, None when every partition must be read.
+    """
+    if not after_block:
+        return None
+    block_calendar = get_block_calendar()
+    first_day = block_calendar.block_to_day(after_block)
+    last_day = block_calendar.block_to_day(until_block)
+    if first_day is None or last_day is None:
+        logger.warning(f"Blocks {after_block}-{until_block} are not in the block calendar, reading every partition")
+        return None
+    return months_between(date(*first_day) - timedelta(days=1), date(*last_day))
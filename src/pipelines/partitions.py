@@ -0,0 +1,38 @@
+import pandas as pd
+
+
+def add_partitions_from_timestamp(data: pd.DataFrame, timestamp_column: str, unit: str = "s") -> pd.DataFrame:
+    """Adds integer ``year`` and ``month`` partition columns derived from a unix timestamp column.
+
+    The timestamps are converted column-wise in one call instead of one ``pd.to_datetime`` per row.
+
+    Args:
+        data (pd.DataFrame): Rows to annotate.
+        timestamp_column (str): Column holding unix timestamps (numbers or numeric strings).
+        unit (str): Unit of the timestamps.
+
+    Returns:
+        pd.DataFrame: ``data`` with ``year`` and ``month`` columns.
+    """
+    timestamps = pd.to_datetime(pd.to_numeric(data[timestamp_column]), unit=unit)
+    data["year"] = timestamps.dt.year
+    data["month"] = timestamps.dt.month
+    return data
+
+
+def add_partitions_from_blocks(data: pd.DataFrame, block_partitions: pd.DataFrame, on: list) -> pd.DataFrame:
+    """Adds the ``year`` and ``month`` partition columns of each row's block with a single merge.
+
+    The rows are matched on their keys, so the result does not depend on the order in which the blocks
+    were fetched.
+
+    Args:
+        data (pd.DataFrame): Rows to annotate, holding the ``on`` columns.
+        block_partitions (pd.DataFrame): One row per block with the ``on`` columns, ``year`` and ``month``.
+        on (list): Columns identifying a block, e.g. ``["protocol", "block_number"]``.
+
+    Returns:
+        pd.DataFrame: ``data`` with ``year`` and ``month`` columns.
+    """
+    data = data.drop(columns=["year", "month"], errors="ignore")
+    return data.merge(block_partitions[on + ["year", "month"]], on=on, how="left", validate="many_to_one")
@@ -0,0 +1,214 @@
+import atexit
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import awswrangler as wr
+import pandas as pd
+import pyarrow as pa
+from spectral_data_lib.data_lakehouse import DataLakehouse
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.storage import read_bytes, write_bytes
+from src.pipelines.watermarks import get_watermark_store
+
+
+data_lakehouse = DataLakehouse()
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+TABLE_REFERENCE_PATTERN = re.compile(r"\b(db_\w+)\.(\w+)\b", re.IGNORECASE)
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def normalize_sql(query: str) -> str:
+    """Collapses whitespace and trailing semicolons so that equivalent queries share a cache entry."""
+    return " ".join(query.split()).rstrip(";").strip()
+
+
+def referenced_tables(query: str) -> list:
+    """Returns the sorted ``database.table`` names referenced by ``query``."""
+    return sorted({f"{database}.{table}".lower() for database, table in TABLE_REFERENCE_PATTERN.findall(query)})
+
+
+class QueryCache(object):
+    """Read-through cache of Athena query results stored as Arrow IPC files.
+
+    An entry is keyed by the normalized SQL and the watermark store version of every table it reads, so a
+    writer advancing (or touching) a table's version makes the entries reading that table unreachable.
+    Entries also expire after ``ttl_seconds``, which bounds the staleness of tables the pipelines do not
+    write, and the directory is bounded to ``max_bytes`` by evicting the least recently used entries.
+
+    Every ECS task starts with an empty local directory, so when ``s3_prefix`` is set every new entry is also
+    copied there and a local miss is read from it: a lookup repeated by the tasks of a DAG run reaches Athena
+    once. The creation time of an entry is stored in its schema metadata, so the copies expire with it.
+
+    Args:
+        directory (str): Local directory holding the cached results.
+        max_bytes (int): Maximum size of the directory.
+        ttl_seconds (int): Lifetime of an entry.
+        s3_prefix (str): Optional ``s3://`` prefix shared by every task.
+    """
+
+    def __init__(
+        self,
+        directory: str = settings.QUERY_CACHE_DIRECTORY,
+        max_bytes: int = settings.QUERY_CACHE_MAX_BYTES,
+        ttl_seconds: int = settings.QUERY_CACHE_TTL_SECONDS,
+        s3_prefix: str = settings.QUERY_CACHE_S3_PREFIX,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.s3_prefix = s3_prefix.rstrip("/") if s3_prefix else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # key -> size in bytes, least recently used first
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        cached_files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".arrow"):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                cached_files.append((stat.st_atime, file_name[: -len(".arrow")], stat.st_size))
+        for _, key, size in sorted(cached_files):
+            self.index[key] = size
+            self.total_bytes += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.arrow")
+
+    def key(self, query: str, versioned: bool = True) -> str:
+        """Returns the key of ``query``, including the version of every table it reads when ``versioned``."""
+        table_versions = []
+        if versioned:
+            watermark_store = get_watermark_store()
+            table_versions = [f"{table}@{watermark_store.version(table)}" for table in referenced_tables(query)]
+        key_document = "\n".join([normalize_sql(query)] + table_versions)
+        return hashlib.sha256(key_document.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> pd.DataFrame:
+        """Returns the cached result of ``key`` from the local directory or the S3 prefix, or None if expired."""
+        table = self.get_local(key)
+        if table is None and self.s3_prefix:
+            table = self.get_shared(key)
+        with self.lock:
+            if table is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self.index:
+                self.index.move_to_end(key)
+        return table.to_pandas()
+
+    def get_local(self, key: str) -> pa.Table:
+        path = self.path(key)
+        try:
+            created_at = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if time.time() - created_at > self.ttl_seconds:
+            return None
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def get_shared(self, key: str) -> pa.Table:
+        """Reads the entry of ``key`` from the S3 prefix and keeps a local copy, as old as the entry."""
+        content = read_bytes(f"{self.s3_prefix}/{key}.arrow")
+        if content is None:
+            return None
+        table = pa.ipc.open_file(pa.BufferReader(content)).read_all()
+        created_at = float((table.schema.metadata or {}).get(b"created_at", 0))
+        if time.time() - created_at > self.ttl_seconds:
+            return None
+        write_bytes(self.path(key), content)
+        os.utime(self.path(key), (time.time(), created_at))
+        self.add_to_index(key, len(content))
+        return table
+
+    def put(self, key: str, result: pd.DataFrame) -> None:
+        """Stores ``result`` under ``key``, evicting the least recently used entries beyond ``max_bytes``."""
+        table = pa.Table.from_pandas(result, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"created_at": str(time.time())})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        content = sink.getvalue().to_pybytes()
+        write_bytes(self.path(key), content)
+        if self.s3_prefix:
+            write_bytes(f"{self.s3_prefix}/{key}.arrow", content)
+        self.add_to_index(key, len(content))
+
+    def add_to_index(self, key: str, size: int) -> None:
+        with self.lock:
+            self.total_bytes += size - self.index.pop(key, 0)
+            self.index[key] = size
+            while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                evicted_key, evicted_size = self.index.popitem(last=False)
+                self.total_bytes -= evicted_size
+                try:
+                    os.remove(self.path(evicted_key))
+                except FileNotFoundError:
+                    pass
+
+    def read_sql_query(self, query: str, read_function) -> pd.DataFrame:
+        """Returns the result of ``query`` from the cache, running ``read_function(query)`` on a miss."""
+        key = self.key(query)
+        result = self.get(key)
+        if result is None:
+            result = read_function(query)
+            self.put(key, result)
+        return result
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Query cache: {self.hits} hits, {self.misses} misses, "
+            f"{len(self.index)} entries, {self.total_bytes} bytes on disk"
+        )
+
+
+def get_query_cache() -> QueryCache:
+    """Returns the query cache of the process, or None when ``QUERY_CACHE_ENABLED`` is false."""
+    global _query_cache
+    if not settings.QUERY_CACHE_ENABLED:
+        return None
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache()
+            atexit.register(_query_cache.log_stats)
+        return _query_cache
+
+
+def cached_read_sql_query(query: str, database_name: str) -> pd.DataFrame:
+    """Cached ``DataLakehouse.read_sql_query``."""
+    query_cache = get_query_cache()
+    if query_cache is None:
+        return data_lakehouse.read_sql_query(database_name=database_name, query=query)
+    return query_cache.read_sql_query(
+        query, lambda sql: data_lakehouse.read_sql_query(database_name=database_name, query=sql)
+    )
+
+
+def cached_does_table_exist(database: str, table: str) -> bool:
+    """Cached ``wr.catalog.does_table_exist``; only existing tables are cached, as a missing one may be created.
+
+    The entry is not keyed by the table version: a table's existence does not change when it is written, and
+    reading its version from the watermark store would cost as much as the Glue call it saves.
+    """
+    query_cache = get_query_cache()
+    if query_cache is None:
+        return wr.catalog.does_table_exist(database=database, table=table)
+    key = query_cache.key(f"does_table_exist {database}.{table}", versioned=False)
+    result = query_cache.get(key)
+    if result is not None:
+        return True
+    if not wr.catalog.does_table_exist(database=database, table=table):
+        return False
+    query_cache.put(key, pd.DataFrame({"table_exists": [True]}))
+    return True
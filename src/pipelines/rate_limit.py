@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket shared by every worker that calls the same upstream API.
+
+    Args:
+        rate (float): Tokens added per second, i.e. the sustained requests per second allowed.
+        capacity (float): Maximum number of tokens, i.e. the burst size. Defaults to ``rate``.
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self) -> float:
+        """Returns the number of tokens currently in the bucket (negative when callers are already waiting)."""
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Takes ``tokens`` from the bucket and returns how many seconds the caller must wait before using them."""
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Blocks until ``tokens`` are available."""
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
@@ -1,8 +1,10 @@
-import requests
 import pandas as pd
 import os
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from argparse import ArgumentParser, Namespace
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
@@ -12,12 +14,27 @@ from spectral_data_lib.log_manager import Logger
 
 
 from config import settings
+from src.pipelines.api_keys import ApiKeyPool
+from src.pipelines.checkpoints import CheckpointManifest
+from src.pipelines.http_client import get_http_client
+from src.pipelines.partitions import add_partitions_from_timestamp
 from src.pipelines.utils import get_latest_timestamp_in_data_lake_table_for_event
+from src.pipelines.watermarks import ALL, event_table, get_watermark_store
+from src.pipelines.writers import StreamingParquetWriter
 
 
 PAGINATION_SIZE = settings.EXTRACTION_PAGINATION_SIZE
 MAX_TIMEWINDOW_DAYS = settings.MAX_TIMEWINDOW_DAYS
 NUMBER_OF_THREADS = settings.NUMBER_OF_THREADS
+PAGINATION_MODE = settings.EXTRACTION_PAGINATION_MODE
+PAGINATION_MODES = ["offset", "keyset"]
+WRITE_MODE = settings.EXTRACTION_WRITE_MODE
+WRITE_MODES = ["batch", "stream"]
+FLUSH_ROWS = settings.EXTRACTION_FLUSH_ROWS
+BACKFILL_SHARDS = settings.BACKFILL_SHARDS
+BACKFILL_MAX_SHARDS_IN_FLIGHT = settings.BACKFILL_MAX_SHARDS_IN_FLIGHT
+TRANSPOSE_SQL_URL = settings.TRANSPOSE_SQL_URL
+TRANSPOSE_REQUESTS_PER_SECOND = settings.TRANSPOSE_REQUESTS_PER_SECOND
 
 data_lakehouse = DataLakehouse()
 logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
@@ -32,7 +49,7 @@ def insert_incoming_data_to_data_lake(incoming_data_df, event_name):
         event_name (str): Event name.
 
     Returns:
-        None. Inserts data into the Data Lakehouse table.
+        None. Inserts data into the Data Lakehouse table and advances its watermark.
     """
     logger.info(f"Inserting {incoming_data_df.shape[0]} rows into Data Lakehouse")
     data_lakehouse.write_parquet_table(
@@ -43,72 +60,463 @@ def insert_incoming_data_to_data_lake(incoming_data_df, event_name):
         layer="raw",
         partition_columns=["year", "month"],
     )
+    latest_timestamp = pd.to_datetime(incoming_data_df["timestamp"], utc=True).max().timestamp()
+    get_watermark_store().advance(event_table(event_name, "raw"), {ALL: latest_timestamp})
 
 
-def fetch_data(event_name, transpose_api_key):
-    headers = {
-        "Content-Type": "application/json",
-        "X-API-KEY": transpose_api_key,
-    }
-    offset_amount = 0
-    continue_fetching = True
-    incoming_data_df = pd.DataFrame([])
+def build_lending_events_query(
+    event_names: list, start_unixtimestamp: int, end_unixtimestamp: int, pagination_mode: str
+) -> str:
+    """Builds the Transpose SQL used to page through lending events of a time window.
 
-    start_unixtimestamp = get_latest_timestamp_in_data_lake_table_for_event(event_name, "raw")
-    end_unixtimestamp = start_unixtimestamp + (MAX_TIMEWINDOW_DAYS * 86400)
-    while continue_fetching:
-        try:
-            json_data = {
-                "sql": f"""
+    Both pagination modes order by the full ``(timestamp, block_number, log_index)`` key so that rows sharing
+    a timestamp always come back in the same order and both modes return exactly the same rows.
+
+    Args:
+        event_names (list): Event names (lending event categories) to fetch in the same scan.
+        start_unixtimestamp (int): Window start (exclusive).
+        end_unixtimestamp (int): Window end (inclusive).
+        pagination_mode (str): ``offset`` or ``keyset``.
+
+    Returns:
+        str: Transpose SQL with ``{{parameter}}`` placeholders for the page position.
+    """
+    if pagination_mode == "keyset":
+        page_filter = """
+                        AND (EXTRACT(EPOCH FROM TIMESTAMP), block_number, log_index) > (
+                            '{{last_unixtimestamp}}'::NUMERIC,
+                            '{{last_block_number}}'::BIGINT,
+                            '{{last_log_index}}'::BIGINT
+                        )"""
+        page_limit = f"LIMIT {PAGINATION_SIZE}"
+    else:
+        page_filter = ""
+        page_limit = f"LIMIT {PAGINATION_SIZE} offset '{{{{offset_amount}}}}'"
+    return f"""
                 SELECT
                     EXTRACT(EPOCH FROM TIMESTAMP) as timestamp_unixtimestamp,
                     *
                 FROM ethereum.lending_events
                     WHERE
-                        category = '{event_name}'
+                        category IN ({", ".join(f"'{event_name}'" for event_name in event_names)})
                         AND protocol_name IN ('aave', 'compound')
                         AND contract_version = 'v2'
                         AND EXTRACT(EPOCH FROM TIMESTAMP) > {start_unixtimestamp}
-                        AND EXTRACT(EPOCH FROM TIMESTAMP) <= {end_unixtimestamp}
-                    ORDER BY TIMESTAMP ASC
-                    LIMIT {PAGINATION_SIZE} offset '{{{{offset_amount}}}}'""",
-                "parameters": {
-                    "offset_amount": offset_amount,
-                },
-                "options": {},
-            }
-            response = requests.post("https://api.transpose.io/sql", headers=headers, json=json_data)
-            current_results_dataframe = pd.DataFrame(response.json().get("results"))
-            offset_amount += current_results_dataframe.shape[0]
-            # if we're getting less than N results, we know there's no more to fetch.
-            if current_results_dataframe.shape[0] < 10000:
-                continue_fetching = False
-            if current_results_dataframe.shape[0] == 0:
-                return None
-            incoming_data_df = pd.concat([incoming_data_df, current_results_dataframe], axis=0)
-            logger.info(f"Fetched {event_name} up to {current_results_dataframe.iloc[-1]['timestamp']}")
+                        AND EXTRACT(EPOCH FROM TIMESTAMP) <= {end_unixtimestamp}{page_filter}
+                    ORDER BY TIMESTAMP ASC, block_number ASC, log_index ASC
+                    {page_limit}"""
+
+
+def fetch_pages(
+    event_names: list,
+    api_key_pool: ApiKeyPool,
+    start_unixtimestamp: int,
+    end_unixtimestamp: int,
+    pagination_mode: str = PAGINATION_MODE,
+    position: dict = None,
+):
+    """Yields the lending events of a time window one Transpose page at a time.
+
+    In ``offset`` mode each page skips the rows already read, so the server scans more rows on every page.
+    In ``keyset`` mode each page continues right after the ``(timestamp, block_number, log_index)`` of the
+    last row of the previous page.
+
+    ``position`` is updated in place after every page with both the offset and the keyset cursor reached.
+
+    Args:
+        event_names (list): Event names (lending event categories) to fetch in the same scan.
+        api_key_pool (ApiKeyPool): Pool of Transpose API keys the requests are scheduled on.
+        start_unixtimestamp (int): Window start (exclusive).
+        end_unixtimestamp (int): Window end (inclusive).
+        pagination_mode (str): ``offset`` or ``keyset``.
+        position (dict): Position to start from, updated in place after every page.
+
+    Yields:
+        pd.DataFrame: One non-empty page of results.
+    """
+    sql = build_lending_events_query(event_names, start_unixtimestamp, end_unixtimestamp, pagination_mode)
+    http_client = get_http_client()
+    if position is None:
+        position = {}
+    position.setdefault("offset_amount", 0)
+    position.setdefault("last_unixtimestamp", start_unixtimestamp)
+    position.setdefault("last_block_number", -1)
+    position.setdefault("last_log_index", -1)
+    while True:
+        if pagination_mode == "keyset":
+            parameters = {key: position[key] for key in ["last_unixtimestamp", "last_block_number", "last_log_index"]}
+        else:
+            parameters = {"offset_amount": position["offset_amount"]}
+        try:
+            response = http_client.post_json(
+                TRANSPOSE_SQL_URL,
+                json={"sql": sql, "parameters": parameters, "options": {}},
+                auth=api_key_pool,
+                rate_limited=False,
+            )
+            current_results_dataframe = pd.DataFrame(response.get("results"))
         except Exception as e:
-            logger.error(f"issue at {offset_amount}")
+            logger.error(f"issue at position {position}")
             raise e
-    incoming_data_df["year"] = (
-        incoming_data_df["timestamp_unixtimestamp"].apply(lambda x: pd.to_datetime(x, unit="s")).dt.year
+        if current_results_dataframe.shape[0] == 0:
+            return
+        last_row = current_results_dataframe.iloc[-1]
+        position.update(
+            offset_amount=position["offset_amount"] + current_results_dataframe.shape[0],
+            last_unixtimestamp=last_row["timestamp_unixtimestamp"],
+            last_block_number=int(last_row["block_number"]),
+            last_log_index=int(last_row["log_index"]),
+        )
+        logger.info(f"Fetched {', '.join(event_names)} up to {last_row['timestamp']}")
+        yield current_results_dataframe
+        # if we're getting less than N results, we know there's no more to fetch.
+        if current_results_dataframe.shape[0] < PAGINATION_SIZE:
+            return
+
+
+def add_partition_columns(incoming_data_df: pd.DataFrame) -> pd.DataFrame:
+    """Derives the year/month partition columns from the event timestamp.
+
+    Args:
+        incoming_data_df (pd.DataFrame): Transpose rows with a ``timestamp_unixtimestamp`` column.
+
+    Returns:
+        pd.DataFrame: Rows with ``year`` and ``month`` columns and without ``timestamp_unixtimestamp``.
+    """
+    incoming_data_df = add_partitions_from_timestamp(incoming_data_df, "timestamp_unixtimestamp")
+    return incoming_data_df.drop(columns=["timestamp_unixtimestamp"])
+
+
+def fetch_data(event_name, api_key_pool: ApiKeyPool, pagination_mode: str = PAGINATION_MODE):
+    start_unixtimestamp = get_latest_timestamp_in_data_lake_table_for_event(event_name, "raw")
+    end_unixtimestamp = start_unixtimestamp + (MAX_TIMEWINDOW_DAYS * 86400)
+    pages = list(fetch_pages([event_name], api_key_pool, start_unixtimestamp, end_unixtimestamp, pagination_mode))
+    if len(pages) == 0:
+        return None
+    return add_partition_columns(pd.concat(pages, axis=0))
+
+
+class EventCategoryWriter(object):
+    """Routes Transpose rows by ``category`` to one streaming writer per raw ``transpose_{event}_events`` table.
+
+    Each table keeps its own watermark: rows at or before the latest timestamp already stored in a table are
+    dropped, so a scan over several categories can start at the oldest watermark and per-event runs and combined
+    runs can be mixed freely.
+
+    Every table is flushed once ``flush_rows`` rows are buffered. Unless the flush is final, the rows sharing the
+    latest buffered timestamp of a table are held back for the next flush, since the next page can hold more
+    rows of that timestamp. The watermark of a table is advanced right after each of its writes and ``on_write``
+    is called, so the caller can checkpoint the watermarks one table at a time: a retry drops the rows a table
+    already holds instead of writing them again.
+
+    Args:
+        watermarks (dict): Latest timestamp stored in each raw event table, by event name. Updated in place.
+        flush_rows (int): Number of buffered rows that triggers a flush of every table. None only flushes on
+            explicit ``flush`` calls.
+        on_write (callable): Optional function called after every table write.
+    """
+
+    def __init__(self, watermarks: dict, flush_rows: int, on_write=None) -> None:
+        self.watermarks = watermarks
+        self.flush_rows = flush_rows
+        self.on_write = on_write
+        self.scanned_unixtimestamp = None
+        self.writers = {
+            event_name: StreamingParquetWriter(
+                write_function=partial(self.write_event_rows, event_name),
+                flush_rows=None,
+                hold_back_column="timestamp_unixtimestamp",
+            )
+            for event_name in watermarks.keys()
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    @property
+    def buffered_rows(self) -> int:
+        return sum(writer.buffered_rows for writer in self.writers.values())
+
+    @property
+    def flushed_rows(self) -> int:
+        return sum(writer.flushed_rows for writer in self.writers.values())
+
+    def write(self, data: pd.DataFrame) -> None:
+        if data is None or data.shape[0] == 0:
+            return
+        data = data.assign(timestamp_unixtimestamp=data["timestamp_unixtimestamp"].astype(float))
+        self.scanned_unixtimestamp = data["timestamp_unixtimestamp"].max()
+        for event_name, rows in data.groupby("category"):
+            rows = rows[rows["timestamp_unixtimestamp"] > self.watermarks[event_name]]
+            if rows.shape[0] > 0:
+                self.writers[event_name].write(add_partitions_from_timestamp(rows.copy(), "timestamp_unixtimestamp"))
+        if self.flush_rows is not None and self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def write_event_rows(self, event_name: str, rows: pd.DataFrame) -> None:
+        insert_incoming_data_to_data_lake(rows.drop(columns=["timestamp_unixtimestamp"]), event_name)
+        self.watermarks[event_name] = max(self.watermarks[event_name], float(rows["timestamp_unixtimestamp"].max()))
+        if self.on_write is not None:
+            self.on_write()
+
+    def flush(self, final: bool = False) -> None:
+        """Writes the buffered rows of every table, holding back the rows of their latest timestamp unless final."""
+        for writer in self.writers.values():
+            writer.flush(final=final)
+
+    def resume_after(self) -> float:
+        """Returns a timestamp such that every row scanned up to it is persisted, or None.
+
+        Scanned rows before the earliest one still buffered are all persisted (or were already stored), so the
+        latest watermark below it is a safe exclusive start for a retried scan: the rows of the tables that are
+        ahead of it are dropped by their own watermark.
+        """
+        if self.scanned_unixtimestamp is None:
+            return None
+        buffered_timestamps = [
+            rows["timestamp_unixtimestamp"].min() for writer in self.writers.values() for rows in writer.buffer
+        ]
+        unpersisted_from = min(buffered_timestamps + [self.scanned_unixtimestamp])
+        return max([watermark for watermark in self.watermarks.values() if watermark < unpersisted_from], default=None)
+
+    def close(self) -> None:
+        self.flush(final=True)
+        for event_name, writer in self.writers.items():
+            logger.info(f"Closing writer of transpose_{event_name}_events")
+            writer.close()
+
+
+def get_event_watermarks(event_names: list) -> dict:
+    """Returns the latest timestamp stored in the raw table of each event."""
+    return {
+        event_name: get_latest_timestamp_in_data_lake_table_for_event(event_name, "raw") for event_name in event_names
+    }
+
+
+def get_checkpoint(event_names: list, write_mode: str) -> CheckpointManifest:
+    """Returns the checkpoint manifest of a streaming or backfill extraction of ``event_names``."""
+    job_events = event_names[0] if len(event_names) == 1 else "all"
+    return CheckpointManifest(job_name=f"raw_transpose_{job_events}_events_{write_mode}")
+
+
+def stream_data(
+    event_names: list,
+    api_key_pool: ApiKeyPool,
+    pagination_mode: str = PAGINATION_MODE,
+    flush_rows: int = FLUSH_ROWS,
+) -> EventCategoryWriter:
+    """Fetches the next time window page by page and writes it to the Data Lakehouse as it arrives.
+
+    Memory stays bounded by ``flush_rows`` (plus one page) whatever the size of the time window. When several
+    events are given they are fetched in one paged scan starting at the oldest of their watermarks.
+
+    The watermark of every table is checkpointed after each of its writes, with the timestamp up to which
+    the scan is persisted; a retry after a failure resumes the same window from that timestamp instead of
+    starting it over, and drops the rows each table already holds.
+
+    Args:
+        event_names (list): Event names.
+        api_key_pool (ApiKeyPool): Pool of Transpose API keys the requests are scheduled on.
+        pagination_mode (str): ``offset`` or ``keyset``.
+        flush_rows (int): Number of buffered rows that triggers a parquet part write.
+
+    Returns:
+        EventCategoryWriter: The closed writer, holding the number of rows flushed.
+    """
+    checkpoint = get_checkpoint(event_names, "stream")
+    state = checkpoint.load()
+    if state is None or "resume_after" not in state:
+        watermarks = get_event_watermarks(event_names)
+        start_unixtimestamp = min(watermarks.values())
+        state = {
+            "watermarks": watermarks,
+            "window": [start_unixtimestamp, start_unixtimestamp + (MAX_TIMEWINDOW_DAYS * 86400)],
+            "resume_after": start_unixtimestamp,
+        }
+    _, end_unixtimestamp = state["window"]
+
+    def save_checkpoint() -> None:
+        resume_after = writer.resume_after()
+        if resume_after is not None:
+            state["resume_after"] = max(state["resume_after"], resume_after)
+        checkpoint.save(state)
+
+    writer = EventCategoryWriter(watermarks=state["watermarks"], flush_rows=flush_rows, on_write=save_checkpoint)
+    with writer:
+        for page in fetch_pages(event_names, api_key_pool, state["resume_after"], end_unixtimestamp, pagination_mode):
+            writer.write(page)
+    checkpoint.clear()
+    return writer
+
+
+def split_time_window(start_unixtimestamp: int, end_unixtimestamp: int, shards: int) -> list:
+    """Splits the ``(start, end]`` window into consecutive ``(start, end]`` sub-windows of equal length.
+
+    Args:
+        start_unixtimestamp (int): Window start (exclusive).
+        end_unixtimestamp (int): Window end (inclusive).
+        shards (int): Number of sub-windows.
+
+    Returns:
+        list: ``(start, end)`` tuples in chronological order.
+    """
+    shards = max(1, min(shards, end_unixtimestamp - start_unixtimestamp))
+    step = (end_unixtimestamp - start_unixtimestamp) // shards
+    boundaries = [start_unixtimestamp + step * i for i in range(shards)] + [end_unixtimestamp]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def fetch_shard(
+    event_names: list,
+    api_key_pool: ApiKeyPool,
+    start_unixtimestamp: int,
+    end_unixtimestamp: int,
+    pagination_mode: str,
+) -> pd.DataFrame:
+    """Fetches every page of one sub-window and returns them as a single frame (or None)."""
+    pages = list(fetch_pages(event_names, api_key_pool, start_unixtimestamp, end_unixtimestamp, pagination_mode))
+    logger.info(f"Fetched shard ({start_unixtimestamp}, {end_unixtimestamp}]: {len(pages)} pages")
+    if len(pages) == 0:
+        return None
+    return pd.concat(pages, axis=0, ignore_index=True)
+
+
+def backfill_data(
+    event_names: list,
+    api_key_pool: ApiKeyPool,
+    pagination_mode: str = PAGINATION_MODE,
+    window_days: int = MAX_TIMEWINDOW_DAYS,
+    shards: int = BACKFILL_SHARDS,
+    max_workers: int = NUMBER_OF_THREADS,
+    flush_rows: int = FLUSH_ROWS,
+    max_shards_in_flight: int = BACKFILL_MAX_SHARDS_IN_FLIGHT,
+) -> EventCategoryWriter:
+    """Fetches a time window as concurrent time shards and writes them back in chronological order.
+
+    Shards are fetched by a pool of ``max_workers`` threads sharing the Transpose rate limit of the HTTP client.
+    The writer consumes the shards strictly in order and checkpoints every persisted shard, so a failed run
+    resumes at the first unfinished shard and produces the same partitions as a serial run.
+
+    At most ``max_shards_in_flight`` shards are submitted ahead of the next one to write, so the shards that
+    finish out of order and wait for an earlier, slower one stay bounded in memory.
+
+    Args:
+        event_names (list): Event names.
+        api_key_pool (ApiKeyPool): Pool of Transpose API keys the requests are scheduled on.
+        pagination_mode (str): ``offset`` or ``keyset``.
+        window_days (int): Size of the window to backfill, starting at the latest timestamp in the raw table.
+        shards (int): Number of sub-windows the window is split into.
+        max_workers (int): Number of sub-windows fetched concurrently.
+        flush_rows (int): Number of buffered rows that triggers a parquet part write.
+        max_shards_in_flight (int): Maximum number of shards fetched or fetching but not written yet, at least
+            ``max_workers``.
+
+    Returns:
+        EventCategoryWriter: The closed writer, holding the number of rows flushed.
+    """
+    checkpoint = get_checkpoint(event_names, "backfill")
+    state = checkpoint.load()
+    if state is None:
+        watermarks = get_event_watermarks(event_names)
+        start_unixtimestamp = min(watermarks.values())
+        end_unixtimestamp = start_unixtimestamp + (window_days * 86400)
+        state = {
+            "watermarks": watermarks,
+            "sub_windows": split_time_window(start_unixtimestamp, end_unixtimestamp, shards),
+            "completed_shards": 0,
+        }
+    sub_windows = iter(state["sub_windows"][state["completed_shards"] :])
+    max_shards_in_flight = max(max_shards_in_flight, max_workers)
+    logger.info(
+        f"Backfilling {', '.join(event_names)} in {len(state['sub_windows']) - state['completed_shards']} shards "
+        f"with {max_workers} workers, {max_shards_in_flight} shards in flight"
     )
-    incoming_data_df["month"] = (
-        incoming_data_df["timestamp_unixtimestamp"].apply(lambda x: pd.to_datetime(x, unit="s")).dt.month
+
+    # Shards are flushed one by one, and each table write checkpoints its watermark, so that a shard retried
+    # after a failure in the middle of its flush only writes the tables it had not written yet
+    writer = EventCategoryWriter(
+        watermarks=state["watermarks"], flush_rows=None, on_write=lambda: checkpoint.save(state)
     )
-    incoming_data_df.drop(columns=["timestamp_unixtimestamp"], inplace=True)
-    return incoming_data_df
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, writer:
 
+        def submit_next_shard() -> None:
+            sub_window = next(sub_windows, None)
+            if sub_window is not None:
+                shard_start, shard_end = sub_window
+                futures.append(
+                    executor.submit(fetch_shard, event_names, api_key_pool, shard_start, shard_end, pagination_mode)
+                )
 
-def update_event_table(event_name: str, transpose_api_key):
+        futures = deque()
+        for _ in range(max_shards_in_flight):
+            submit_next_shard()
+        try:
+            while len(futures) > 0:
+                shard = futures.popleft().result()
+                submit_next_shard()
+                writer.write(shard)
+                # The shard is complete, so none of its rows are held back
+                writer.flush(final=True)
+                state["completed_shards"] += 1
+                checkpoint.save(state)
+        except Exception as e:
+            for future in futures:
+                future.cancel()
+            raise e
+    checkpoint.clear()
+    return writer
+
+
+def update_event_table(
+    event_name: str,
+    transpose_api_keys: list,
+    pagination_mode: str = PAGINATION_MODE,
+    write_mode: str = WRITE_MODE,
+    flush_rows: int = FLUSH_ROWS,
+    backfill: bool = False,
+    window_days: int = MAX_TIMEWINDOW_DAYS,
+    shards: int = BACKFILL_SHARDS,
+):
     start = time.time()
 
-    incoming_data = fetch_data(event_name=event_name, transpose_api_key=transpose_api_key)
-    if incoming_data is not None:
-        insert_incoming_data_to_data_lake(incoming_data_df=incoming_data, event_name=event_name)
+    # "all" fetches every event in a single scan, which is only supported by the streaming write path
+    event_names_to_fetch = settings.EVENTS_NAMES if event_name == "all" else [event_name]
+    if event_name == "all" and write_mode == "batch":
+        write_mode = "stream"
+    api_key_pool = ApiKeyPool(api_keys=transpose_api_keys, requests_per_second=TRANSPOSE_REQUESTS_PER_SECOND)
+    if backfill:
+        writer = backfill_data(
+            event_names=event_names_to_fetch,
+            api_key_pool=api_key_pool,
+            pagination_mode=pagination_mode,
+            window_days=window_days,
+            shards=shards,
+            flush_rows=flush_rows,
+        )
+        if writer.flushed_rows == 0:
+            logger.info(f"No new data for {event_name}")
+    elif write_mode == "stream":
+        writer = stream_data(
+            event_names=event_names_to_fetch,
+            api_key_pool=api_key_pool,
+            pagination_mode=pagination_mode,
+            flush_rows=flush_rows,
+        )
+        if writer.flushed_rows == 0:
+            logger.info(f"No new data for {event_name}")
     else:
-        logger.info(f"No new data for {event_name}")
+        incoming_data = fetch_data(event_name=event_name, api_key_pool=api_key_pool, pagination_mode=pagination_mode)
+        if incoming_data is not None:
+            insert_incoming_data_to_data_lake(incoming_data_df=incoming_data, event_name=event_name)
+        else:
+            logger.info(f"No new data for {event_name}")
 
+    get_http_client().log_stats()
+    api_key_pool.log_stats()
     end = time.time()
     logger.info(f"Completed successfully. Elapsed time: {end - start}")
 
@@ -121,15 +529,55 @@ def get_args() -> Namespace:
         "-e",
         type=str,
         required=True,
-        choices=event_names,
-        help="Event Name",
+        choices=event_names + ["all"],
+        help="Event Name, or all to fetch every event in a single scan",
     )
     parser.add_argument(
         "--api_key",
         "-k",
         type=str,
         required=True,
-        help="Pipeline Name",
+        action="append",
+        help="Transpose API key. Repeat it (or pass a comma separated list) to share the quota of several keys",
+    )
+    parser.add_argument(
+        "--pagination_mode",
+        "-p",
+        type=str,
+        default=PAGINATION_MODE,
+        choices=PAGINATION_MODES,
+        help="Transpose pagination mode: offset (LIMIT/OFFSET) or keyset (cursor on timestamp, block, log index)",
+    )
+    parser.add_argument(
+        "--write_mode",
+        "-w",
+        type=str,
+        default=WRITE_MODE,
+        choices=WRITE_MODES,
+        help="batch (write the whole window at once) or stream (write a parquet part every --flush_rows rows)",
+    )
+    parser.add_argument(
+        "--flush_rows",
+        type=int,
+        default=FLUSH_ROWS,
+        help="Number of buffered rows written as one parquet part in stream mode",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Fetch the window as concurrent time shards (catch-up after downtime)",
+    )
+    parser.add_argument(
+        "--window_days",
+        type=int,
+        default=MAX_TIMEWINDOW_DAYS,
+        help="Number of days fetched from the latest timestamp in the raw table in backfill mode",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=BACKFILL_SHARDS,
+        help="Number of time shards the backfill window is split into",
     )
     return parser.parse_args()
 
@@ -137,4 +585,13 @@ def get_args() -> Namespace:
 if __name__ == "__main__":
     args = get_args()
 
-    update_event_table(args.event_name, args.api_key)
+    update_event_table(
+        args.event_name,
+        [api_key for api_keys in args.api_key for api_key in api_keys.split(",") if api_key],
+        args.pagination_mode,
+        args.write_mode,
+        args.flush_rows,
+        args.backfill,
+        args.window_days,
+        args.shards,
+    )
@@ -1,6 +1,6 @@
+import argparse
 import asyncio
 import time
-import aiohttp
 import pandas as pd
 import gc
 
@@ -10,12 +10,20 @@ from spectral_data_lib.log_manager import Logger
 from spectral_data_lib.helpers.get_secrets import get_secret
 
 
+from src.pipelines.checkpoints import CheckpointManifest
+from src.pipelines.http_client import AsyncHttpClient
+from src.pipelines.response_cache import get_response_cache
+from src.pipelines.subgraph import fetch_keyset_ranges, id_ranges
 from src.pipelines.utils import fetch_daily_first_block_numbers_and_partitions, get_start_block_to_fetch_new_data
+from src.pipelines.watermarks import get_watermark_store
+from src.pipelines.work_queue import AsyncWorkQueue, DeadLetterStore, ReplayedBlockStore
 
 
 data_lakehouse = DataLakehouse()
 logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
 
+JOB_NAME = "raw_the_graph_historical_account_positions"
+
 
 def insert_incoming_data_into_data_lake(data: pd.DataFrame):
     data_lakehouse.write_parquet_table(
@@ -26,87 +34,63 @@ def insert_incoming_data_into_data_lake(data: pd.DataFrame):
         layer="raw",
         partition_columns=["year", "month"],
     )
+    get_watermark_store().advance(
+        "db_raw_prod.the_graph_historical_account_positions", data.groupby("protocol")["block_number"].max().to_dict()
+    )
 
 
 async def get_data_for_block_range(
-    session,
+    http_client,
     block_number,
     url,
     query,
     protocol,
-    sem,
     year,
     month,
 ) -> pd.DataFrame:
     """Fetches data from Subgraph for a given block number and protocol.
 
+    Positions are paged with ``id_gt`` keyset pagination over ``POSITIONS_ID_RANGES`` id ranges fetched
+    concurrently (up to ``POSITIONS_REQUESTS_PER_BLOCK`` requests in flight), so a block holding millions of
+    positions is not fetched one page after another. Failures are raised to the work queue, which retries
+    the block later.
+
     Args:
-        session (aiohttp.ClientSession): An aiohttp session.
+        http_client (AsyncHttpClient): The shared async HTTP client.
         block_number (int): The block number to fetch data for.
         url (str): The URL of the Subgraph.
         query (str): The GraphQL query to run.
         protocol (str): The protocol to fetch data for.
-        sem (asyncio.Semaphore): An asyncio semaphore.
+        year (str): Two-digit year partition of the block.
+        month (str): Month partition of the block.
 
     Returns:
         pd.DataFrame: The data fetched from the Subgraph.
     """
-    async with sem:
-        logger.info(f"Attempting to get response for block {block_number} on {protocol}")
-        total_block_dataframe_list = []
-        more_to_fetch = True
-        query_variables = {"block_number": block_number, "last_id": ""}
-        while more_to_fetch:
-            try:
-                response = await session.post(url=url, json={"query": query, "variables": query_variables})
-                try:
-                    subgraph_response_dict = await response.json()
-                    if (
-                        not subgraph_response_dict.get("data").get("first_results")
-                        or len(subgraph_response_dict.get("data").get("first_results")) == 0
-                    ):
-                        # No result or no more data to fetch
-                        logger.info(f"No result for {block_number}")
-                        more_to_fetch = False
-                    else:
-                        for result in list(subgraph_response_dict.get("data").keys()):
-                            if subgraph_response_dict.get("data").get(result):
-                                # load and append our data
-                                dataframe_chunk = pd.DataFrame.from_dict(subgraph_response_dict.get("data").get(result))
-                                dataframe_chunk["block_number"] = block_number
-                                dataframe_chunk["protocol"] = protocol
-                                dataframe_chunk["year"] = f"20{year}"
-                                dataframe_chunk["month"] = month
-                                total_block_dataframe_list.append(dataframe_chunk)
-
-                                # If we have less than 1000 results in any result we're done
-                                if len(subgraph_response_dict.get("data").get(result)) < 1000:
-                                    more_to_fetch = False
-
-                                # If we have 1000 results in the sixth_result key in any result we need to fetch more
-                                if more_to_fetch:
-                                    logger.info(
-                                        f'Paginating on block number {block_number} with new last id {dataframe_chunk.iloc[-1]["id"].split("-")[0]}'
-                                    )
-                                    query_variables = {
-                                        "block_number": block_number,
-                                        "last_id": dataframe_chunk.iloc[-1]["id"],
-                                    }
-                                    await asyncio.sleep(0.25)
-
-                except Exception as e:
-                    logger.error(f"Failed to parse response for block {block_number}")
-                    logger.error(e)
-                    continue
-            except Exception as e:
-                logger.error(f"Failed to get response for block {block_number}")
-                logger.error(e)
-                continue
-        return pd.concat(total_block_dataframe_list)
-
-
-async def fetch_data(api_key: str):
-    param_dict = {
+    logger.info(f"Attempting to get response for block {block_number} on {protocol}")
+    positions = await fetch_keyset_ranges(
+        http_client=http_client,
+        url=url,
+        query=query,
+        variables={"block_number": block_number},
+        entity="positions",
+        ranges=id_ranges(settings.POSITIONS_ID_RANGES),
+        max_in_flight=settings.POSITIONS_REQUESTS_PER_BLOCK,
+        split_after_pages=settings.POSITIONS_SPLIT_AFTER_PAGES,
+    )
+    if len(positions) == 0:
+        logger.info(f"No result for {block_number}")
+        return pd.DataFrame([])
+    block_dataframe = pd.DataFrame.from_dict(positions)
+    block_dataframe["block_number"] = block_number
+    block_dataframe["protocol"] = protocol
+    block_dataframe["year"] = f"20{year}"
+    block_dataframe["month"] = month
+    return block_dataframe
+
+
+def get_subgraph_params(api_key: str) -> dict:
+    return {
         "compound-v2-eth": {
             "url": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/6tGbL7WBx287EZwGUvvcQdL6m67JGMJrma3JSTtt5SV7",
             "earliest_block": 7774386,
@@ -116,10 +100,116 @@ async def fetch_data(api_key: str):
             "earliest_block": 11363052,
         },
     }
-    query = open("src/pipelines/raw/queries/historical_account_positions.graphql").read()
 
+
+def block_key(block: dict) -> str:
+    return f"{block['protocol']}:{block['block_number']}"
+
+
+class BlockPipeline(object):
+    """Fetches blocks with a pool of workers and writes them from a single writer task.
+
+    Fetched frames go through a bounded queue of ``ACCOUNT_POSITIONS_WRITE_QUEUE_SIZE`` blocks: the writer
+    persists a block while the workers download the next ones, and the workers wait when the writer falls
+    behind. At most ``workers + results buffer + queue size`` blocks are held in memory, whatever the size of
+    the block window.
+
+    Args:
+        http_client (AsyncHttpClient): The shared async HTTP client.
+        param_dict (dict): Subgraph url and earliest block of each protocol.
+        on_persisted (callable): Function called with each block once it is written.
+    """
+
+    def __init__(self, http_client, param_dict: dict, on_persisted) -> None:
+        self.http_client = http_client
+        self.param_dict = param_dict
+        self.on_persisted = on_persisted
+        self.query = open("src/pipelines/raw/queries/historical_account_positions.graphql").read()
+        self.write_queue = asyncio.Queue(maxsize=settings.ACCOUNT_POSITIONS_WRITE_QUEUE_SIZE)
+        self.writer_task = None
+
+    async def __aenter__(self):
+        self.writer_task = asyncio.ensure_future(self.write_blocks())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.writer_task.cancel()
+            await asyncio.gather(self.writer_task, return_exceptions=True)
+            return
+        await self.put(None)
+        await self.writer_task
+
+    async def write_blocks(self) -> None:
+        while True:
+            entry = await self.write_queue.get()
+            if entry is None:
+                return
+            block, block_dataframe = entry
+            if block_dataframe.shape[0] > 0:
+                logger.info(f"Block {block['block_number']} on {block['protocol']}: {block_dataframe.shape[0]} rows")
+                await asyncio.to_thread(insert_incoming_data_into_data_lake, block_dataframe)
+            self.on_persisted(block)
+            del entry, block_dataframe
+            gc.collect()
+
+    async def put(self, entry) -> None:
+        """Puts ``entry`` on the write queue, raising the writer's error if it stopped."""
+        put_task = asyncio.ensure_future(self.write_queue.put(entry))
+        await asyncio.wait({put_task, self.writer_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not put_task.done():
+            put_task.cancel()
+            self.writer_task.result()
+            raise RuntimeError("Block writer stopped before the pipeline was closed")
+
+    async def fetch_block(self, block: dict) -> pd.DataFrame:
+        return await get_data_for_block_range(
+            http_client=self.http_client,
+            block_number=block["block_number"],
+            url=self.param_dict[block["protocol"]]["url"],
+            query=self.query,
+            protocol=block["protocol"],
+            year=block["year"],
+            month=block["month"],
+        )
+
+    async def fetch(self, blocks: list) -> list:
+        """Fetches ``blocks`` through a retrying work queue and hands each one to the writer.
+
+        Args:
+            blocks (list): ``{"protocol", "block_number", "year", "month"}`` dicts.
+
+        Returns:
+            list: The blocks that were dead-lettered.
+        """
+        # The workers bound the blocks being downloaded; the requests in flight are adapted by the client's
+        # AIMD controller
+        work_queue = AsyncWorkQueue(
+            handler=self.fetch_block,
+            workers=settings.ACCOUNT_POSITIONS_MAX_BLOCKS_IN_FLIGHT,
+            dead_letters=DeadLetterStore(job_name=JOB_NAME),
+        )
+        logger.info(f"There are {len(blocks)} blocks to fetch during this iteration")
+        async for block, block_dataframe in work_queue.run(blocks):
+            await self.put((block, block_dataframe))
+        return work_queue.dead_lettered
+
+
+def plan_block_window(param_dict: dict, start_block: int = None) -> list:
+    """Returns the blocks of the next window to fetch for every protocol.
+
+    Args:
+        param_dict (dict): Subgraph url and earliest block of each protocol.
+        start_block (int): Last block already planned. None reads it from the Data Lakehouse table.
+
+    Returns:
+        list: ``{"protocol", "block_number", "year", "month"}`` dicts, empty when there is nothing new to fetch.
+    """
+    block_window = []
     for protocol in param_dict.keys():
-        earliest_block_to_consider = get_start_block_to_fetch_new_data("the_graph_historical_account_positions")
+        earliest_block_to_consider = start_block
+        if earliest_block_to_consider is None:
+            earliest_block_to_consider = get_start_block_to_fetch_new_data("the_graph_historical_account_positions")
         earliest_block_to_consider = (
             param_dict[protocol]["earliest_block"]
             if pd.isna(earliest_block_to_consider)
@@ -133,60 +223,119 @@ async def fetch_data(api_key: str):
             blocks_list = blocks_list[1:]
         if len(blocks_list) == 0:
             return []
-        param_dict[protocol]["block_list"] = blocks_list
-
-    sem = asyncio.Semaphore(10)
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for protocol in param_dict.keys():
-            url = param_dict.get(protocol).get("url")
-            block_list = (
-                param_dict.get(protocol)
-                .get("block_list")["first_eth_block_of_the_day"]
-                .apply(lambda x: int(x))
-                .to_list()
+        # Reducing size of the list in order to process a smaller window of data
+        for _, block in blocks_list.iloc[0 : settings.ACCOUNT_POSITIONS_BLOCK_WINDOW_SIZE].iterrows():
+            block_window.append(
+                {
+                    "protocol": protocol,
+                    "block_number": int(block["first_eth_block_of_the_day"]),
+                    "year": block["year"],
+                    "month": block["month"],
+                }
             )
-            # Reducing size of the list in order to process a smaller window of data
-            block_list = block_list[0 : settings.ACCOUNT_POSITIONS_BLOCK_WINDOW_SIZE]
-            for _, block_number in enumerate(block_list):
-                year_partition = param_dict.get(protocol).get("block_list")["year"].iloc[_]
-                month_partition = param_dict.get(protocol).get("block_list")["month"].iloc[_]
-                tasks.append(
-                    get_data_for_block_range(
-                        session=session,
-                        block_number=block_number,
-                        url=url,
-                        query=query,
-                        protocol=protocol,
-                        sem=sem,
-                        year=year_partition,
-                        month=month_partition,
+    return block_window
+
+
+async def fetch_data(api_key: str, checkpoint: CheckpointManifest) -> int:
+    """Fetches windows of blocks until the table is up to date, writing each block as soon as it is fetched.
+
+    A single event loop and HTTP session serve every window. The next window is planned from the last planned
+    block, so it starts downloading while the writer is still persisting the end of the previous one. The
+    blocks not handled yet and the last planned block are recorded in ``checkpoint``, so a retry after a
+    failure resumes from the first unhandled block.
+
+    Args:
+        api_key (str): Subgraph gateway API key.
+        checkpoint (CheckpointManifest): Checkpoint of the planned blocks.
+
+    Returns:
+        int: Number of blocks fetched.
+    """
+    param_dict = get_subgraph_params(api_key)
+    state = checkpoint.load() or {"blocks": [], "planned_until": None}
+    fetched_blocks = 0
+
+    def on_persisted(block: dict) -> None:
+        state["blocks"].remove(block)
+        checkpoint.save(state)
+
+    async with AsyncHttpClient() as http_client:
+        async with BlockPipeline(http_client, param_dict, on_persisted) as pipeline:
+            pending_blocks = list(state["blocks"])
+            while True:
+                if len(pending_blocks) == 0:
+                    pending_blocks = await asyncio.to_thread(
+                        plan_block_window, param_dict, start_block=state["planned_until"]
+                    )
+                    if len(pending_blocks) == 0:
+                        break
+                    state["blocks"].extend(pending_blocks)
+                    state["planned_until"] = max(block["block_number"] for block in pending_blocks)
+                    checkpoint.save(state)
+                dead_lettered_blocks = await pipeline.fetch(pending_blocks)
+                for block in dead_lettered_blocks:
+                    state["blocks"].remove(block)
+                if len(dead_lettered_blocks) > 0:
+                    checkpoint.save(state)
+                    logger.warning(
+                        f"{len(dead_lettered_blocks)} blocks were dead-lettered, replay with --replay_dead_letters"
                     )
-                )
-        print(f"There are {len(tasks)} tasks to run during this iteration")
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        await session.close()
-        return results
+                fetched_blocks += len(pending_blocks) - len(dead_lettered_blocks)
+                pending_blocks = []
+        http_client.log_stats()
+
+    checkpoint.clear()
+    return fetched_blocks
+
+
+async def replay_dead_letters(api_key: str) -> None:
+    """Fetches again the dead-lettered blocks and moves the ones written successfully to the replayed blocks.
+
+    The stage watermark is already past the replayed blocks, so they are recorded for ``--replay_dead_letters``
+    of the stage layer.
+    """
+    dead_letters = DeadLetterStore(job_name=JOB_NAME)
+    blocks = dead_letters.items()
+    if len(blocks) == 0:
+        logger.info("No dead-lettered blocks to replay.")
+        return
+    replayed_blocks = []
+    async with AsyncHttpClient() as http_client:
+        async with BlockPipeline(http_client, get_subgraph_params(api_key), replayed_blocks.append) as pipeline:
+            await pipeline.fetch(blocks)
+        http_client.log_stats()
+    ReplayedBlockStore("db_raw_prod.the_graph_historical_account_positions").add(replayed_blocks)
+    dead_letters.remove(replayed_blocks)
+    logger.info(f"Replayed {len(replayed_blocks)} of {len(blocks)} dead-lettered blocks")
 
 
 def update_table(api_key: str):
     start = time.time()
 
-    while True:
-        incoming_data = asyncio.run(fetch_data(api_key))
-        if len(incoming_data) < 1:
-            logger.info("No new data to ingest. Exiting.")
-            break
-        incoming_data = pd.concat(incoming_data)
-        logger.info(f"Incoming data size: {incoming_data.shape}")
-        insert_incoming_data_into_data_lake(incoming_data)
-        del incoming_data
-        gc.collect()
+    checkpoint = CheckpointManifest(job_name=JOB_NAME)
+    fetched_blocks = asyncio.run(fetch_data(api_key, checkpoint))
+    if fetched_blocks < 1:
+        logger.info("No new data to ingest. Exiting.")
 
     end = time.time()
     logger.info(f"Elapsed time: {end - start}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="Fetch the blocks that exhausted their attempts in previous runs instead of new blocks",
+    )
+    args = parser.parse_args()
+
     secrets = get_secret("prod/api/keys")
-    update_table(secrets["SUBGRAPH_API_KEY"])
+    # Warms the subgraph response cache from S3 before any request is sent
+    response_cache = get_response_cache()
+    if args.replay_dead_letters:
+        asyncio.run(replay_dead_letters(secrets["SUBGRAPH_API_KEY"]))
+    else:
+        update_table(secrets["SUBGRAPH_API_KEY"])
+    if response_cache is not None:
+        response_cache.log_stats()
@@ -1,43 +1,53 @@
+import argparse
+import asyncio
 import time
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import requests
 
 
+from config import settings
 from spectral_data_lib.log_manager import Logger
 from spectral_data_lib.helpers.get_secrets import get_secret
 from spectral_data_lib.data_lakehouse import DataLakehouse
 
 
+from src.pipelines.http_client import AsyncHttpClient
+from src.pipelines.partitions import add_partitions_from_blocks
+from src.pipelines.response_cache import get_response_cache
+from src.pipelines.subgraph import MultiBlockBatcher
 from src.pipelines.utils import fetch_daily_first_block_numbers_and_partitions, get_start_block_to_fetch_new_data
+from src.pipelines.watermarks import get_watermark_store
+from src.pipelines.work_queue import AsyncWorkQueue, DeadLetterStore, ReplayedBlockStore
 
 data_lakehouse = DataLakehouse()
 logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
 
+JOB_NAME = "raw_the_graph_historical_market_data"
 
-def get_data_for_block_range(block_number, url, query, protocol):
-    # For some reason we occasionally get errors on certain blocks when fetching so this retry mechanism will query a nearby block
-    # a few times before giving up
+
+async def get_data_for_block_range(batcher, block_number, protocol) -> pd.DataFrame:
+    """Fetches the markets of a protocol at a given block number.
+
+    The request is sent together with the other blocks waiting on ``batcher``, as one aliased multi-block
+    query. Failures are raised to the work queue, which retries the block later and dead-letters it after
+    ``WORK_QUEUE_MAX_ATTEMPTS`` attempts instead of silently leaving it out of the snapshot.
+
+    Args:
+        batcher (MultiBlockBatcher): Batcher of the protocol's subgraph.
+        block_number (int): The block number to fetch data for.
+        protocol (str): The protocol to fetch data for.
+
+    Returns:
+        pd.DataFrame: The markets at the block.
+    """
     logger.info(f"attempting to get response for block {block_number} on protocol {protocol}")
-    for i in range(0, 5):
-        query_variables = {"block_number": block_number}
-        if i > 0:
-            logger.info(f"attempting to get response for block {block_number} on protocol {protocol} try {i}")
-        try:
-            response = requests.post(url=url, json={"query": query, "variables": query_variables})
-            subgraph_response_dict = response.json()
-            dataframe_chunk = pd.DataFrame.from_dict(subgraph_response_dict.get("data").get("first_results"))
-            dataframe_chunk["block_number"] = block_number
-            dataframe_chunk["protocol"] = protocol
-            time.sleep(0.25)
-            return dataframe_chunk
-        except Exception as e:
-            logger.error(f"Failed to get response for block {block_number}")
+    dataframe_chunk = pd.DataFrame.from_dict(await batcher.fetch(block_number))
+    dataframe_chunk["block_number"] = block_number
+    dataframe_chunk["protocol"] = protocol
+    return dataframe_chunk
 
 
-def fetch_data(api_key: str):
-    param_dict = {
+def get_subgraph_params(api_key: str) -> dict:
+    return {
         "compound-v2-eth": {
             "url": f"https://gateway.thegraph.com/api/{api_key}/subgraphs/id/6tGbL7WBx287EZwGUvvcQdL6m67JGMJrma3JSTtt5SV7",
             "earliest_block": 7774386,
@@ -47,10 +57,21 @@ def fetch_data(api_key: str):
             "earliest_block": 11363052,
         },  # default value for protocol
     }
-    query = open("src/pipelines/raw/queries/historical_market_state.graphql").read()
 
-    general_blocks_list = []
-    total_subgraph_dataframe_list = []
+
+def plan_blocks(param_dict: dict) -> list:
+    """Returns the blocks to fetch for every protocol with the partition their snapshot belongs to.
+
+    The first block of the list is skipped because its data was already ingested by the previous run; the
+    snapshot taken at the first block of a day is stored in the partition of the day before it.
+
+    Args:
+        param_dict (dict): Subgraph url and earliest block of each protocol.
+
+    Returns:
+        list: ``{"protocol", "block_number", "year", "month"}`` dicts, empty when there is nothing new to fetch.
+    """
+    blocks = []
     for protocol in param_dict.keys():
         earliest_block_to_consider = get_start_block_to_fetch_new_data("the_graph_historical_market_data")
         earliest_block_to_consider = (
@@ -66,35 +87,84 @@ def fetch_data(api_key: str):
             blocks_list = blocks_list[1:]
         if len(blocks_list) == 0:
             return []
-        general_blocks_list.append(blocks_list)
-        unique_block_numbers = blocks_list["first_eth_block_of_the_day"].unique()
-
         logger.info(f"Found {len(blocks_list)} blocks to query for {protocol}")
-        url = param_dict[protocol]["url"]
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(get_data_for_block_range, block_number, url, query, protocol)
-                for block_number in blocks_list["first_eth_block_of_the_day"].apply(lambda x: int(x)).to_list()
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                total_subgraph_dataframe_list.append(future.result())
-
-    total_subgraph_dataframe = pd.concat(total_subgraph_dataframe_list)
-
-    total_subgraph_dataframe = total_subgraph_dataframe[
-        total_subgraph_dataframe["block_number"] != unique_block_numbers[0]
-    ]
-    unique_block_numbers = total_subgraph_dataframe["block_number"].unique()
-    general_blocks_list = pd.concat(general_blocks_list, ignore_index=True)
-    for i in range(
-        0, len(unique_block_numbers)
-    ):  # skiping first day because we already have the first next block day's data
-        total_subgraph_dataframe.loc[
-            total_subgraph_dataframe["block_number"] == unique_block_numbers[i], "year"
-        ] = f"20{general_blocks_list['year'][i]}"
-        total_subgraph_dataframe.loc[
-            total_subgraph_dataframe["block_number"] == unique_block_numbers[i], "month"
-        ] = general_blocks_list["month"][i]
+        blocks_list = blocks_list.reset_index(drop=True)
+        for i in range(1, len(blocks_list)):
+            blocks.append(
+                {
+                    "protocol": protocol,
+                    "block_number": int(blocks_list["first_eth_block_of_the_day"][i]),
+                    "year": blocks_list["year"][i - 1],
+                    "month": blocks_list["month"][i - 1],
+                }
+            )
+    return blocks
+
+
+async def fetch_blocks(api_key: str, blocks: list) -> tuple:
+    """Fetches ``blocks`` through a retrying work queue.
+
+    Args:
+        api_key (str): Subgraph gateway API key.
+        blocks (list): ``{"protocol", "block_number", "year", "month"}`` dicts.
+
+    Returns:
+        tuple: The fetched data and the list of blocks that were fetched successfully.
+    """
+    param_dict = get_subgraph_params(api_key)
+    query = open("src/pipelines/raw/queries/historical_market_state.graphql").read()
+
+    total_subgraph_dataframe_list = []
+    fetched_blocks = []
+    async with AsyncHttpClient() as http_client:
+        batchers = {
+            protocol: MultiBlockBatcher(http_client, url=params["url"], query=query, field="first_results")
+            for protocol, params in param_dict.items()
+        }
+
+        async def fetch_block(block: dict) -> pd.DataFrame:
+            return await get_data_for_block_range(
+                batcher=batchers[block["protocol"]],
+                block_number=block["block_number"],
+                protocol=block["protocol"],
+            )
+
+        # The workers are the blocks waiting for a response, sent in batches; the HTTP client's AIMD controller
+        # decides how many batches are in flight at once
+        work_queue = AsyncWorkQueue(
+            handler=fetch_block,
+            workers=settings.MARKET_DATA_BLOCKS_IN_FLIGHT,
+            dead_letters=DeadLetterStore(job_name=JOB_NAME),
+        )
+        try:
+            async for block, block_dataframe in work_queue.run(blocks):
+                total_subgraph_dataframe_list.append(block_dataframe)
+                fetched_blocks.append(block)
+        finally:
+            await asyncio.gather(*(batcher.close() for batcher in batchers.values()))
+        http_client.log_stats()
+        for batcher in batchers.values():
+            batcher.log_stats()
+
+    if len(work_queue.dead_lettered) > 0:
+        logger.warning(f"{len(work_queue.dead_lettered)} blocks were dead-lettered, replay with --replay_dead_letters")
+    if len(total_subgraph_dataframe_list) == 0:
+        return [], fetched_blocks
+    block_partitions = pd.DataFrame(fetched_blocks)
+    block_partitions["year"] = "20" + block_partitions["year"].astype(str)
+    total_subgraph_dataframe = add_partitions_from_blocks(
+        pd.concat(total_subgraph_dataframe_list, ignore_index=True),
+        block_partitions,
+        on=["protocol", "block_number"],
+    )
+    return total_subgraph_dataframe, fetched_blocks
+
+
+def fetch_data(api_key: str):
+    blocks = plan_blocks(get_subgraph_params(api_key))
+    if len(blocks) == 0:
+        return []
+    total_subgraph_dataframe, _ = asyncio.run(fetch_blocks(api_key, blocks))
     return total_subgraph_dataframe
 
 
@@ -107,6 +177,9 @@ def insert_incoming_data_into_data_lake(data: pd.DataFrame):
         layer="raw",
         partition_columns=["year", "month"],
     )
+    get_watermark_store().advance(
+        "db_raw_prod.the_graph_historical_market_data", data.groupby("protocol")["block_number"].max().to_dict()
+    )
 
 
 def update_table(api_key: str):
@@ -123,6 +196,40 @@ def update_table(api_key: str):
     logger.info(f"Elapsed time: {end - start}")
 
 
+def replay_dead_letters(api_key: str) -> None:
+    """Fetches again the dead-lettered blocks and moves the ones written successfully to the replayed blocks.
+
+    The stage watermark is already past the replayed blocks, so they are recorded for ``--replay_dead_letters``
+    of the stage layer.
+    """
+    dead_letters = DeadLetterStore(job_name=JOB_NAME)
+    blocks = dead_letters.items()
+    if len(blocks) == 0:
+        logger.info("No dead-lettered blocks to replay.")
+        return
+    incoming_data, fetched_blocks = asyncio.run(fetch_blocks(api_key, blocks))
+    if len(incoming_data) > 0:
+        insert_incoming_data_into_data_lake(incoming_data)
+    ReplayedBlockStore("db_raw_prod.the_graph_historical_market_data").add(fetched_blocks)
+    dead_letters.remove(fetched_blocks)
+    logger.info(f"Replayed {len(fetched_blocks)} of {len(blocks)} dead-lettered blocks")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="Fetch the blocks that exhausted their attempts in previous runs instead of new blocks",
+    )
+    args = parser.parse_args()
+
     secrets = get_secret("prod/api/keys")
-    update_table(secrets["SUBGRAPH_API_KEY"])
+    # Warms the subgraph response cache from S3 before any request is sent
+    response_cache = get_response_cache()
+    if args.replay_dead_letters:
+        replay_dead_letters(secrets["SUBGRAPH_API_KEY"])
+    else:
+        update_table(secrets["SUBGRAPH_API_KEY"])
+    if response_cache is not None:
+        response_cache.log_stats()
@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.storage import list_sizes, read_bytes, write_bytes
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+_response_cache = None
+
+
+def subgraph_id(url: str) -> str:
+    """Returns the id of the subgraph queried by ``url``, so the gateway API key is never part of a cache key."""
+    if "/subgraphs/id/" in url:
+        return url.split("/subgraphs/id/")[-1].strip("/")
+    return url
+
+
+def response_key(url: str, query: str, variables: dict) -> str:
+    """Content address of a subgraph response: hash of the subgraph id, the query hash and the variables."""
+    query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
+    key_document = json.dumps(
+        {"subgraph": subgraph_id(url), "query": query_hash, "variables": variables}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(key_document.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(object):
+    """On-disk cache of subgraph responses to queries pinned to a block, which never change.
+
+    Responses are stored as gzip compressed JSON files named after their content address. The local directory
+    is bounded to ``max_bytes`` by evicting the least recently used files. When ``s3_prefix`` is set every
+    new response is also copied there, and :meth:`warm` downloads that prefix on container start so replays
+    and backfills are served without calling the gateway.
+
+    Args:
+        directory (str): Local directory holding the cached responses.
+        max_bytes (int): Maximum size of the local directory.
+        s3_prefix (str): Optional ``s3://`` prefix shared by every container.
+    """
+
+    def __init__(
+        self,
+        directory: str = settings.RESPONSE_CACHE_DIRECTORY,
+        max_bytes: int = settings.RESPONSE_CACHE_MAX_BYTES,
+        s3_prefix: str = settings.RESPONSE_CACHE_S3_PREFIX,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.s3_prefix = s3_prefix.rstrip("/") if s3_prefix else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # key -> size in bytes, least recently used first, rebuilt from the files left by previous runs
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        cached_files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".json.gz"):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                cached_files.append((stat.st_mtime, file_name[: -len(".json.gz")], stat.st_size))
+        for _, key, size in sorted(cached_files):
+            self.index[key] = size
+            self.total_bytes += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+    def get(self, key: str) -> dict:
+        """Returns the cached response of ``key`` from the local directory or the S3 prefix, or None."""
+        content = read_bytes(self.path(key))
+        if content is not None:
+            # The modification time keeps the recency order across runs
+            os.utime(self.path(key))
+            with self.lock:
+                self.hits += 1
+                if key in self.index:
+                    self.index.move_to_end(key)
+            return json.loads(gzip.decompress(content))
+        if self.s3_prefix:
+            content = read_bytes(f"{self.s3_prefix}/{key}.json.gz")
+        with self.lock:
+            if content is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        write_bytes(self.path(key), content)
+        self.add_to_index(key, len(content))
+        return json.loads(gzip.decompress(content))
+
+    def put(self, key: str, response: dict) -> None:
+        """Stores ``response`` under ``key``, evicting the least recently used responses beyond ``max_bytes``."""
+        content = gzip.compress(json.dumps(response).encode("utf-8"))
+        write_bytes(self.path(key), content)
+        if self.s3_prefix:
+            write_bytes(f"{self.s3_prefix}/{key}.json.gz", content)
+        self.add_to_index(key, len(content))
+
+    def add_to_index(self, key: str, size: int) -> None:
+        with self.lock:
+            self.total_bytes += size - self.index.pop(key, 0)
+            self.index[key] = size
+            while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                evicted_key, evicted_size = self.index.popitem(last=False)
+                self.total_bytes -= evicted_size
+                try:
+                    os.remove(self.path(evicted_key))
+                except FileNotFoundError:
+                    pass
+
+    def warm(self, workers: int = settings.RESPONSE_CACHE_WARM_WORKERS) -> int:
+        """Downloads the responses of ``s3_prefix`` missing locally, up to ``max_bytes``, with ``workers`` threads.
+
+        Returns:
+            int: Number of responses downloaded.
+        """
+        if not self.s3_prefix:
+            return 0
+        missing_paths = []
+        budget_bytes = self.max_bytes - self.total_bytes
+        for s3_path, size in list_sizes(self.s3_prefix).items():
+            key = s3_path.split("/")[-1][: -len(".json.gz")]
+            if not s3_path.endswith(".json.gz") or key in self.index:
+                continue
+            if size > budget_bytes:
+                break
+            budget_bytes -= size
+            missing_paths.append((s3_path, key))
+
+        def download(s3_path: str, key: str) -> None:
+            content = read_bytes(s3_path)
+            write_bytes(self.path(key), content)
+            self.add_to_index(key, len(content))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda path_and_key: download(*path_and_key), missing_paths))
+        logger.info(f"Warmed the response cache with {len(missing_paths)} responses from {self.s3_prefix}")
+        return len(missing_paths)
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Response cache: {self.hits} hits, {self.misses} misses, "
+            f"{len(self.index)} responses, {self.total_bytes} bytes on disk"
+        )
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the response cache shared by the process, or None when ``RESPONSE_CACHE_ENABLED`` is false."""
+    global _response_cache
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+        if settings.RESPONSE_CACHE_WARM_ON_START:
+            _response_cache.warm()
+    return _response_cache
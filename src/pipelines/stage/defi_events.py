@@ -1,11 +1,21 @@
 from argparse import ArgumentParser, Namespace
 import time
-import awswrangler as wr
 
 from spectral_data_lib.log_manager import Logger
 
 from config import settings
-from src.pipelines.stage.transformations.stage_tranformation_queries import general_query, liquidation_query
+from src.pipelines.engines import ENGINES, get_engine, set_default_engine
+from src.pipelines.partition_planner import TRANSPOSE, partition_predicate, plan_timestamp_partitions
+from src.pipelines.stage.transformations.stage_tranformation_queries import (
+    event_keys,
+    general_columns,
+    general_query,
+    keyed_merge_query,
+    liquidation_columns,
+    liquidation_query,
+)
+from src.pipelines.utils import get_latest_timestamp_in_data_lake_table_for_event
+from src.pipelines.watermarks import ALL, event_table, get_or_rebuild_watermark, get_watermark_store
 
 
 logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
@@ -23,13 +33,38 @@ def update_event_table(event_name: str) -> None:
     """
     start = time.time()
 
+    # Both bounds are literals read from the watermark store instead of MAX() subqueries over the tables
+    stage_watermark = get_or_rebuild_watermark(event_table(event_name, "stage")) or 0
+    raw_watermark = get_latest_timestamp_in_data_lake_table_for_event(event_name, "raw")
+    if raw_watermark <= stage_watermark:
+        logger.info(f"No new {event_name} events to move to the stage layer.")
+        return
+
     if event_name != "liquidation":
-        query = general_query
+        query, columns = general_query, general_columns
     else:
-        query = liquidation_query
-    query = query.format(event_name)
+        query, columns = liquidation_query, liquidation_columns
+    # Only the year/month partitions that can hold events newer than the stage watermark are scanned
+    partitions = plan_timestamp_partitions(stage_watermark, raw_watermark)
+    incoming_query = query.format(
+        event_name=event_name,
+        stage_watermark=stage_watermark,
+        raw_watermark=raw_watermark,
+        partition_predicate=partition_predicate(partitions, TRANSPOSE, alias="raw"),
+    )
+    # Events of an overlapping re-ingest or of a retried run are already in the stage table and are skipped
+    query = keyed_merge_query(
+        target_table=event_table(event_name, "stage"),
+        incoming_query=incoming_query,
+        columns=columns,
+        keys=event_keys,
+        existing_filter=f"""epoch_timestamp > {stage_watermark}
+    AND epoch_timestamp <= {raw_watermark}
+    AND {partition_predicate(partitions, TRANSPOSE)}""",
+    )
 
-    wr.athena.start_query_execution(sql=query, database="db_stage_prod", wait=True, athena_query_wait_polling_delay=1)
+    get_engine().execute(query, database="db_stage_prod")
+    get_watermark_store().advance(event_table(event_name, "stage"), {ALL: raw_watermark})
 
     end = time.time()
     logger.info(f"Completed successfully. Elapsed time: {end - start}")
@@ -46,10 +81,18 @@ def get_args() -> Namespace:
         choices=event_names,
         help="Event Name",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default=settings.SQL_ENGINE,
+        choices=ENGINES,
+        help="Engine running the SQL transformation",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
+    set_default_engine(args.engine)
 
     update_event_table(args.event_name)
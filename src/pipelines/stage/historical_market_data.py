@@ -1,19 +1,29 @@
 import time
-import awswrangler as wr
+from argparse import ArgumentParser, Namespace
 
 from spectral_data_lib.log_manager import Logger
 
+from src.pipelines.engines import get_engine
+from src.pipelines.partition_planner import THE_GRAPH, block_list_predicate, partition_predicate, plan_block_partitions
+from src.pipelines.stage.transformations.stage_tranformation_queries import keyed_merge_query
+from src.pipelines.utils import get_start_block_to_fetch_new_data
+from src.pipelines.watermarks import get_or_rebuild_watermark, get_watermark_store
+from src.pipelines.work_queue import ReplayedBlockStore
+
 
 logger = Logger(logger_name="analytics_data_ingestion_pipeline")
 
+TABLE_NAME = "the_graph_historical_market_data"
 
-def update_stage():
-    """Updates stage layer table with new data."""
-    table_name = "the_graph_historical_market_data"
-    update_query = f"""
-        INSERT INTO db_stage_prod.{table_name}
+
+def merge_blocks(blocks_predicate: str) -> None:
+    """Merges the raw rows matching ``blocks_predicate`` into the stage table.
+
+    Args:
+        blocks_predicate (str): SQL predicate on ``block_number`` and the partitions, applied to both tables.
+    """
+    incoming_query = f"""
         SELECT
-            distinct
             cast(liquidationthreshold as double) AS liquidation_threshold,
             name,
             cast(inputtokenpriceusd as Double) AS input_token_price_usd,
@@ -24,22 +34,88 @@ def update_stage():
             timestamp AS block_timestamp,
             year,
             month
-        FROM db_raw_prod.{table_name}
-        where block_number > (select COALESCE(max(block_number), 0) from db_stage_prod.{table_name})
+        FROM db_raw_prod.{TABLE_NAME}
+        where {blocks_predicate}
     """
-    wr.athena.start_query_execution(
-        sql=update_query, database="db_stage_prod", wait=True, athena_query_wait_polling_delay=1
+    # Rows of an overlapping re-ingest or of a retried run are already in the stage table and are skipped
+    update_query = keyed_merge_query(
+        target_table=f"db_stage_prod.{TABLE_NAME}",
+        incoming_query=incoming_query,
+        columns=[
+            "liquidation_threshold",
+            "name",
+            "input_token_price_usd",
+            "id",
+            "decimals",
+            "protocol",
+            "block_number",
+            "block_timestamp",
+            "year",
+            "month",
+        ],
+        keys=["block_number", "id"],
+        existing_filter=blocks_predicate,
     )
+    get_engine().execute(update_query, database="db_stage_prod")
+
 
+def update_stage():
+    """Updates stage layer table with new data."""
+    # Both bounds are literals read from the watermark store instead of MAX() subqueries over the tables
+    stage_watermark = get_or_rebuild_watermark(f"db_stage_prod.{TABLE_NAME}") or 0
+    raw_watermark = get_start_block_to_fetch_new_data(TABLE_NAME)
+    raw_watermarks = get_watermark_store().load(f"db_raw_prod.{TABLE_NAME}")
+    if raw_watermark is None or raw_watermark <= stage_watermark:
+        logger.info(f"No new rows to move to db_stage_prod.{TABLE_NAME}.")
+        return
+    partitions = plan_block_partitions(stage_watermark, raw_watermark)
+    merge_blocks(
+        f"""block_number > {stage_watermark}
+    AND block_number <= {raw_watermark}
+    AND {partition_predicate(partitions, THE_GRAPH)}"""
+    )
+    get_watermark_store().advance(f"db_stage_prod.{TABLE_NAME}", raw_watermarks["watermarks"])
 
-def update_table():
+
+def replay_blocks() -> None:
+    """Merges the dead-lettered blocks replayed into the raw table, which are below the stage watermark.
+
+    The merged blocks are handed to the analytics layer through its replayed blocks.
+    """
+    raw_replayed_blocks = ReplayedBlockStore(f"db_raw_prod.{TABLE_NAME}")
+    blocks = raw_replayed_blocks.blocks()
+    if len(blocks) == 0:
+        logger.info(f"No replayed blocks to move to db_stage_prod.{TABLE_NAME}.")
+        return
+    merge_blocks(block_list_predicate(blocks))
+    ReplayedBlockStore(f"db_stage_prod.{TABLE_NAME}").add(blocks)
+    raw_replayed_blocks.remove(blocks)
+    logger.info(f"Moved {len(blocks)} replayed blocks to db_stage_prod.{TABLE_NAME}.")
+
+
+def update_table(replay_dead_letters: bool = False):
     start = time.time()
 
-    update_stage()
+    if replay_dead_letters:
+        replay_blocks()
+    else:
+        update_stage()
 
     end = time.time()
     logger.info(f"Completed successfully. Elapsed time: {end - start}")
 
 
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="Moves the historical market data from the raw to the stage layer.")
+
+    parser.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="Merge the dead-lettered blocks replayed into the raw table instead of the new blocks",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    update_table()
+    args = get_args()
+    update_table(args.replay_dead_letters)
@@ -1,5 +1,4 @@
 general_query = """
-INSERT INTO db_stage_prod.transpose_{0}_events
 SELECT
     block_number,
     log_index,
@@ -16,13 +15,14 @@ SELECT
     LOWER(sender_address) AS sender_address,
     year,
     month
-FROM db_raw_prod.transpose_{0}_events raw
-WHERE to_unixtime(raw.timestamp) > (select max(to_unixtime(timestamp)) from db_stage_prod.transpose_{0}_events)
+FROM db_raw_prod.transpose_{event_name}_events raw
+WHERE to_unixtime(raw.timestamp) > {stage_watermark}
+AND to_unixtime(raw.timestamp) <= {raw_watermark}
+AND {partition_predicate}
 """
 
 
 liquidation_query = """
-INSERT INTO db_stage_prod.transpose_{0}_events
 SELECT
     block_number,
     log_index,
@@ -42,6 +42,92 @@ SELECT
     LOWER(sender_address) AS sender_address,
     year,
     month
-FROM db_raw_prod.transpose_{0}_events raw
-WHERE to_unixtime(raw.timestamp) > (select max(to_unixtime(timestamp)) from db_stage_prod.transpose_{0}_events)
+FROM db_raw_prod.transpose_{event_name}_events raw
+WHERE to_unixtime(raw.timestamp) > {stage_watermark}
+AND to_unixtime(raw.timestamp) <= {raw_watermark}
+AND {partition_predicate}
+"""
+
+general_columns = [
+    "block_number",
+    "log_index",
+    "transaction_hash",
+    "timestamp",
+    "epoch_timestamp",
+    "protocol_name",
+    "contract_version",
+    "market_address",
+    "token_address",
+    "category",
+    "account_address",
+    "quantity",
+    "sender_address",
+    "year",
+    "month",
+]
+
+liquidation_columns = [
+    "block_number",
+    "log_index",
+    "transaction_hash",
+    "timestamp",
+    "epoch_timestamp",
+    "protocol_name",
+    "contract_version",
+    "market_address",
+    "token_address",
+    "liquidated_token_address",
+    "category",
+    "account_address",
+    "liquidator_address",
+    "quantity",
+    "quantity_liquidated",
+    "sender_address",
+    "year",
+    "month",
+]
+
+event_keys = ["block_number", "log_index", "transaction_hash"]
+
+
+def keyed_merge_query(target_table: str, incoming_query: str, columns: list, keys: list, existing_filter: str) -> str:
+    """Returns the ``INSERT`` writing the rows of ``incoming_query`` whose key is not in ``target_table`` yet.
+
+    The incoming rows keep one row per key, and the keys already in the target are found with an anti-join
+    restricted to ``existing_filter`` (the watermark range and partitions of the batch), so re-running or
+    overlapping a batch never writes a key twice and no ``DISTINCT`` over the whole rows is needed.
+
+    Args:
+        target_table (str): ``database.table`` to insert into.
+        incoming_query (str): ``SELECT`` of the new rows, returning ``columns``.
+        columns (list): Columns of the target table, in order.
+        keys (list): Columns identifying a row.
+        existing_filter (str): Predicate on the target table selecting where the incoming keys can already be.
+
+    Returns:
+        str: The ``INSERT INTO ... SELECT`` query.
+    """
+    key_columns = ", ".join(keys)
+    incoming_columns = ",\n    ".join(f"incoming.{column}" for column in columns)
+    join_condition = " AND ".join(f"existing.{key} = incoming.{key}" for key in keys)
+    return f"""
+INSERT INTO {target_table}
+WITH incoming AS (
+    SELECT
+        batch.*,
+        ROW_NUMBER() OVER (PARTITION BY {key_columns} ORDER BY {key_columns}) AS key_rank
+    FROM ({incoming_query}) AS batch
+),
+existing AS (
+    SELECT {key_columns}
+    FROM {target_table}
+    WHERE {existing_filter}
+)
+SELECT
+    {incoming_columns}
+FROM incoming
+LEFT JOIN existing
+    ON {join_condition}
+WHERE incoming.key_rank = 1
+AND existing.{keys[0]} IS NULL
 """
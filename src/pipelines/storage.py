@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from config import settings
+
+
+_s3_client = None
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client("s3", region_name=settings.REGION)
+    return _s3_client
+
+
+def is_s3_path(path: str) -> bool:
+    return path.startswith("s3://")
+
+
+def split_s3_path(path: str) -> tuple:
+    """Returns the ``(bucket, key)`` of an ``s3://bucket/key`` path."""
+    parsed_path = urlparse(path)
+    return parsed_path.netloc, parsed_path.path.lstrip("/")
+
+
+def read_bytes(path: str) -> bytes:
+    """Reads a local or S3 file, returning None when it does not exist."""
+    if is_s3_path(path):
+        bucket, key = split_s3_path(path)
+        try:
+            return get_s3_client().get_object(Bucket=bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise e
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def write_bytes(path: str, content: bytes) -> None:
+    """Writes a local or S3 file atomically: readers see either the previous or the new content."""
+    if is_s3_path(path):
+        bucket, key = split_s3_path(path)
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=content)
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(file_descriptor, "wb") as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+def delete(path: str) -> None:
+    """Deletes a local or S3 file if it exists."""
+    if is_s3_path(path):
+        bucket, key = split_s3_path(path)
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def list_paths(prefix: str):
+    """Yields the paths of the local or S3 files under ``prefix``."""
+    if is_s3_path(prefix):
+        bucket, key_prefix = split_s3_path(prefix)
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix.rstrip("/") + "/"):
+            for s3_object in page.get("Contents", []):
+                yield f"s3://{bucket}/{s3_object['Key']}"
+        return
+    for directory, _, file_names in os.walk(prefix):
+        for file_name in file_names:
+            yield os.path.join(directory, file_name)
+
+
+def list_sizes(prefix: str) -> dict:
+    """Returns the size in bytes of every local or S3 file under ``prefix``, by path."""
+    if is_s3_path(prefix):
+        bucket, key_prefix = split_s3_path(prefix)
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        sizes = {}
+        for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix.rstrip("/") + "/"):
+            for s3_object in page.get("Contents", []):
+                sizes[f"s3://{bucket}/{s3_object['Key']}"] = s3_object["Size"]
+        return sizes
+    return {path: os.path.getsize(path) for path in list_paths(prefix)}
+
+
+def data_file_sizes(location: str) -> dict:
+    """Sizes of the data files under ``location``, without the hidden (``_``/``.`` prefixed) ones."""
+    return {
+        path: size for path, size in list_sizes(location).items() if not os.path.basename(path).startswith(("_", "."))
+    }
+
+
+def read_json(path: str) -> dict:
+    """Reads a local or S3 JSON document, returning None when it does not exist."""
+    content = read_bytes(path)
+    if content is None:
+        return None
+    return json.loads(content)
+
+
+def write_json(path: str, data: dict) -> None:
+    """Writes a local or S3 JSON document atomically."""
+    write_bytes(path, json.dumps(data, sort_keys=True, default=str).encode("utf-8"))
@@ -0,0 +1,286 @@
+import asyncio
+import json
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.response_cache import get_response_cache, response_key
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+PAGE_SIZE = settings.SUBGRAPH_PAGE_SIZE
+# Entity ids start with an "0x" prefixed hex address, so "0xg" sorts after every id
+ID_UPPER_BOUND = "0xg"
+ID_HEX_WIDTH = 40
+
+
+class SubgraphError(Exception):
+    """Raised when a subgraph answers with GraphQL errors instead of data."""
+
+
+def get_response_data(subgraph_response_dict: dict) -> dict:
+    """Returns the ``data`` of a subgraph response, raising SubgraphError on GraphQL errors."""
+    if subgraph_response_dict.get("errors") or subgraph_response_dict.get("data") is None:
+        raise SubgraphError(subgraph_response_dict.get("errors"))
+    return subgraph_response_dict["data"]
+
+
+async def post_query(http_client, url: str, query: str, variables: dict) -> dict:
+    """Runs ``query`` on a subgraph and returns the ``data`` of its response.
+
+    Queries pinned to a block (``block_number`` variable) read through the response cache: their result never
+    changes, so a response already downloaded by any run is not requested from the gateway again.
+
+    Args:
+        http_client (AsyncHttpClient): The shared async HTTP client.
+        url (str): The URL of the Subgraph.
+        query (str): The GraphQL query to run.
+        variables (dict): Variables of the query.
+
+    Returns:
+        dict: The ``data`` of the response.
+    """
+    cache = get_response_cache() if "block_number" in variables else None
+    if cache is not None:
+        key = response_key(url, query, variables)
+        cached_response = await asyncio.to_thread(cache.get, key)
+        if cached_response is not None:
+            return get_response_data(cached_response)
+    subgraph_response_dict = await http_client.post_json(url=url, json={"query": query, "variables": variables})
+    data = get_response_data(subgraph_response_dict)
+    if cache is not None:
+        await asyncio.to_thread(cache.put, key, subgraph_response_dict)
+    return data
+
+
+def build_multi_block_query(query: str, field: str, block_numbers: list) -> str:
+    """Rewrites a query whose only field is pinned to ``$block_number`` into one aliased copy per block.
+
+    e.g. ``first_results: markets(block: {number: $block_number}) {...}`` becomes
+    ``b12345: markets(block: {number: 12345}) {...}`` for every block of ``block_numbers``.
+    """
+    selection = query[query.index(f"{field}:") + len(field) + 1 : query.rindex("}")].strip()
+    aliased_fields = [
+        f"b{block_number}: " + selection.replace("$block_number", str(block_number)) for block_number in block_numbers
+    ]
+    return "query multi_block {\n" + "\n".join(aliased_fields) + "\n}"
+
+
+class MultiBlockBatcher(object):
+    """Coalesces concurrent single-block queries of a subgraph into aliased multi-block requests.
+
+    Callers ask for one block at a time; the requests waiting at the same moment are sent together, up to
+    ``batch_size`` blocks per POST. After every response the batch size is tuned so that a response holds
+    about ``target_response_bytes``. Each block is stored in the response cache under the key of its
+    single-block query, so cached blocks are never requested and the cache does not depend on the batching.
+
+    Args:
+        http_client (AsyncHttpClient): The shared async HTTP client.
+        url (str): The URL of the Subgraph.
+        query (str): Single-block query, with its only field pinned to ``$block_number``.
+        field (str): Name of the field (alias) of the query.
+        batch_size (int): Initial number of blocks per request.
+        max_batch_size (int): Maximum number of blocks per request.
+        target_response_bytes (int): Response size the batch size is tuned to.
+        linger_seconds (float): Time a request waits for other blocks before being sent.
+    """
+
+    def __init__(
+        self,
+        http_client,
+        url: str,
+        query: str,
+        field: str,
+        batch_size: int = settings.SUBGRAPH_BLOCKS_PER_REQUEST,
+        max_batch_size: int = settings.SUBGRAPH_MAX_BLOCKS_PER_REQUEST,
+        target_response_bytes: int = settings.SUBGRAPH_TARGET_RESPONSE_BYTES,
+        linger_seconds: float = settings.SUBGRAPH_BATCH_LINGER_SECONDS,
+    ) -> None:
+        self.http_client = http_client
+        self.url = url
+        self.query = query
+        self.field = field
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.target_response_bytes = target_response_bytes
+        self.linger_seconds = linger_seconds
+        self.pending = []
+        self.linger_handle = None
+        # Requests in flight, kept referenced until they finish so that close() can wait for them
+        self.tasks = set()
+        self.requests = 0
+        self.blocks = 0
+
+    async def fetch(self, block_number: int) -> list:
+        """Returns the rows of the query's field at ``block_number``."""
+        cache = get_response_cache()
+        if cache is not None:
+            cached_response = await asyncio.to_thread(cache.get, self.cache_key(block_number))
+            if cached_response is not None:
+                return get_response_data(cached_response)[self.field]
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((block_number, future))
+        if len(self.pending) >= self.batch_size:
+            self.dispatch()
+        elif self.linger_handle is None:
+            self.linger_handle = asyncio.get_running_loop().call_later(self.linger_seconds, self.dispatch)
+        return await future
+
+    def cache_key(self, block_number: int) -> str:
+        return response_key(self.url, self.query, {"block_number": block_number})
+
+    def dispatch(self) -> None:
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        while len(self.pending) > 0:
+            batch, self.pending = self.pending[: self.batch_size], self.pending[self.batch_size :]
+            task = asyncio.ensure_future(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def close(self) -> None:
+        """Cancels the blocks not sent yet and waits for the requests in flight to finish."""
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        for _, future in self.pending:
+            future.cancel()
+        self.pending = []
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def send(self, batch: list) -> None:
+        block_numbers = [block_number for block_number, _ in batch]
+        try:
+            subgraph_response_dict = await self.http_client.post_json(
+                url=self.url, json={"query": build_multi_block_query(self.query, self.field, block_numbers)}
+            )
+            data = get_response_data(subgraph_response_dict)
+            self.requests += 1
+            self.blocks += len(batch)
+            cache = get_response_cache()
+            for block_number, future in batch:
+                rows = data[f"b{block_number}"]
+                if cache is not None:
+                    await asyncio.to_thread(cache.put, self.cache_key(block_number), {"data": {self.field: rows}})
+                if not future.done():
+                    future.set_result(rows)
+            bytes_per_block = max(len(json.dumps(data)) / len(batch), 1)
+            self.batch_size = int(min(self.max_batch_size, max(1, self.target_response_bytes // bytes_per_block)))
+        except asyncio.CancelledError as e:
+            for _, future in batch:
+                future.cancel()
+            raise e
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Multi-block batcher: {self.blocks} blocks in {self.requests} requests, batch size {self.batch_size}"
+        )
+
+
+def id_to_int(entity_id: str) -> int:
+    """Maps an ``0x`` prefixed id to its position in the id space, using the first 40 hex digits."""
+    if entity_id >= ID_UPPER_BOUND:
+        return 16**ID_HEX_WIDTH
+    hex_digits = ""
+    for character in entity_id[2 : 2 + ID_HEX_WIDTH].lower():
+        if character not in "0123456789abcdef":
+            break
+        hex_digits += character
+    return int(hex_digits.ljust(ID_HEX_WIDTH, "0") or "0", 16)
+
+
+def split_id_range(lower_id: str, upper_id: str) -> str:
+    """Returns an id splitting the ``(lower_id, upper_id)`` range in two halves, or None if it is too narrow."""
+    lower, upper = id_to_int(lower_id), id_to_int(upper_id)
+    if upper - lower < 2:
+        return None
+    return "0x" + format((lower + upper) // 2, f"0{ID_HEX_WIDTH}x")
+
+
+def id_ranges(number_of_ranges: int) -> list:
+    """Splits the whole id space into ``number_of_ranges`` contiguous ``(id_gt, id_lt)`` ranges."""
+    step = 16**ID_HEX_WIDTH // number_of_ranges
+    boundaries = ["0x" + format(step * i, f"0{ID_HEX_WIDTH}x") for i in range(1, number_of_ranges)]
+    return list(zip([""] + boundaries, boundaries + [ID_UPPER_BOUND]))
+
+
+async def fetch_keyset_ranges(
+    http_client,
+    url: str,
+    query: str,
+    variables: dict,
+    entity: str,
+    ranges: list,
+    max_in_flight: int,
+    split_after_pages: int,
+) -> list:
+    """Fetches every entity of ``query`` by walking ``id_gt`` keyset pages over several id ranges concurrently.
+
+    ``query`` must accept ``$last_id``, ``$upper_id`` and ``$first`` and filter on ``id_gt``/``id_lt``. Each
+    range is walked page after page from its lower bound; a range that still returns full pages after
+    ``split_after_pages`` pages hands the upper half of what is left to a new walker, so a single very large
+    result set ends up fetched by up to ``max_in_flight`` concurrent requests.
+
+    Args:
+        http_client (AsyncHttpClient): The shared async HTTP client.
+        url (str): The URL of the Subgraph.
+        query (str): The GraphQL query to run.
+        variables (dict): Variables of the query besides the keyset ones (e.g. the block number).
+        entity (str): Name of the entity field in the response data.
+        ranges (list): Initial ``(id_gt, id_lt)`` ranges.
+        max_in_flight (int): Maximum number of concurrent requests.
+        split_after_pages (int): Number of full pages after which a range is split.
+
+    Returns:
+        list: Entities of every range, each range in id order.
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    pending = set()
+    results = []
+
+    async def walk(lower_id: str, upper_id: str) -> list:
+        rows = []
+        last_id = lower_id
+        pages = 0
+        while True:
+            async with semaphore:
+                data = await post_query(
+                    http_client,
+                    url=url,
+                    query=query,
+                    variables={**variables, "last_id": last_id, "upper_id": upper_id, "first": PAGE_SIZE},
+                )
+            page = data[entity]
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return rows
+            last_id = page[-1]["id"]
+            pages += 1
+            if pages % split_after_pages == 0 and len(pending) < max_in_flight:
+                split_id = split_id_range(last_id, upper_id)
+                if split_id is not None and split_id > last_id:
+                    spawn(split_id, upper_id)
+                    upper_id = split_id
+
+    def spawn(lower_id: str, upper_id: str) -> None:
+        pending.add(asyncio.ensure_future(walk(lower_id, upper_id)))
+
+    for lower_id, upper_id in ranges:
+        spawn(lower_id, upper_id)
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            pending.discard(task)
+            try:
+                results.extend(task.result())
+            except Exception as e:
+                for other_task in pending:
+                    other_task.cancel()
+                raise e
+    return results
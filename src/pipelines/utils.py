@@ -1,6 +1,9 @@
 from spectral_data_lib.data_lakehouse import DataLakehouse
 import pandas as pd
 
+from src.pipelines.block_calendar import get_block_calendar
+from src.pipelines.watermarks import event_table, get_or_rebuild_watermark
+
 
 data_lakehouse = DataLakehouse()
 
@@ -9,16 +12,17 @@ def get_latest_timestamp_in_data_lake_table_for_event(event_name: str, layer: st
     """Returns latest timestamp in the Data Lakehouse stage table
     or default start timestamp if table is empty.
 
+    Read from the watermark store; the table is only scanned the first time the store sees it.
+
     Args:
         event_name (str): Event name.
 
     Returns:
         int: Latest index in the Data Lakehouse table.
     """
-    query = f"""SELECT COALESCE(MAX(to_unixtime(timestamp)), 0) as max_timestamp FROM db_{layer}_prod.transpose_{event_name}_events"""
-    event_latest_timestamp = data_lakehouse.read_sql_query(query)
-    if event_latest_timestamp.iloc[0][0] is not None:
-        return int(event_latest_timestamp.iloc[0][0])
+    event_latest_timestamp = get_or_rebuild_watermark(event_table(event_name, layer))
+    if event_latest_timestamp is not None:
+        return int(event_latest_timestamp)
     return 1557187200
 
 
@@ -26,35 +30,31 @@ def fetch_daily_first_block_numbers_and_partitions(latest_block_number: int) ->
     """Fetches the first block number of each day from the Ethereum blockchain
     and year, month and day to which it belongs.
 
+    Answered by the block calendar index instead of a GROUP BY over ``db_raw_prod.ethereum_blocks``.
+
     Args:
         latest_block_number (int): The latest block number in the Ethereum blockchain.
 
     Returns:
         pd.DataFrame: The first block number of each day.
     """
-    query = f"""
-    SELECT
-            date_format(timestamp, '%y') AS year,
-            date_format(timestamp, '%m') AS month,
-            date_format(timestamp, '%d') AS day,
-            MIN(number) AS first_eth_block_of_the_day
-    FROM db_raw_prod.ethereum_blocks
-    WHERE number >= {latest_block_number}
-    GROUP BY 1, 2, 3
-    ORDER BY 1, 2, 3 ASC"""
-
-    latest_existing_block_number = data_lakehouse.read_sql_query(database_name="db_raw_prod", query=query)
-    if len(latest_existing_block_number) > 0:
-        return latest_existing_block_number
+    daily_first_blocks = get_block_calendar().daily_first_blocks(int(latest_block_number))
+    if len(daily_first_blocks) > 0:
+        return daily_first_blocks
     return None
 
 
-def get_start_block_to_fetch_new_data(table_name, db_name="db_raw_prod", block_number_column="block_number") -> int:
-    """Returns the latest block number in the Data Lakehouse table or None if table is empty."""
-    result = data_lakehouse.read_sql_query(
-        database_name="db_raw_prod",
-        query=f"select max({block_number_column}) as latest_block_number from {db_name}.{table_name}",
-    )
-    if len(result) > 0:
-        return result["latest_block_number"][0]
-    return None
+def get_start_block_to_fetch_new_data(table_name, db_name="db_raw_prod", protocol: str = None) -> int:
+    """Returns the latest block number in the Data Lakehouse table or None if table is empty.
+
+    Read from the watermark store; the table is only scanned the first time the store sees it.
+
+    Args:
+        table_name (str): Table name.
+        db_name (str): Database of the table.
+        protocol (str): Only consider the blocks of this protocol. None considers every protocol.
+
+    Returns:
+        int: Latest block number, or None.
+    """
+    return get_or_rebuild_watermark(f"{db_name}.{table_name}", key=protocol)
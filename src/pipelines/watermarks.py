@@ -0,0 +1,199 @@
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from spectral_data_lib.log_manager import Logger
+
+from config import settings
+from src.pipelines.storage import read_json, write_json
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+ALL = "all"
+_watermark_store = None
+
+
+def event_table(event_name: str, layer: str) -> str:
+    return f"db_{layer}_prod.transpose_{event_name}_events"
+
+
+def watermark_queries() -> dict:
+    """Returns the query recomputing the watermarks of every table tracked by the store.
+
+    Each query returns a ``watermark_key`` column (the protocol, or ``all``) and a ``watermark`` column.
+    """
+    queries = {}
+    for event_name in settings.EVENTS_NAMES:
+        for layer in ["raw", "stage", "analytics"]:
+            table_name = event_table(event_name, layer)
+            query = f"""
+                SELECT '{ALL}' AS watermark_key, CAST(MAX(to_unixtime(timestamp)) AS BIGINT) AS watermark
+                FROM {table_name}"""
+            queries[table_name] = query
+    for table_name in [
+        "db_raw_prod.the_graph_historical_account_positions",
+        "db_raw_prod.the_graph_historical_market_data",
+        "db_stage_prod.the_graph_historical_account_positions",
+        "db_stage_prod.the_graph_historical_market_data",
+        "db_analytics_prod.the_graph_historical_market_data_and_account_positions",
+    ]:
+        query = f"""
+            SELECT protocol AS watermark_key, MAX(block_number) AS watermark
+            FROM {table_name}
+            GROUP BY protocol"""
+        queries[table_name] = query
+    return queries
+
+
+class WatermarkStore(object):
+    """Where each Data Lakehouse table stopped: latest timestamp or block number written, per protocol.
+
+    Every table has a small JSON manifest ``{"table", "version", "watermarks": {key: value}, "updated_at"}``
+    under ``WATERMARK_LOCATION``. Writers advance it right after a successful write and readers get the
+    resume point without scanning the table. ``version`` grows on every change, so it also identifies the
+    content of the table (e.g. for caches). Watermarks only move forward, unless rebuilt from the data.
+
+    Args:
+        location (str): Local directory or ``s3://`` prefix holding the manifests.
+    """
+
+    def __init__(self, location: str = settings.WATERMARK_LOCATION) -> None:
+        self.location = location.rstrip("/")
+        self.lock = threading.Lock()
+
+    def path(self, table: str) -> str:
+        return f"{self.location}/{table}.json"
+
+    def load(self, table: str) -> dict:
+        """Returns the manifest of ``table``, or None if it has none yet."""
+        return read_json(self.path(table))
+
+    def get(self, table: str, key: str = None) -> int:
+        """Returns the watermark of ``key`` in ``table``, the highest one of the table when ``key`` is None.
+
+        Returns:
+            int: The watermark, or None if the store does not know the table (or key) yet.
+        """
+        manifest = self.load(table)
+        if manifest is None or len(manifest["watermarks"]) == 0:
+            return None
+        if key is None:
+            return max(manifest["watermarks"].values())
+        return manifest["watermarks"].get(key)
+
+    def version(self, table: str) -> int:
+        manifest = self.load(table)
+        return 0 if manifest is None else manifest["version"]
+
+    def write(self, table: str, watermarks: dict, replace: bool = False) -> dict:
+        with self.lock:
+            manifest = self.load(table) or {"table": table, "version": 0, "watermarks": {}}
+            if replace:
+                new_watermarks = dict(watermarks)
+            else:
+                new_watermarks = dict(manifest["watermarks"])
+                for key, value in watermarks.items():
+                    if value is not None and (key not in new_watermarks or value > new_watermarks[key]):
+                        new_watermarks[key] = value
+            if new_watermarks == manifest["watermarks"] and manifest["version"] > 0:
+                return manifest
+            manifest = {
+                "table": table,
+                "version": manifest["version"] + 1,
+                "watermarks": new_watermarks,
+                "updated_at": int(time.time()),
+            }
+            write_json(self.path(table), manifest)
+            return manifest
+
+    def advance(self, table: str, watermarks: dict) -> dict:
+        """Moves the watermarks of ``table`` forward after a successful write; lower values are ignored.
+
+        Args:
+            table (str): ``database.table`` name.
+            watermarks (dict): New watermark of each key (protocol, or ``all``).
+
+        Returns:
+            dict: The manifest of the table.
+        """
+        return self.write(table, {key: int(value) for key, value in watermarks.items() if value is not None})
+
+    def touch(self, table: str) -> dict:
+        """Bumps the version of ``table`` after a write that does not move a watermark (e.g. a full reload)."""
+        with self.lock:
+            manifest = self.load(table) or {"table": table, "version": 0, "watermarks": {}}
+            manifest = {**manifest, "version": manifest["version"] + 1, "updated_at": int(time.time())}
+            write_json(self.path(table), manifest)
+            return manifest
+
+    def rebuild(self, table: str, query: str) -> dict:
+        """Recomputes the watermarks of ``table`` from its data with ``query``, on the configured SQL engine."""
+        # Imported here as the engines depend on the query cache, which depends on this module
+        from src.pipelines.engines import get_engine
+
+        result = get_engine().read_sql_query(query, database=table.split(".")[0])
+        watermarks = {
+            str(row["watermark_key"]): int(row["watermark"])
+            for _, row in result.iterrows()
+            if row["watermark"] is not None and row["watermark"] == row["watermark"]
+        }
+        manifest = self.write(table, watermarks, replace=True)
+        logger.info(f"Rebuilt watermarks of {table}: {watermarks}")
+        return manifest
+
+
+def get_watermark_store() -> WatermarkStore:
+    global _watermark_store
+    if _watermark_store is None:
+        _watermark_store = WatermarkStore()
+    return _watermark_store
+
+
+def get_or_rebuild_watermark(table: str, key: str = None) -> int:
+    """Returns the watermark of ``table``, computing it from the data the first time the table is seen.
+
+    Args:
+        table (str): ``database.table`` name, one of :func:`watermark_queries`.
+        key (str): Protocol, or None for the highest watermark of the table.
+
+    Returns:
+        int: The watermark, or None if the table is empty.
+    """
+    watermark_store = get_watermark_store()
+    if watermark_store.load(table) is None:
+        watermark_store.rebuild(table, watermark_queries()[table])
+    return watermark_store.get(table, key)
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="Watermark store of the DeFi Features tables.")
+
+    parser.add_argument(
+        "--rebuild_watermarks",
+        action="store_true",
+        help="Recompute the watermarks of every table from its data",
+    )
+    parser.add_argument(
+        "--table",
+        type=str,
+        action="append",
+        help="Only rebuild this database.table (can be repeated)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    watermark_store = get_watermark_store()
+    for table, query in watermark_queries().items():
+        if args.table and table not in args.table:
+            continue
+        if args.rebuild_watermarks:
+            watermark_store.rebuild(table, query)
+        logger.info(f"{table}: {watermark_store.load(table)}")
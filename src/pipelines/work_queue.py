@@ -0,0 +1,177 @@
+import asyncio
+import random
+import threading
+import time
+
+from config import settings
+from spectral_data_lib.log_manager import Logger
+
+from src.pipelines.storage import read_json, write_json
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+
+def retry_delay_seconds(attempt: int) -> float:
+    """Exponential backoff with jitter between two attempts of the same work item."""
+    delay_cap = min(settings.WORK_QUEUE_BACKOFF_MAX_SECONDS, settings.WORK_QUEUE_BACKOFF_BASE_SECONDS * 2**attempt)
+    return random.uniform(delay_cap / 2, delay_cap)
+
+
+class DeadLetterStore(object):
+    """Durable list of the work items that failed ``WORK_QUEUE_MAX_ATTEMPTS`` times.
+
+    Items are JSON documents (e.g. ``{"protocol", "block_number", "year", "month"}``) stored with their last
+    error and number of attempts, so they can be inspected and replayed by a later run.
+
+    Args:
+        job_name (str): Unique name of the job, used as the file name.
+        location (str): Local directory or ``s3://`` prefix holding the dead letters.
+    """
+
+    def __init__(self, job_name: str, location: str = settings.DEAD_LETTER_LOCATION) -> None:
+        self.job_name = job_name
+        self.path = f"{location.rstrip('/')}/{job_name}.json"
+        self.lock = threading.Lock()
+
+    def load(self) -> list:
+        """Returns the dead-lettered entries, each a dict with ``item``, ``attempts``, ``error`` and ``failed_at``."""
+        return read_json(self.path) or []
+
+    def items(self) -> list:
+        return [entry["item"] for entry in self.load()]
+
+    def add(self, item: dict, attempts: int, error: Exception) -> None:
+        """Adds ``item`` to the dead letters, replacing a previous entry of the same item."""
+        with self.lock:
+            entries = [entry for entry in self.load() if entry["item"] != item]
+            entries.append({"item": item, "attempts": attempts, "error": repr(error), "failed_at": int(time.time())})
+            write_json(self.path, entries)
+
+    def remove(self, items: list) -> None:
+        """Removes ``items`` (e.g. replayed successfully) from the dead letters."""
+        with self.lock:
+            entries = self.load()
+            remaining_entries = [entry for entry in entries if entry["item"] not in items]
+            if len(remaining_entries) != len(entries):
+                write_json(self.path, remaining_entries)
+
+
+class ReplayedBlockStore(object):
+    """Durable list of the blocks replayed into a table that the next layer has not merged yet.
+
+    The incremental runs only read the blocks above the watermark of their target table, which already moved
+    past a dead-lettered block by the time it is replayed. Each layer merges the blocks of the store of its
+    source table, records them in its own store for the next layer and removes them from the source's one.
+
+    Args:
+        table_name (str): Table the blocks were replayed into, e.g. ``db_raw_prod.the_graph_historical_market_data``.
+        location (str): Local directory or ``s3://`` prefix holding the stores.
+    """
+
+    def __init__(self, table_name: str, location: str = settings.DEAD_LETTER_LOCATION) -> None:
+        self.table_name = table_name
+        self.path = f"{location.rstrip('/')}/replayed/{table_name}.json"
+        self.lock = threading.Lock()
+
+    def blocks(self) -> list:
+        """Returns the ``{"protocol", "block_number", "year", "month"}`` dicts of the replayed blocks."""
+        return read_json(self.path) or []
+
+    def add(self, blocks: list) -> None:
+        with self.lock:
+            stored_blocks = self.blocks()
+            new_blocks = [block for block in blocks if block not in stored_blocks]
+            if len(new_blocks) > 0:
+                write_json(self.path, stored_blocks + new_blocks)
+
+    def remove(self, blocks: list) -> None:
+        """Removes ``blocks`` once the next layer merged them."""
+        with self.lock:
+            stored_blocks = self.blocks()
+            remaining_blocks = [block for block in stored_blocks if block not in blocks]
+            if len(remaining_blocks) != len(stored_blocks):
+                write_json(self.path, remaining_blocks)
+
+
+class AsyncWorkQueue(object):
+    """Runs an async ``handler`` over work items with a fixed number of workers and retries failures out of band.
+
+    A failed item goes back on the queue after an exponential backoff, so the other items keep flowing while
+    it waits. After ``max_attempts`` failures the item is recorded in the dead letters and the queue moves on.
+
+    Args:
+        handler (callable): Coroutine function receiving an item and returning its result.
+        workers (int): Number of items processed concurrently.
+        dead_letters (DeadLetterStore): Where the items that exhausted their attempts are recorded.
+        max_attempts (int): Number of attempts before an item is dead-lettered.
+        results_buffer (int): Number of results held before the workers wait for the consumer.
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers: int,
+        dead_letters: DeadLetterStore,
+        max_attempts: int = settings.WORK_QUEUE_MAX_ATTEMPTS,
+        results_buffer: int = None,
+    ) -> None:
+        self.handler = handler
+        self.workers = workers
+        self.dead_letters = dead_letters
+        self.max_attempts = max_attempts
+        self.results_buffer = results_buffer or workers
+        self.succeeded = 0
+        self.dead_lettered = []
+
+    async def run(self, items: list):
+        """Processes ``items`` and yields ``(item, result)`` for each one that succeeded, in completion order.
+
+        Args:
+            items (list): Work items.
+
+        Yields:
+            tuple: The item and the result of its handler.
+        """
+        queue = asyncio.Queue()
+        results = asyncio.Queue(maxsize=self.results_buffer)
+        retry_tasks = set()
+        for item in items:
+            queue.put_nowait((item, 1))
+
+        async def requeue(item: dict, attempt: int, delay: float) -> None:
+            await asyncio.sleep(delay)
+            queue.put_nowait((item, attempt))
+
+        async def worker() -> None:
+            while True:
+                item, attempt = await queue.get()
+                try:
+                    result = await self.handler(item)
+                except Exception as e:
+                    if attempt >= self.max_attempts:
+                        logger.error(f"Dead-lettering {item} after {attempt} attempts: {e}")
+                        await asyncio.to_thread(self.dead_letters.add, item, attempt, e)
+                        self.dead_lettered.append(item)
+                        await results.put((item, None, e))
+                        continue
+                    delay = retry_delay_seconds(attempt)
+                    logger.warning(f"Attempt {attempt} of {item} failed, retrying in {delay:.1f}s: {e}")
+                    task = asyncio.ensure_future(requeue(item, attempt + 1, delay))
+                    retry_tasks.add(task)
+                    task.add_done_callback(retry_tasks.discard)
+                    continue
+                await results.put((item, result, None))
+
+        worker_tasks = [asyncio.ensure_future(worker()) for _ in range(min(self.workers, max(len(items), 1)))]
+        try:
+            for _ in range(len(items)):
+                item, result, error = await results.get()
+                if error is None:
+                    self.succeeded += 1
+                    yield item, result
+        finally:
+            for task in worker_tasks + list(retry_tasks):
+                task.cancel()
+            await asyncio.gather(*worker_tasks, *retry_tasks, return_exceptions=True)
+            logger.info(f"Work queue done: {self.succeeded} items succeeded, {len(self.dead_lettered)} dead-lettered")
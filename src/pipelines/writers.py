@@ -0,0 +1,89 @@
+import pandas as pd
+
+from spectral_data_lib.log_manager import Logger
+
+
+logger = Logger(logger_name=__file__.split("/")[-1].split(".")[0])
+
+
+class StreamingParquetWriter(object):
+    """Buffers incoming frames and flushes them as parquet parts once ``flush_rows`` rows are buffered.
+
+    Only the rows of the current buffer are held in memory, so the peak memory of an ingestion job depends
+    on ``flush_rows`` and not on the size of the window being extracted.
+
+    Args:
+        write_function (callable): Function receiving a pd.DataFrame and persisting it (e.g. partitioned by year/month).
+        flush_rows (int): Number of buffered rows that triggers a flush. None only flushes on explicit calls.
+        hold_back_column (str): Optional column; rows sharing the value of the last buffered row are kept
+            for the next flush so that a resume from ``MAX(hold_back_column)`` never skips rows.
+    """
+
+    def __init__(self, write_function, flush_rows: int, hold_back_column: str = None) -> None:
+        self.write_function = write_function
+        self.flush_rows = flush_rows
+        self.hold_back_column = hold_back_column
+        self.buffer = []
+        self.buffered_rows = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flushed_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data: pd.DataFrame) -> None:
+        """Adds a frame to the buffer and flushes it if it reached ``flush_rows`` rows.
+
+        Args:
+            data (pd.DataFrame): Incoming rows.
+
+        Returns:
+            None
+        """
+        if data is None or data.shape[0] == 0:
+            return
+        self.buffer.append(data)
+        self.buffered_rows += data.shape[0]
+        if self.flush_rows is not None and self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        """Writes the buffered rows as one parquet part.
+
+        Args:
+            final (bool): When True every buffered row is written, including the held back ones.
+
+        Returns:
+            None
+        """
+        if self.buffered_rows == 0:
+            return
+        data = pd.concat(self.buffer, axis=0, ignore_index=True)
+        held_back = data.iloc[0:0]
+        if self.hold_back_column and not final:
+            is_last_value = data[self.hold_back_column] == data[self.hold_back_column].iloc[-1]
+            held_back = data[is_last_value]
+            data = data[~is_last_value]
+        self.buffer = [held_back] if held_back.shape[0] > 0 else []
+        self.buffered_rows = held_back.shape[0]
+        if data.shape[0] == 0:
+            return
+
+        data_bytes = int(data.memory_usage(deep=True).sum())
+        self.write_function(data)
+        self.flushes += 1
+        self.flushed_rows += data.shape[0]
+        self.flushed_bytes += data_bytes
+        logger.info(f"Flushed part {self.flushes}: {data.shape[0]} rows, {data_bytes} bytes")
+
+    def close(self) -> None:
+        """Flushes every remaining row and logs the totals written by this writer."""
+        self.flush(final=True)
+        logger.info(
+            f"Streaming writer closed: {self.flushes} parts, {self.flushed_rows} rows, {self.flushed_bytes} bytes"
+        )
@@ -0,0 +1,32 @@
+import pytest
+
+from src.pipelines import engines, http_client, subgraph, watermarks
+from src.pipelines.concurrency import AimdController
+from src.pipelines.watermarks import WatermarkStore
+
+
+@pytest.fixture
+def local_lake(tmp_path, monkeypatch):
+    """A DuckDB engine over a local ``DUCKDB_DATA_ROOT``, the default engine of the test, and a local watermark store."""
+    pytest.importorskip("duckdb")
+    engine = engines.DuckDBEngine(data_root=str(tmp_path / "lake"))
+    monkeypatch.setattr(engines, "_engines", {engines.DUCKDB: engine})
+    monkeypatch.setattr(engines, "_default_engine", engines.DUCKDB)
+    monkeypatch.setattr(watermarks, "_watermark_store", WatermarkStore(location=str(tmp_path / "watermarks")))
+    return engine
+
+
+@pytest.fixture
+def local_subgraph(monkeypatch):
+    """Neither caches the responses of a local subgraph stub nor throttles the requests sent to it."""
+    controllers = {}
+    monkeypatch.setattr(subgraph, "get_response_cache", lambda: None)
+    monkeypatch.setattr(
+        http_client,
+        "get_controller",
+        lambda name: controllers.setdefault(
+            name, AimdController(name, initial_limit=http_client.settings.HTTP_CONCURRENCY_MAX)
+        ),
+    )
+    monkeypatch.setattr(http_client, "requests_per_second_by_host", lambda: {})
+    monkeypatch.setattr(http_client.settings, "HTTP_DEFAULT_REQUESTS_PER_SECOND", 100000)
@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.pipelines.analytics.token_prices import refresh_token_price_index
+from src.pipelines.stage.transformations.stage_tranformation_queries import general_columns
+
+
+SECONDS_PER_DAY = 86400
+ETH_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+
+def write_table(engine, table_name: str, data, partition_cols: list = None) -> None:
+    """Appends ``data`` (a DataFrame or an Arrow table) to ``table_name`` under the engine's local data root."""
+    database, table = table_name.split(".")
+    location = engine.table_location(database, table)
+    if not isinstance(data, pa.Table):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+    if partition_cols:
+        pq.write_to_dataset(data, root_path=location, partition_cols=partition_cols)
+    else:
+        os.makedirs(location, exist_ok=True)
+        pq.write_table(data, f"{location}/part-{len(os.listdir(location)):05d}.parquet")
+
+
+def generate_stage_events(rows: int, tokens: list, start_unixtimestamp: int, days: int, seed: int = 0) -> pa.Table:
+    """Random ``db_stage_prod.transpose_<event>_events`` rows, ``epoch_timestamp`` a decimal(38,0) like Athena's."""
+    random = np.random.default_rng(seed)
+    epoch_timestamps = np.sort(random.integers(start_unixtimestamp, start_unixtimestamp + days * SECONDS_PER_DAY, rows))
+    # Some events in the second half of a day, where rounding the day instead of truncating it shows
+    epoch_timestamps[::5] = epoch_timestamps[::5] // SECONDS_PER_DAY * SECONDS_PER_DAY + SECONDS_PER_DAY - 60
+    timestamps = pd.to_datetime(epoch_timestamps, unit="s")
+    events = pd.DataFrame(
+        {
+            "block_number": 17000000 + np.arange(rows),
+            "log_index": random.integers(0, 300, rows),
+            "transaction_hash": [f"0x{index:064x}" for index in range(rows)],
+            "timestamp": timestamps,
+            "epoch_timestamp": epoch_timestamps,
+            "protocol_name": random.choice(["aave", "compound"], rows),
+            "contract_version": "v2",
+            "market_address": "0xmarket",
+            "token_address": random.choice(tokens, rows),
+            "category": "borrow",
+            "account_address": [f"0x{value:040x}" for value in random.integers(0, 2**62, rows)],
+            "quantity": random.integers(1, 10**12, rows).astype(float),
+            "sender_address": [f"0x{value:040x}" for value in random.integers(0, 2**62, rows)],
+            "year": timestamps.year.astype(str),
+            "month": timestamps.month.astype(str),
+        }
+    )[general_columns]
+    # Spread the senders over every address partition
+    events["sender_address"] = [
+        f"0x{value:02x}" + address[4:]
+        for value, address in zip(random.integers(0, 256, rows), events["sender_address"])
+    ]
+    table = pa.Table.from_pandas(events, preserve_index=False)
+    epoch_index = table.schema.get_field_index("epoch_timestamp")
+    return table.set_column(epoch_index, "epoch_timestamp", table.column("epoch_timestamp").cast(pa.decimal128(38, 0)))
+
+
+def generate_daily_token_prices(tokens: list, start_unixtimestamp: int, days: int, seed: int = 0) -> pd.DataFrame:
+    """Random ``features_daily_token_prices``: about one price a day per token at a random time, with gaps."""
+    random = np.random.default_rng(seed)
+    day_starts = start_unixtimestamp // SECONDS_PER_DAY * SECONDS_PER_DAY + np.arange(-8, days) * SECONDS_PER_DAY
+    prices = pd.DataFrame(
+        {
+            "address": np.repeat(tokens, len(day_starts)),
+            "timestamp": np.tile(day_starts, len(tokens))
+            + random.integers(0, SECONDS_PER_DAY, len(day_starts) * len(tokens)),
+            "price": random.random(len(day_starts) * len(tokens)),
+        }
+    )
+    return prices[random.random(len(prices)) > 0.3].reset_index(drop=True)
+
+
+def write_event_sources(
+    engine, event_name: str, events: pa.Table, tokens: list, start_unixtimestamp: int, days: int
+) -> None:
+    """Writes the stage ``events`` and the token tables ``transformations.sql`` reads, then the as-of prices.
+
+    Every token has a metadata row but the last one, and the one before it is dropped.
+    """
+    write_table(engine, f"db_stage_prod.transpose_{event_name}_events", events, partition_cols=["year", "month"])
+    write_table(
+        engine,
+        "db_stage_prod.ethereum_tokens_metadata",
+        pd.DataFrame(
+            {
+                "contract_address": tokens[:-1],
+                "decimals": [6 if index % 4 == 1 else 18 for index in range(len(tokens) - 1)],
+            }
+        ),
+    )
+    write_table(engine, "db_sandbox_prod.defi_events_tokens_to_drop", pd.DataFrame({"contract_address": [tokens[-2]]}))
+    daily_token_prices = generate_daily_token_prices(tokens, start_unixtimestamp, days=days)
+    write_table(engine, "db_analytics_prod.features_daily_token_prices", daily_token_prices)
+    refresh_token_price_index()
+
+
+def write_previous_analytics_event(
+    engine, event_name: str, events: pa.Table, block_number: int, epoch_timestamp: int
+) -> None:
+    """Writes the first of the stage ``events``, moved to ``block_number`` and ``epoch_timestamp``, to the
+    analytics table, as inserted by a previous run."""
+    previous_event = (
+        events.slice(0, 1)
+        .to_pandas()
+        .assign(block_number=block_number, epoch_timestamp=epoch_timestamp, token_decimal=18, quantity_in_eth=1.0)
+    )
+    previous_event = previous_event.assign(index_address=previous_event["sender_address"])
+    previous_event["address_partition"] = previous_event["sender_address"].str[2:4]
+    write_table(
+        engine,
+        f"db_analytics_prod.transpose_{event_name}_events",
+        previous_event[
+            [
+                "block_number",
+                "log_index",
+                "transaction_hash",
+                "timestamp",
+                "epoch_timestamp",
+                "protocol_name",
+                "contract_version",
+                "market_address",
+                "token_address",
+                "token_decimal",
+                "category",
+                "account_address",
+                "quantity",
+                "quantity_in_eth",
+                "sender_address",
+                "index_address",
+                "year",
+                "month",
+                "address_partition",
+            ]
+        ],
+        partition_cols=["address_partition"],
+    )
+
+
+def generate_market_data(blocks: list, protocols: list, markets: int, seed: int = 0) -> pd.DataFrame:
+    """Random ``db_stage_prod.the_graph_historical_market_data`` snapshots of ``blocks``, partitioned by month.
+
+    Market 0 of a protocol is its ETH market. Some markets miss a snapshot, some prices are 0 or null, and the
+    ETH market of the second protocol misses its second block.
+    """
+    random = np.random.default_rng(seed)
+    eth_market_names = {"aave": "Aave interest bearing WETH", "compound": "Compound Ether"}
+    rows = []
+    for block_number in blocks:
+        for protocol in protocols:
+            for market in range(markets):
+                if market > 0 and random.random() < 0.05:
+                    continue
+                price = random.random() * 2000
+                if random.random() < 0.1:
+                    price = float(random.choice([0.0, price]))
+                rows.append(
+                    {
+                        "liquidation_threshold": random.random() * 100,
+                        "name": eth_market_names[protocol] if market == 0 else f"token {market}",
+                        "input_token_price_usd": None if random.random() < 0.02 else price,
+                        "id": f"0xm{protocol}{market}",
+                        "decimals": int(random.choice([6, 8, 18])),
+                        "protocol": protocol,
+                        "block_number": int(block_number),
+                        "block_timestamp": int(block_number) * 12,
+                    }
+                )
+    market_data = pd.DataFrame(rows)
+    market_data = market_data[
+        ~((market_data["block_number"] == blocks[1]) & (market_data["name"] == eth_market_names[protocols[1]]))
+    ]
+    return market_data.assign(
+        year="2023", month=np.where(market_data["block_number"] < blocks[len(blocks) // 2], "01", "02")
+    )
+
+
+def generate_account_positions(rows: int, blocks: list, protocols: list, markets: int, seed: int = 0) -> pd.DataFrame:
+    """Random ``db_stage_prod.the_graph_historical_account_positions`` of ``blocks``, partitioned by month.
+
+    About 5% of the balances are 0, and some positions are in markets without market data.
+    """
+    random = np.random.default_rng(seed)
+    protocol_of_rows = random.choice(protocols, rows)
+    positions = pd.DataFrame(
+        {
+            "balance": np.where(random.random(rows) < 0.05, 0.0, random.random(rows) * 1e20),
+            "id": [f"position {index}" for index in range(rows)],
+            "is_collateral": random.random(rows) < 0.5,
+            "market": "market",
+            "market_id": [
+                f"0xm{protocol}{market}"
+                for protocol, market in zip(protocol_of_rows, random.integers(0, markets + 1, rows))
+            ],
+            "side": "LENDER",
+            "account": [f"0x{value:040x}" for value in random.integers(0, 2**63, rows, dtype=np.uint64) * 2],
+            "block_number": random.choice(blocks, rows).astype("int64"),
+        }
+    )
+    return positions.assign(
+        protocol=protocol_of_rows,
+        block_timestamp=positions["block_number"] * 12,
+        year="2023",
+        month=np.where(positions["block_number"] < blocks[len(blocks) // 2], "01", "02"),
+    )
@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import json
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+from aiohttp import web
+
+
+# Aliased fields of the current positions query, values inlined (see build_multi_chunk_query)
+ALIASED_POSITIONS_PATTERN = re.compile(
+    r"(c\d+): positions\(\s*where: \{account_in: (\[.*?\]), id_gt: (\".*?\"), balance_not: \"0\"\}\s*first: (\d+)",
+    re.S,
+)
+
+
+def generate_positions(accounts: int, positions_per_account: list, id_prefix: str = "", seed: int = 0) -> list:
+    """Random subgraph positions of ``accounts`` accounts, sorted by id.
+
+    Args:
+        accounts (int): Number of accounts.
+        positions_per_account (list): Possible numbers of positions of an account, drawn uniformly.
+        id_prefix (str): Hex digits every position id starts with, to concentrate the ids in a narrow range.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        list: Position dicts, as returned by the subgraph.
+    """
+    random = np.random.default_rng(seed)
+    positions = []
+    for account_index in range(accounts):
+        account = f"0x{account_index * 7919 + 1:040x}"
+        for position_index in range(int(random.choice(positions_per_account))):
+            hex_id = id_prefix + random.bytes(20).hex()[len(id_prefix) :]
+            positions.append(
+                {
+                    "balance": str(int(random.integers(1, 10**18))),
+                    "id": f"0x{hex_id}-{position_index}",
+                    "isCollateral": bool(position_index % 2),
+                    "market": {"id": f"0x{position_index % 5:040x}", "name": f"market {position_index % 5}"},
+                    "side": "LENDER",
+                    "account": {"id": account},
+                }
+            )
+    return sorted(positions, key=lambda position: position["id"])
+
+
+class SubgraphStub(object):
+    """Local GraphQL server answering the positions queries of the pipelines, on its own thread and event loop.
+
+    Serves the ``positions`` of every subgraph id, either paged with ``id_gt``/``id_lt`` variables (historical
+    positions) or as aliased fields filtering on ``account_in`` (current positions). Every response is delayed
+    by ``latency_seconds`` without blocking the other requests, like a remote indexer.
+
+    Args:
+        positions (dict): Positions of each subgraph id, sorted by id.
+        latency_seconds (float): Delay of every response.
+    """
+
+    def __init__(self, positions: dict, latency_seconds: float = 0.0) -> None:
+        self.positions = positions
+        self.ids = {subgraph_id: [position["id"] for position in rows] for subgraph_id, rows in positions.items()}
+        self.positions_by_account = {}
+        for subgraph_id, rows in positions.items():
+            by_account = defaultdict(list)
+            for position in rows:
+                by_account[position["account"]["id"]].append(position)
+            self.positions_by_account[subgraph_id] = by_account
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.loop = None
+        self.runner = None
+        self.base_url = None
+
+    def url(self, subgraph_id: str) -> str:
+        return f"{self.base_url}/api/local-key/subgraphs/id/{subgraph_id}"
+
+    def __enter__(self):
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        async def start() -> None:
+            app = web.Application(client_max_size=64 * 1024**2)
+            app.router.add_post("/api/{api_key}/subgraphs/id/{subgraph_id}", self.handle)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+            host, port = self.runner.addresses[0][:2]
+            self.base_url = f"http://{host}:{port}"
+            started.set()
+
+        def run() -> None:
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(start())
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await self.answer(request)
+        finally:
+            self.in_flight -= 1
+
+    async def answer(self, request: web.Request) -> web.Response:
+        subgraph_id = request.match_info["subgraph_id"]
+        body = await request.json()
+        query, variables = body["query"], body.get("variables") or {}
+        await asyncio.sleep(self.latency_seconds)
+        aliased_fields = ALIASED_POSITIONS_PATTERN.findall(query)
+        if len(aliased_fields) > 0:
+            data = {
+                alias: self.account_positions(subgraph_id, json.loads(accounts), json.loads(last_id), int(first))
+                for alias, accounts, last_id, first in aliased_fields
+            }
+        else:
+            data = {
+                "positions": self.positions_page(
+                    subgraph_id, variables.get("last_id") or "", variables.get("upper_id"), variables["first"]
+                )
+            }
+        return web.json_response({"data": data})
+
+    def positions_page(self, subgraph_id: str, last_id: str, upper_id: str, first: int) -> list:
+        ids = self.ids[subgraph_id]
+        start = bisect.bisect_right(ids, last_id)
+        end = len(ids) if upper_id is None else bisect.bisect_left(ids, upper_id)
+        return self.positions[subgraph_id][start : min(end, start + first)]
+
+    def account_positions(self, subgraph_id: str, accounts: list, last_id: str, first: int) -> list:
+        by_account = self.positions_by_account[subgraph_id]
+        rows = [position for account in accounts for position in by_account.get(account, [])]
+        rows = sorted((position for position in rows if position["id"] > last_id), key=lambda row: row["id"])
+        return rows[:first]
@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+from src.pipelines import chunk_scheduler, watermarks
+from src.pipelines.analytics import defi_events
+from tests.local_lake import ETH_ADDRESS, generate_stage_events, write_event_sources, write_previous_analytics_event
+
+
+START_UNIXTIMESTAMP = 1672531200
+TOKENS = [ETH_ADDRESS] + [f"0x{token:040x}" for token in range(1, 5)]
+DROPPED_TOKEN, TOKEN_WITHOUT_METADATA = TOKENS[3], TOKENS[4]
+ANALYTICS_TABLE = "db_analytics_prod.transpose_borrow_events"
+KEYS = ["block_number", "log_index", "transaction_hash"]
+
+
+@pytest.fixture
+def borrow_events(local_lake, monkeypatch):
+    """Stage borrow events, token tables and an analytics table holding the events of a previous run."""
+    monkeypatch.setattr(chunk_scheduler, "retry_delay_seconds", lambda attempt: 0)
+    events = generate_stage_events(rows=3000, tokens=TOKENS, start_unixtimestamp=START_UNIXTIMESTAMP, days=40)
+    write_event_sources(local_lake, "borrow", events, TOKENS, START_UNIXTIMESTAMP, days=40)
+    write_previous_analytics_event(
+        local_lake, "borrow", events, block_number=16000000, epoch_timestamp=START_UNIXTIMESTAMP - 86400
+    )
+    return events.to_pandas()
+
+
+def analytics_events(local_lake) -> pd.DataFrame:
+    return local_lake.read_sql_query(f"SELECT * FROM {ANALYTICS_TABLE}", database="db_analytics_prod")
+
+
+def expected_keys(events: pd.DataFrame) -> list:
+    converted = events[~events["token_address"].isin([DROPPED_TOKEN, TOKEN_WITHOUT_METADATA])]
+    return sorted(map(tuple, converted[KEYS].values.tolist())) + [(16000000,) + tuple(events[KEYS[1:]].values[0])]
+
+
+def test_retried_chunks_and_reruns_insert_every_event_once(local_lake, borrow_events, monkeypatch):
+    insert_data_into_table = defi_events.insert_data_into_table
+    failed_chunks = set()
+
+    def insert_then_fail_once(*args) -> None:
+        # The insert went through but its acknowledgment was lost, so the chunk is retried
+        insert_data_into_table(*args)
+        if args[-1] not in failed_chunks:
+            failed_chunks.add(args[-1])
+            raise ConnectionError("connection reset after the insert")
+
+    monkeypatch.setattr(defi_events, "insert_data_into_table", insert_then_fail_once)
+    defi_events.run_insert_in_parallell("borrow")
+    # The whole job runs again, as after a chunk that failed for good
+    watermarks.get_watermark_store().write(ANALYTICS_TABLE, {watermarks.ALL: START_UNIXTIMESTAMP - 86400}, replace=True)
+    defi_events.run_insert_in_parallell("borrow")
+
+    inserted = analytics_events(local_lake)
+    assert len(failed_chunks) > 1
+    assert sorted(map(tuple, inserted[KEYS].values.tolist())) == sorted(expected_keys(borrow_events))
+
+
+def test_query_shares_split_the_engine_quota(local_lake, borrow_events, monkeypatch):
+    concurrency = []
+
+    def scheduler(run_chunk, concurrency_limit: int) -> chunk_scheduler.ChunkScheduler:
+        concurrency.append(concurrency_limit)
+        # The local files are not written atomically, so the inserts still run one at a time
+        return chunk_scheduler.ChunkScheduler(run_chunk, concurrency=1)
+
+    monkeypatch.setattr(local_lake, "max_concurrent_queries", 20)
+    monkeypatch.setattr(defi_events, "ChunkScheduler", lambda run_chunk, concurrency: scheduler(run_chunk, concurrency))
+
+    defi_events.run_insert_in_parallell("borrow", query_shares=5)
+
+    assert concurrency == [4]
@@ -0,0 +1,176 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from src.pipelines import engines
+from src.pipelines.analytics import defi_events, token_prices
+from src.pipelines.chunk_scheduler import address_partitions_sql
+from src.pipelines.partition_planner import TRANSPOSE, partition_predicate, plan_timestamp_partitions
+from tests.local_lake import (
+    ETH_ADDRESS,
+    SECONDS_PER_DAY,
+    generate_stage_events,
+    write_event_sources,
+    write_previous_analytics_event,
+)
+
+
+START_UNIXTIMESTAMP = 1672531200
+TRANSFORMATIONS_SQL = "src/pipelines/analytics/transformations/transformations.sql"
+# transformations.sql before the as-of price table, with a range join over every daily price of the token
+RANGE_JOIN_SQL = "tests/sql/transformations_range_join.sql"
+KEYS = ["block_number", "log_index", "transaction_hash"]
+
+
+def write_borrow_sources(engine, rows: int, tokens_count: int, days: int) -> None:
+    tokens = [ETH_ADDRESS] + [f"0x{token:040x}" for token in range(1, tokens_count)]
+    events = generate_stage_events(rows=rows, tokens=tokens, start_unixtimestamp=START_UNIXTIMESTAMP, days=days)
+    write_event_sources(engine, "borrow", events, tokens, START_UNIXTIMESTAMP, days=days)
+    write_previous_analytics_event(
+        engine, "borrow", events, block_number=16000000, epoch_timestamp=START_UNIXTIMESTAMP - SECONDS_PER_DAY
+    )
+
+
+def borrow_template_params(days: int) -> dict:
+    """Parameters of the insert templates over every new borrow event."""
+    last_timestamp, max_timestamp = START_UNIXTIMESTAMP - 1, START_UNIXTIMESTAMP + days * SECONDS_PER_DAY
+    return {
+        "event_name": "borrow",
+        "token_column": "token_address",
+        "last_timestamp": last_timestamp,
+        "max_timestamp": max_timestamp,
+        "quantity_column": "quantity",
+        "index_column": "sender_address",
+        "address_partitions": address_partitions_sql([f"{partition:02x}" for partition in range(256)]),
+        "partition_predicate": partition_predicate(
+            plan_timestamp_partitions(last_timestamp, max_timestamp), TRANSPOSE, alias="tb"
+        ),
+    }
+
+
+def select_borrow_events(engine, sql_file_path: str, days: int) -> pd.DataFrame:
+    """Runs the ``SELECT`` of the insert template ``sql_file_path`` over every new borrow event."""
+    query = defi_events.render_sql_template(sql_file_path, borrow_template_params(days))
+    select = query.split("\n", 1)[1]
+    return engine.read_sql_query(select, database="db_analytics_prod").sort_values(KEYS, ignore_index=True)
+
+
+def select_borrow_events_in_process(engine, days: int) -> pd.DataFrame:
+    """Selects every new borrow event like ``insert_events_in_process``, their prices looked up in process."""
+    params = borrow_template_params(days)
+    query = defi_events.render_sql_template(defi_events.EVENTS_WITHOUT_PRICES_SQL, params)
+    events = engine.read_sql_query(query, database="db_analytics_prod")
+    prices = token_prices.read_prices_as_of(params["last_timestamp"], params["max_timestamp"])
+    events = token_prices.add_quantity_in_eth(events, prices, "token_address", "quantity")
+    return events.sort_values(KEYS, ignore_index=True)
+
+
+def test_as_of_prices_convert_events_like_the_range_join(local_lake):
+    write_borrow_sources(local_lake, rows=3000, tokens_count=5, days=40)
+
+    range_join = select_borrow_events(local_lake, RANGE_JOIN_SQL, days=40)
+    as_of = select_borrow_events(local_lake, TRANSFORMATIONS_SQL, days=40)
+
+    assert as_of["quantity_in_eth"].notna().sum() > len(as_of) // 2
+    # Events late in the day, whose day rounded half up would miss their prices
+    assert (as_of["epoch_timestamp"].astype("int64") % SECONDS_PER_DAY >= SECONDS_PER_DAY // 2).any()
+    pd.testing.assert_frame_equal(as_of, range_join)
+
+
+def insert_borrow_events_in_process(engine, days: int) -> pd.DataFrame:
+    """Inserts every new borrow event with ``insert_data_into_table`` on DuckDB, then reads them back."""
+    params = borrow_template_params(days)
+    defi_events.insert_data_into_table(
+        "borrow",
+        params["last_timestamp"],
+        params["max_timestamp"],
+        "token_address",
+        "quantity",
+        "sender_address",
+        tuple(f"{partition:02x}" for partition in range(256)),
+    )
+    inserted = engine.read_sql_query(
+        f"SELECT * FROM db_analytics_prod.transpose_borrow_events WHERE epoch_timestamp > {params['last_timestamp']}",
+        database="db_analytics_prod",
+    )
+    return inserted.sort_values(KEYS, ignore_index=True)
+
+
+def test_events_converted_in_process_match_the_range_join(local_lake):
+    write_borrow_sources(local_lake, rows=3000, tokens_count=5, days=40)
+
+    range_join = select_borrow_events(local_lake, RANGE_JOIN_SQL, days=40)
+    in_process = insert_borrow_events_in_process(local_lake, days=40)
+
+    assert in_process["quantity_in_eth"].notna().sum() > len(in_process) // 2
+    pd.testing.assert_frame_equal(in_process[range_join.columns], range_join)
+    # A re-run skips the events already inserted
+    assert len(insert_borrow_events_in_process(local_lake, days=40)) == len(range_join)
+
+
+def test_refresh_replaces_the_as_of_prices(local_lake):
+    write_borrow_sources(local_lake, rows=100, tokens_count=5, days=10)
+    table = f"{token_prices.DATABASE}.{token_prices.TABLE}"
+    rows = len(local_lake.read_sql_query(f"SELECT * FROM {table}", database=token_prices.DATABASE))
+
+    token_prices.refresh_token_price_index()
+
+    assert len(local_lake.read_sql_query(f"SELECT * FROM {table}", database=token_prices.DATABASE)) == rows
+
+
+def test_athena_replace_deletes_the_previous_prices_after_the_grace_period(tmp_path, monkeypatch):
+    location = str(tmp_path / "features_token_prices_as_of")
+    table_locations = {}
+
+    def execute(engine, sql: str, database: str) -> None:
+        # The CREATE TABLE AS writes the new version, the ALTER TABLE swaps it in
+        if sql.startswith("CREATE TABLE"):
+            new_location = sql.split("external_location = '")[1].split("'")[0]
+            os.makedirs(new_location)
+            open(f"{new_location}/prices", "w").close()
+        elif sql.startswith("ALTER TABLE"):
+            table_locations[token_prices.TABLE] = sql.split("SET LOCATION '")[1].split("'")[0]
+
+    monkeypatch.setattr(engines.AthenaEngine, "execute", execute)
+    monkeypatch.setattr(engines.AthenaEngine, "does_table_exist", lambda engine, database, table: True)
+    monkeypatch.setattr(engines.wr.catalog, "get_table_location", lambda database, table: table_locations[table])
+    os.makedirs(f"{location}/0")
+    open(f"{location}/0/prices", "w").close()
+    table_locations[token_prices.TABLE] = f"{location}/0/"
+    athena = engines.AthenaEngine()
+
+    athena.replace_table(token_prices.DATABASE, token_prices.TABLE, "SELECT 1", location=location)
+    # A query started before the swap still reads the previous prices
+    assert os.path.exists(f"{location}/0/prices")
+
+    athena.grace_seconds = 0
+    time.sleep(1)  # the versions of the table are in seconds
+    athena.replace_table(token_prices.DATABASE, token_prices.TABLE, "SELECT 1", location=location)
+
+    assert not os.path.exists(f"{location}/0/prices")
+    assert os.path.exists(f"{table_locations[token_prices.TABLE]}prices")
+    assert len(os.listdir(f"{location}/_manifests")) == 1
+
+
+@pytest.mark.benchmark
+def test_benchmark_as_of_prices_against_the_range_join(local_lake):
+    write_borrow_sources(local_lake, rows=200000, tokens_count=500, days=365)
+
+    start = time.time()
+    range_join = select_borrow_events(local_lake, RANGE_JOIN_SQL, days=365)
+    range_join_seconds = time.time() - start
+    start = time.time()
+    as_of = select_borrow_events(local_lake, TRANSFORMATIONS_SQL, days=365)
+    as_of_seconds = time.time() - start
+    start = time.time()
+    in_process = select_borrow_events_in_process(local_lake, days=365)
+    in_process_seconds = time.time() - start
+
+    pd.testing.assert_frame_equal(as_of, range_join)
+    pd.testing.assert_frame_equal(in_process, range_join)
+    print(
+        f"\n{len(as_of)} events: range join {range_join_seconds:.2f}s, as-of prices {as_of_seconds:.2f}s, "
+        f"as-of prices in process {in_process_seconds:.2f}s"
+    )
@@ -0,0 +1,138 @@
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src.pipelines import compaction
+from src.pipelines.compaction import PartitionCompactor, data_file_sizes, read_parquet_files
+from src.pipelines.storage import list_paths
+
+
+class LocalGlue(object):
+    """In-memory Glue catalog of one table partitioned by year/month, with the calls the compactor makes."""
+
+    def __init__(self, location: str, partitions: list) -> None:
+        self.location = location
+        self.partitions = {
+            tuple(values): {
+                "Values": list(values),
+                "StorageDescriptor": {"Location": f"{location}/year={values[0]}/month={values[1]}/"},
+            }
+            for values in partitions
+        }
+
+    def get_table(self, DatabaseName: str, Name: str) -> dict:
+        return {
+            "Table": {
+                "StorageDescriptor": {"Location": f"{self.location}/"},
+                "PartitionKeys": [{"Name": "year"}, {"Name": "month"}],
+            }
+        }
+
+    def get_paginator(self, operation_name: str):
+        glue = self
+
+        class Paginator(object):
+            def paginate(self, DatabaseName: str, TableName: str):
+                yield {"Partitions": copy.deepcopy(list(glue.partitions.values()))}
+
+        return Paginator()
+
+    def get_partition(self, DatabaseName: str, TableName: str, PartitionValues: list) -> dict:
+        return {"Partition": copy.deepcopy(self.partitions[tuple(PartitionValues)])}
+
+    def update_partition(self, DatabaseName: str, TableName: str, PartitionValueList: list, PartitionInput: dict):
+        self.partitions[tuple(PartitionValueList)] = copy.deepcopy(PartitionInput)
+
+    def partition_location(self, values: list) -> str:
+        return self.partitions[tuple(values)]["StorageDescriptor"]["Location"].rstrip("/")
+
+
+def append_files(location: str, files: int, rows_per_file: int, seed: int) -> int:
+    random = np.random.default_rng(seed)
+    os.makedirs(location, exist_ok=True)
+    for index in range(files):
+        rows = pd.DataFrame(
+            {
+                "sender_address": [f"0x{value:040x}" for value in random.integers(0, 1000, rows_per_file)],
+                "block_number": random.integers(17000000, 18000000, rows_per_file),
+                "quantity": random.integers(1, 10**12, rows_per_file).astype(str),
+            }
+        )
+        pq.write_table(pa.Table.from_pandas(rows, preserve_index=False), f"{location}/{seed}-{index}.parquet")
+    return files * rows_per_file
+
+
+def visible_rows(glue: LocalGlue, values: list) -> int:
+    return read_parquet_files(sorted(data_file_sizes(glue.partition_location(values)))).num_rows
+
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    location = str(tmp_path / "raw" / "transpose_borrow_events")
+    glue = LocalGlue(location, partitions=[["2023", "1"]])
+    monkeypatch.setattr(compaction.boto3, "client", lambda service_name, region_name=None: glue)
+    glue.compaction_location = str(tmp_path / "_compaction")
+    return glue
+
+
+def test_flipped_partition_is_settled_back_home_after_the_grace_period(table):
+    values = ["2023", "1"]
+    home = f"{table.location}/year=2023/month=1"
+    rows = append_files(home, files=12, rows_per_file=100, seed=0)
+    small_files = sorted(data_file_sizes(home))
+    compactor = PartitionCompactor(
+        "db_raw_prod", "transpose_borrow_events", grace_seconds=3600, compaction_location=table.compaction_location
+    )
+    compacted_location = f"{table.compaction_location}/db_raw_prod/transpose_borrow_events"
+
+    [report] = compactor.run()
+
+    assert report["status"] == "compacted"
+    assert table.partition_location(values).startswith(f"{compacted_location}/year=2023/month=1/")
+    assert visible_rows(table, values) == rows
+    # Queries started before the flip may still read the small files, the only ones under the table prefix
+    assert all(os.path.exists(path) for path in small_files)
+    assert sorted(data_file_sizes(table.location)) == small_files
+
+    # A backfill appends to the home of the flipped partition
+    late_rows = append_files(home, files=1, rows_per_file=10, seed=1)
+    assert compactor.run() == [{"status": "flipped"}]
+    compactor.grace_seconds = 0
+    assert compactor.settle_due() == set()
+
+    assert table.partition_location(values) == home
+    assert visible_rows(table, values) == rows + late_rows
+    assert not any(os.path.exists(path) for path in small_files)
+    assert len(data_file_sizes(home)) == report["files_after"] + 1
+    assert data_file_sizes(table.location) == data_file_sizes(home)
+    # The compacted prefix and the manifests are cleaned up after another grace period
+    compactor.settle_due()
+    assert data_file_sizes(compacted_location) == {}
+    assert list(list_paths(compacted_location)) == []
+
+
+def test_partition_appended_to_while_compacted_is_left_unchanged(table, monkeypatch):
+    values = ["2023", "1"]
+    home = f"{table.location}/year=2023/month=1"
+    rows = append_files(home, files=12, rows_per_file=100, seed=0)
+
+    def read_then_append(paths: list, *args, **kwargs) -> pa.Table:
+        data = read_parquet_files(paths, *args, **kwargs)
+        if "compacted" not in paths[0]:
+            append_files(home, files=1, rows_per_file=10, seed=len(paths))
+        return data
+
+    monkeypatch.setattr(compaction, "read_parquet_files", read_then_append)
+    [report] = PartitionCompactor(
+        "db_raw_prod", "transpose_borrow_events", compaction_location=table.compaction_location
+    ).run()
+
+    assert report["status"] == "appended"
+    assert table.partition_location(values) == home
+    assert visible_rows(table, values) == rows + 10
+    assert data_file_sizes(table.compaction_location) == {}
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+
+from src.pipelines.analytics import current_collateral_positions
+from src.pipelines.analytics.current_collateral_positions import CurrentPositionsFetcher
+from src.pipelines.http_client import AsyncHttpClient
+from tests.subgraph_stub import SubgraphStub, generate_positions
+
+
+QUERY = open("src/pipelines/analytics/queries/current_positions_for_address_list.graphql").read()
+
+pytestmark = pytest.mark.usefixtures("local_subgraph")
+
+
+def fetch_current_positions(stub: SubgraphStub, addresses: list, **fetcher_args) -> tuple:
+    """Returns the positions of ``addresses`` fetched from ``stub``, the fetcher and the seconds it took."""
+
+    async def fetch() -> tuple:
+        async with AsyncHttpClient() as client:
+            fetcher = CurrentPositionsFetcher(client, "aave", stub.url("positions"), QUERY, addresses, **fetcher_args)
+            return await fetcher.fetch(), fetcher
+
+    start = time.time()
+    positions, fetcher = asyncio.run(fetch())
+    return positions, fetcher, time.time() - start
+
+
+def accounts_of(positions: list) -> list:
+    return sorted({position["account"]["id"] for position in positions})
+
+
+def test_chunks_requeued_after_the_first_request_are_paged_concurrently():
+    positions = generate_positions(accounts=4000, positions_per_account=[1, 2, 3, 4])
+    with SubgraphStub({"positions": positions}, latency_seconds=0.05) as stub:
+        # The first request carries all 8 chunks, then a request carries one chunk of 2 pages
+        fetched, fetcher, _ = fetch_current_positions(
+            stub,
+            accounts_of(positions),
+            chunks_per_request=8,
+            max_chunks_per_request=8,
+            target_rows=1,
+            requests_in_flight=8,
+            min_addresses_per_chunk=500,
+            max_addresses_per_chunk=500,
+        )
+
+    assert sorted(position["id"] for position in fetched) == [position["id"] for position in positions]
+    assert fetcher.in_flight == 0
+    assert stub.max_in_flight == 8
+
+
+@pytest.mark.benchmark
+def test_benchmark_adaptive_chunks_rows_per_second():
+    positions = generate_positions(accounts=100000, positions_per_account=[0, 1, 2, 3, 5, 20])
+    addresses = [f"0x{account_index * 7919 + 1:040x}" for account_index in range(100000)]
+    with SubgraphStub({"positions": positions}, latency_seconds=0.2) as stub:
+        # One request per fixed chunk of 500 addresses, 10 at a time, as the positions were fetched before
+        fixed, fixed_fetcher, fixed_seconds = fetch_current_positions(
+            stub,
+            addresses,
+            chunks_per_request=1,
+            max_chunks_per_request=1,
+            requests_in_flight=10,
+            min_addresses_per_chunk=500,
+            max_addresses_per_chunk=500,
+        )
+        adaptive, adaptive_fetcher, adaptive_seconds = fetch_current_positions(stub, addresses)
+
+    settings = current_collateral_positions.settings
+    print(
+        f"\n{len(positions)} positions of {len(addresses)} addresses: fixed 500 address chunks "
+        f"{len(fixed) / fixed_seconds:.0f} rows/s in {fixed_fetcher.requests} requests, adaptive chunks "
+        f"{len(adaptive) / adaptive_seconds:.0f} rows/s in {adaptive_fetcher.requests} requests "
+        f"({settings.CURRENT_POSITIONS_REQUESTS_IN_FLIGHT} in flight)"
+    )
+    assert len(fixed) == len(adaptive) == len(positions)
+    assert adaptive_seconds < fixed_seconds
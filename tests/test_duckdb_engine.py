@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src.pipelines import watermarks
+from src.pipelines.stage import defi_events as stage_defi_events
+from src.pipelines.stage.transformations.stage_tranformation_queries import general_columns
+from tests.local_lake import write_table
+
+RAW_TABLE = "db_raw_prod.transpose_borrow_events"
+STAGE_TABLE = "db_stage_prod.transpose_borrow_events"
+
+
+def raw_borrow_events(rows: int, start_unixtimestamp: int, seed: int = 0) -> pd.DataFrame:
+    random = np.random.default_rng(seed)
+    timestamps = pd.to_datetime(
+        np.sort(random.integers(start_unixtimestamp, start_unixtimestamp + 60 * 86400, rows)), unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "block_number": 17000000 + np.arange(rows),
+            "log_index": random.integers(0, 300, rows),
+            "transaction_hash": [f"0x{index:064x}" for index in range(rows)],
+            "timestamp": timestamps,
+            "protocol_name": random.choice(["aave", "compound"], rows),
+            "contract_version": "v2",
+            "market_address": "0xMARKET",
+            "token_address": "0xTOKEN",
+            "category": "borrow",
+            "account_address": [f"0xACCOUNT{index % 7}" for index in range(rows)],
+            "quantity": random.integers(1, 10**12, rows).astype(str),
+            "sender_address": "0xSENDER",
+            "year": timestamps.year.astype(str),
+            "month": timestamps.month.astype(str),
+        }
+    )
+
+
+def test_stage_events_run_offline_end_to_end(local_lake):
+    raw_events = raw_borrow_events(rows=300, start_unixtimestamp=1672531200)
+    write_table(local_lake, RAW_TABLE, raw_events, partition_cols=["year", "month"])
+    # The stage table already holds the first events, written in the column order of its DDL
+    already_staged = raw_events.head(100).assign(
+        epoch_timestamp=lambda rows: rows["timestamp"].astype("int64") // 10**9,
+        market_address="0xmarket",
+        token_address="0xtoken",
+        account_address=lambda rows: rows["account_address"].str.lower(),
+        sender_address="0xsender",
+    )[general_columns]
+    write_table(local_lake, STAGE_TABLE, already_staged, partition_cols=["year", "month"])
+
+    stage_defi_events.update_event_table("borrow")
+    # A retried run writes nothing twice
+    watermarks.get_watermark_store().write(STAGE_TABLE, {watermarks.ALL: 0}, replace=True)
+    stage_defi_events.update_event_table("borrow")
+
+    staged = local_lake.read_sql_query(f"SELECT * FROM {STAGE_TABLE}", database="db_stage_prod")
+    assert local_lake.table_columns("db_stage_prod", "transpose_borrow_events") == general_columns
+    assert sorted(staged["transaction_hash"]) == sorted(raw_events["transaction_hash"])
+    assert (staged["account_address"] == staged["account_address"].str.lower()).all()
+    assert watermarks.get_watermark_store().get(STAGE_TABLE) == int(raw_events["timestamp"].max().timestamp())
+
+
+def test_insert_maps_the_selected_columns_by_position(local_lake):
+    existing = pd.DataFrame({"account": ["0xa"], "balance": [1.0], "year": ["2023"], "month": ["1"]})
+    write_table(local_lake, "db_stage_prod.balances", existing, partition_cols=["year", "month"])
+
+    # Athena writes the selected columns by position whatever their names, so does the engine
+    local_lake.execute(
+        "INSERT INTO db_stage_prod.balances SELECT '0xb' AS address, 2.0 AS amount, '2023' AS year, '2' AS month",
+        database="db_stage_prod",
+    )
+    with pytest.raises(ValueError, match="selects 3 columns, the table has 4"):
+        local_lake.execute(
+            "INSERT INTO db_stage_prod.balances SELECT '0xc' AS account, '2023' AS year, '3' AS month",
+            database="db_stage_prod",
+        )
+
+    balances = local_lake.read_sql_query(
+        "SELECT account, balance, year, month FROM db_stage_prod.balances ORDER BY month", database="db_stage_prod"
+    )
+    assert balances.values.tolist() == [["0xa", 1.0, "2023", "1"], ["0xb", 2.0, "2023", "2"]]
+
+
+class GlueCatalog(object):
+    """In-memory Glue catalog of one table partitioned by year/month."""
+
+    def __init__(self, location: str, partition_locations: dict) -> None:
+        self.location = location
+        self.partition_locations = partition_locations
+
+    def get_table(self, DatabaseName: str, Name: str) -> dict:
+        return {
+            "Table": {
+                "StorageDescriptor": {"Location": f"{self.location}/"},
+                "PartitionKeys": [{"Name": "year"}, {"Name": "month"}],
+            }
+        }
+
+    def get_paginator(self, operation_name: str):
+        glue = self
+
+        class Paginator(object):
+            def paginate(self, DatabaseName: str, TableName: str):
+                yield {
+                    "Partitions": [
+                        {"Values": list(values), "StorageDescriptor": {"Location": f"{location}/"}}
+                        for values, location in glue.partition_locations.items()
+                    ]
+                }
+
+        return Paginator()
+
+
+def write_file(path: str, quantities: list) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(pa.table({"quantity": quantities}), path)
+
+
+def test_s3_tables_are_read_from_their_glue_partitions(local_lake, tmp_path):
+    bucket = str(tmp_path / "data-lakehouse")
+    location = f"{bucket}/stage/transpose_borrow_events"
+    # Athena writes files without an extension, next to hidden files
+    write_file(f"{location}/year=2023/month=1/20231018_093000_00042_abcde_0a1b2c3d", [1, 2])
+    write_file(f"{location}/year=2023/month=1/20231018_093000_00042_abcde_4e5f6a7b", [3])
+    write_file(f"{location}/year=2023/month=1/_SUCCESS", [100])
+    write_file(f"{location}/year=2023/month=1/.20231018_093000_00042_abcde_0a1b2c3d.crc", [100])
+    # The partition of February is flipped to compacted files outside the table prefix
+    write_file(f"{location}/year=2023/month=2/20231018_093000_00043_abcde_8c9d0e1f", [4, 5])
+    compacted = f"{bucket}/_compaction/db_stage_prod/transpose_borrow_events/year=2023/month=2/1697621400"
+    write_file(f"{compacted}/compacted-1697621400-00000.snappy.parquet", [4, 5])
+    # Over the Glue catalog, the S3 locations played by local directories
+    local_lake.data_root = None
+    local_lake.glue_client = GlueCatalog(
+        location, {("2023", "1"): f"{location}/year=2023/month=1", ("2023", "2"): compacted}
+    )
+
+    events = local_lake.read_sql_query(
+        f"SELECT year, month, quantity FROM {STAGE_TABLE} ORDER BY quantity", database="db_stage_prod"
+    )
+    assert events.values.tolist() == [
+        ["2023", "1", 1],
+        ["2023", "1", 2],
+        ["2023", "1", 3],
+        ["2023", "2", 4],
+        ["2023", "2", 5],
+    ]
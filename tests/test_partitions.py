@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.pipelines.partitions import add_partitions_from_blocks, add_partitions_from_timestamp
+
+
+def add_partitions_row_by_row(data: pd.DataFrame, timestamp_column: str) -> pd.DataFrame:
+    """The per-row conversion the helper replaced in ``raw/defi_events``."""
+    data["year"] = data[timestamp_column].apply(lambda x: pd.to_datetime(x, unit="s")).dt.year
+    data["month"] = data[timestamp_column].apply(lambda x: pd.to_datetime(x, unit="s")).dt.month
+    return data
+
+
+def add_partitions_block_by_block(chunks: list, blocks: list) -> pd.DataFrame:
+    """The per-block assignment the helper replaced in ``raw/historical_market_data``."""
+    for chunk, block in zip(chunks, blocks):
+        chunk["year"] = f"20{block['year']}"
+        chunk["month"] = block["month"]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def random_timestamps(rows: int, seed: int = 0) -> np.ndarray:
+    random = np.random.default_rng(seed)
+    # The last second of every month of 2019-2024 and its next second, and random seconds in between
+    month_starts = pd.date_range("2019-01-01", "2025-01-01", freq="MS").astype("int64") // 10**9
+    boundaries = np.concatenate([month_starts - 1, month_starts])
+    return np.concatenate([boundaries, random.integers(month_starts[0], month_starts[-1], rows)]).astype(float)
+
+
+def market_chunks(blocks: int, rows_per_block: int, seed: int = 0) -> tuple:
+    random = np.random.default_rng(seed)
+    block_dicts = [
+        {
+            "protocol": ["aave", "compound"][block_index % 2],
+            "block_number": 15000000 + block_index // 2 * 7200,
+            "year": str(22 + block_index // 2 // 365),
+            "month": str(block_index // 2 // 31 % 12 + 1),
+        }
+        for block_index in range(blocks)
+    ]
+    chunks = [
+        pd.DataFrame(
+            {
+                "protocol": block["protocol"],
+                "block_number": block["block_number"],
+                "total_supply": random.integers(0, 10**12, rows_per_block).astype(str),
+            }
+        )
+        for block in block_dicts
+    ]
+    return chunks, block_dicts
+
+
+def partitions_from_blocks(chunks: list, block_dicts: list) -> pd.DataFrame:
+    block_partitions = pd.DataFrame(block_dicts)
+    block_partitions["year"] = "20" + block_partitions["year"].astype(str)
+    return add_partitions_from_blocks(
+        pd.concat(chunks, ignore_index=True), block_partitions, on=["protocol", "block_number"]
+    )
+
+
+def test_add_partitions_from_timestamp_matches_the_row_by_row_conversion():
+    timestamps = random_timestamps(rows=5000)
+
+    expected = add_partitions_row_by_row(pd.DataFrame({"timestamp": timestamps}), "timestamp")
+    vectorized = add_partitions_from_timestamp(pd.DataFrame({"timestamp": timestamps}), "timestamp")
+    # Transpose returns numeric columns as strings when a page holds nulls
+    from_strings = add_partitions_from_timestamp(pd.DataFrame({"timestamp": timestamps.astype(str)}), "timestamp")
+
+    pd.testing.assert_frame_equal(vectorized, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(from_strings[["year", "month"]], expected[["year", "month"]], check_dtype=False)
+
+
+def test_add_partitions_from_blocks_matches_the_block_by_block_assignment_in_any_order():
+    chunks, block_dicts = market_chunks(blocks=400, rows_per_block=5)
+    expected = add_partitions_block_by_block([chunk.copy() for chunk in chunks], block_dicts)
+
+    # Blocks complete in any order
+    order = np.random.default_rng(1).permutation(len(chunks))
+    merged = partitions_from_blocks([chunks[index] for index in order], [block_dicts[index] for index in order])
+
+    sort_columns = ["protocol", "block_number", "total_supply"]
+    pd.testing.assert_frame_equal(
+        merged.sort_values(sort_columns, ignore_index=True), expected.sort_values(sort_columns, ignore_index=True)
+    )
+
+
+def test_add_partitions_from_blocks_refuses_a_block_listed_twice():
+    chunks, block_dicts = market_chunks(blocks=4, rows_per_block=5)
+    with pytest.raises(pd.errors.MergeError):
+        partitions_from_blocks(chunks, block_dicts + block_dicts[:1])
+
+
+@pytest.mark.benchmark
+def test_benchmark_partitions_of_a_million_rows():
+    timestamps = random_timestamps(rows=10**6)
+    start = time.time()
+    add_partitions_row_by_row(pd.DataFrame({"timestamp": timestamps}), "timestamp")
+    row_by_row_seconds = time.time() - start
+    start = time.time()
+    add_partitions_from_timestamp(pd.DataFrame({"timestamp": timestamps}), "timestamp")
+    vectorized_seconds = time.time() - start
+
+    chunks, block_dicts = market_chunks(blocks=10**4, rows_per_block=100)
+    start = time.time()
+    add_partitions_block_by_block([chunk.copy() for chunk in chunks], block_dicts)
+    block_by_block_seconds = time.time() - start
+    start = time.time()
+    partitions_from_blocks(chunks, block_dicts)
+    merge_seconds = time.time() - start
+
+    print(
+        f"\n{len(timestamps)} timestamps: row by row {row_by_row_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s"
+        f"\n{10**6} market rows in {10**4} blocks: block by block {block_by_block_seconds:.2f}s, "
+        f"one merge {merge_seconds:.2f}s"
+    )
+    assert vectorized_seconds < row_by_row_seconds / 10
@@ -0,0 +1,123 @@
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+from src.pipelines.analytics import historical_market_data_and_account_positions as market_positions
+from src.pipelines.analytics.positions_merge import ANALYTICS_DATABASE, ANALYTICS_TABLE, merge_positions
+from tests.local_lake import generate_account_positions, generate_market_data, write_table
+
+
+BLOCKS = list(range(1000, 1600, 10))
+PROTOCOLS = ["aave", "compound"]
+PARTITIONS = [(2023, 1), (2023, 2)]
+LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER = 1050, 1500
+ADDRESS_PARTITIONS = tuple(f"{partition:02x}" for partition in range(256))
+
+
+def write_stage_tables(engine, positions: int) -> None:
+    write_table(
+        engine,
+        "db_stage_prod.the_graph_historical_market_data",
+        generate_market_data(BLOCKS, PROTOCOLS, markets=15),
+        partition_cols=["year", "month"],
+    )
+    write_table(
+        engine,
+        "db_stage_prod.the_graph_historical_account_positions",
+        generate_account_positions(positions, BLOCKS, PROTOCOLS, markets=15),
+        partition_cols=["year", "month"],
+    )
+
+
+def merged_positions(engine) -> pd.DataFrame:
+    """The analytics table, then removed so the next merge starts from an empty table."""
+    merged = engine.read_sql_query(f"SELECT * FROM {ANALYTICS_DATABASE}.{ANALYTICS_TABLE}", database=ANALYTICS_DATABASE)
+    shutil.rmtree(engine.table_location(ANALYTICS_DATABASE, ANALYTICS_TABLE))
+    return merged.sort_values("id", ignore_index=True)
+
+
+def merge_with_sql(engine) -> pd.DataFrame:
+    market_positions.insert_data_into_table(ADDRESS_PARTITIONS, LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER)
+    return merged_positions(engine)
+
+
+def merge_with_arrow(engine, batch_rows: int) -> pd.DataFrame:
+    merge_positions(LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER, PARTITIONS, data_root=engine.data_root, batch_rows=batch_rows)
+    return merged_positions(engine)
+
+
+def assert_same_positions(arrow: pd.DataFrame, sql: pd.DataFrame) -> None:
+    assert sorted(arrow.columns) == sorted(sql.columns)
+    assert arrow["id"].tolist() == sql["id"].tolist()
+    for column in sql.columns:
+        if sql[column].dtype.kind == "f":
+            np.testing.assert_allclose(arrow[column].astype(float), sql[column], rtol=1e-12, err_msg=column)
+        else:
+            assert arrow[column].astype(str).tolist() == sql[column].astype(str).tolist(), column
+
+
+@pytest.fixture
+def stage_tables(local_lake, monkeypatch):
+    monkeypatch.setattr(market_positions, "plan_block_partitions", lambda after_block, until_block: PARTITIONS)
+    return local_lake
+
+
+def test_arrow_merge_matches_the_sql_insert(stage_tables):
+    write_stage_tables(stage_tables, positions=20000)
+
+    sql = merge_with_sql(stage_tables)
+    arrow = merge_with_arrow(stage_tables, batch_rows=3000)
+
+    assert len(sql) > 0
+    # Zero balances and zero or missing prices, where the SQL nulls and zeros must be kept
+    assert (sql["balance_in_eth"] == 0).any() and sql["input_token_price_usd"].isna().any()
+    assert_same_positions(arrow, sql)
+
+
+def test_sql_insert_skips_the_positions_already_inserted(stage_tables):
+    write_stage_tables(stage_tables, positions=5000)
+    expected = merge_with_sql(stage_tables)
+
+    # A chunk that wrote its rows then failed is retried, then the whole job is re-run
+    market_positions.insert_data_into_table(ADDRESS_PARTITIONS[:128], LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER)
+    market_positions.insert_data_into_table(ADDRESS_PARTITIONS[:128], LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER)
+    market_positions.insert_data_into_table(ADDRESS_PARTITIONS, LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER)
+
+    assert_same_positions(merged_positions(stage_tables), expected)
+
+
+def test_arrow_merge_skips_the_positions_already_merged(stage_tables):
+    write_stage_tables(stage_tables, positions=5000)
+    expected = merge_with_sql(stage_tables)
+
+    # A run that wrote part of the positions before failing, then the re-run
+    merge_positions(LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER, PARTITIONS, data_root=stage_tables.data_root)
+    location = stage_tables.table_location(ANALYTICS_DATABASE, ANALYTICS_TABLE)
+    address_partitioning = ds.partitioning(pa.schema([("address_partition", pa.string())]), flavor="hive")
+    written = pq.read_table(location, partitioning=address_partitioning)
+    shutil.rmtree(location)
+    pq.write_to_dataset(written.slice(0, written.num_rows // 2), location, partition_cols=["address_partition"])
+    merge_positions(LAST_BLOCK_NUMBER, MAX_BLOCK_NUMBER, PARTITIONS, data_root=stage_tables.data_root)
+
+    assert_same_positions(merged_positions(stage_tables), expected)
+
+
+@pytest.mark.benchmark
+def test_benchmark_arrow_merge_against_the_sql_insert(stage_tables):
+    write_stage_tables(stage_tables, positions=1500000)
+
+    start = time.time()
+    sql = merge_with_sql(stage_tables)
+    sql_seconds = time.time() - start
+    start = time.time()
+    arrow = merge_with_arrow(stage_tables, batch_rows=50000)
+    arrow_seconds = time.time() - start
+
+    assert_same_positions(arrow, sql)
+    print(f"\n{len(sql)} positions: DuckDB insert {sql_seconds:.2f}s, Arrow merge {arrow_seconds:.2f}s")
@@ -0,0 +1,85 @@
+import time
+
+import pandas as pd
+
+from src.pipelines import query_cache
+from src.pipelines.query_cache import QueryCache, cached_does_table_exist
+
+
+class CountingWatermarkStore(object):
+    def __init__(self) -> None:
+        self.versions = {}
+        self.reads = 0
+
+    def version(self, table: str) -> int:
+        self.reads += 1
+        return self.versions.get(table, 0)
+
+
+def test_does_table_exist_is_cached_without_reading_table_versions(tmp_path, monkeypatch):
+    watermark_store = CountingWatermarkStore()
+    glue_calls = []
+    monkeypatch.setattr(query_cache, "_query_cache", QueryCache(directory=str(tmp_path), s3_prefix=""))
+    monkeypatch.setattr(query_cache, "get_watermark_store", lambda: watermark_store)
+    monkeypatch.setattr(
+        query_cache.wr.catalog,
+        "does_table_exist",
+        lambda database, table: glue_calls.append(table) or table == "existing",
+    )
+
+    for _ in range(3):
+        assert cached_does_table_exist(database="db_analytics_prod", table="existing")
+        assert not cached_does_table_exist(database="db_analytics_prod", table="missing")
+
+    # A missing table may be created by the next writer, so it is checked every time
+    assert glue_calls == ["existing", "missing", "missing", "missing"]
+    assert watermark_store.reads == 0
+
+
+def test_query_results_are_invalidated_by_a_new_table_version(tmp_path, monkeypatch):
+    watermark_store = CountingWatermarkStore()
+    monkeypatch.setattr(query_cache, "get_watermark_store", lambda: watermark_store)
+    cache = QueryCache(directory=str(tmp_path), s3_prefix="")
+    queries = []
+
+    def read_function(sql: str) -> pd.DataFrame:
+        queries.append(sql)
+        return pd.DataFrame({"wallet_address": ["0x1", "0x2"], "version": len(queries)})
+
+    query = "SELECT wallet_address FROM db_sandbox_prod.test_set_wallet_addresses"
+    first = cache.read_sql_query(query, read_function)
+    # Whitespace and the trailing semicolon do not change the entry
+    second = cache.read_sql_query(f"  {query}\n;", read_function)
+    watermark_store.versions["db_sandbox_prod.test_set_wallet_addresses"] = 1
+    third = cache.read_sql_query(query, read_function)
+
+    pd.testing.assert_frame_equal(first, second)
+    assert len(queries) == 2
+    assert third["version"].tolist() == [2, 2]
+
+
+def test_query_results_are_shared_between_tasks_until_they_expire(tmp_path, monkeypatch):
+    monkeypatch.setattr(query_cache, "get_watermark_store", CountingWatermarkStore)
+    queries = []
+
+    def read_function(sql: str) -> pd.DataFrame:
+        queries.append(sql)
+        return pd.DataFrame({"first_block": [17000000, 17007200]})
+
+    query = "SELECT MIN(number) AS first_block FROM db_raw_prod.ethereum_blocks GROUP BY 1"
+    # Each task starts with an empty local directory, the shared prefix plays the S3 one
+    first_task = QueryCache(directory=str(tmp_path / "first_task"), s3_prefix=str(tmp_path / "shared"))
+    second_task = QueryCache(directory=str(tmp_path / "second_task"), s3_prefix=str(tmp_path / "shared"))
+    first = first_task.read_sql_query(query, read_function)
+    second = second_task.read_sql_query(query, read_function)
+
+    pd.testing.assert_frame_equal(first, second)
+    assert len(queries) == 1
+    assert second_task.hits == 1 and second_task.misses == 0
+
+    # The local copy is as old as the shared entry, so both expire together
+    for cache in [second_task, QueryCache(directory=str(tmp_path / "third_task"), s3_prefix=str(tmp_path / "shared"))]:
+        cache.ttl_seconds = 0
+        time.sleep(0.01)
+        cache.read_sql_query(query, read_function)
+    assert len(queries) == 3
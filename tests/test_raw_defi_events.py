@@ -0,0 +1,204 @@
+import time
+
+import pandas as pd
+import pytest
+import requests
+
+from src.pipelines.api_keys import ApiKeyPool
+from src.pipelines.checkpoints import CheckpointManifest
+from src.pipelines.raw import defi_events
+from tests.transpose_stub import KEY_COLUMNS, TransposeStub, generate_lending_events
+
+
+START_UNIXTIMESTAMP = 1672531200
+WINDOW_DAYS = 10
+EVENT_NAMES = ["deposit", "borrow", "repay", "liquidation", "withdraw"]
+
+
+@pytest.fixture
+def events() -> pd.DataFrame:
+    return generate_lending_events(EVENT_NAMES, START_UNIXTIMESTAMP, WINDOW_DAYS + 2, rows=3000)
+
+
+@pytest.fixture
+def written(monkeypatch, tmp_path) -> dict:
+    """Routes the raw table writes and checkpoints of ``raw/defi_events`` to memory and ``tmp_path``."""
+    written = {"parts": [], "checkpoints": []}
+
+    def insert_incoming_data_to_data_lake(incoming_data_df, event_name):
+        written["parts"].append(incoming_data_df.assign(event_name=event_name))
+
+    def get_checkpoint(event_names, write_mode):
+        checkpoint = CheckpointManifest(job_name=f"raw_transpose_all_events_{write_mode}", location=str(tmp_path))
+        written["checkpoints"].append(checkpoint)
+        return checkpoint
+
+    monkeypatch.setattr(defi_events, "insert_incoming_data_to_data_lake", insert_incoming_data_to_data_lake)
+    monkeypatch.setattr(defi_events, "get_checkpoint", get_checkpoint)
+    monkeypatch.setattr(
+        defi_events, "get_event_watermarks", lambda event_names: {name: START_UNIXTIMESTAMP for name in event_names}
+    )
+    monkeypatch.setattr(defi_events, "PAGINATION_SIZE", 100)
+    monkeypatch.setattr(defi_events, "MAX_TIMEWINDOW_DAYS", WINDOW_DAYS)
+    return written
+
+
+def transpose_stub(monkeypatch, events: pd.DataFrame, latency_seconds: float) -> TransposeStub:
+    stub = TransposeStub(events, latency_seconds=latency_seconds)
+    monkeypatch.setattr(defi_events, "TRANSPOSE_SQL_URL", stub.__enter__().url)
+    return stub
+
+
+def written_rows(written: dict) -> pd.DataFrame:
+    rows = pd.concat(written["parts"], ignore_index=True)
+    rows["timestamp_unixtimestamp"] = pd.to_datetime(rows["timestamp"]).map(pd.Timestamp.timestamp).astype("int64")
+    return rows.sort_values(KEY_COLUMNS, ignore_index=True)
+
+
+def expected_rows(events: pd.DataFrame) -> pd.DataFrame:
+    in_window = (events["timestamp_unixtimestamp"] > START_UNIXTIMESTAMP) & (
+        events["timestamp_unixtimestamp"] <= START_UNIXTIMESTAMP + WINDOW_DAYS * 86400
+    )
+    return events[in_window].sort_values(KEY_COLUMNS, ignore_index=True)
+
+
+def api_key_pool() -> ApiKeyPool:
+    return ApiKeyPool(api_keys=["local-key"], requests_per_second=1000)
+
+
+@pytest.mark.parametrize("pagination_mode", defi_events.PAGINATION_MODES)
+def test_backfill_writes_the_same_rows_and_partitions_as_a_serial_run(monkeypatch, written, events, pagination_mode):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.01)
+    try:
+        defi_events.stream_data(EVENT_NAMES, api_key_pool(), pagination_mode=pagination_mode, flush_rows=500)
+        serial = written_rows(written)
+        written["parts"].clear()
+        defi_events.backfill_data(
+            EVENT_NAMES, api_key_pool(), pagination_mode=pagination_mode, window_days=WINDOW_DAYS, shards=12
+        )
+        backfill = written_rows(written)
+    finally:
+        stub.__exit__(None, None, None)
+
+    expected = expected_rows(events)
+    assert len(serial) == len(expected)
+    assert serial[KEY_COLUMNS + ["category"]].equals(expected[KEY_COLUMNS + ["category"]])
+    assert (serial["event_name"] == serial["category"]).all()
+    columns = KEY_COLUMNS + ["category", "event_name", "quantity", "year", "month"]
+    pd.testing.assert_frame_equal(backfill[columns], serial[columns])
+
+
+def test_backfill_resumes_at_the_first_unfinished_shard(monkeypatch, written, events):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.0)
+    sub_windows = defi_events.split_time_window(
+        START_UNIXTIMESTAMP, START_UNIXTIMESTAMP + WINDOW_DAYS * 86400, shards=10
+    )
+    failed_start, _ = sub_windows[6]
+    stub.fail_windows.add(failed_start)
+    try:
+        with pytest.raises(requests.HTTPError):
+            defi_events.backfill_data(EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=10, max_workers=2)
+        state = written["checkpoints"][-1].state
+        assert state["completed_shards"] == 6
+        stub.requested_windows.clear()
+        defi_events.backfill_data(EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=10, max_workers=2)
+    finally:
+        stub.__exit__(None, None, None)
+
+    # The persisted shards are not fetched again, and no row is written twice
+    assert min(stub.requested_windows) == failed_start
+    rows = written_rows(written)
+    assert not rows.duplicated(KEY_COLUMNS).any()
+    assert rows[KEY_COLUMNS].equals(expected_rows(events)[KEY_COLUMNS])
+
+
+def test_backfill_bounds_the_shards_held_in_memory(monkeypatch, written, events):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.0)
+    fetch_shard = defi_events.fetch_shard
+    started = []
+
+    def slow_first_shard(event_names, api_key_pool, start_unixtimestamp, end_unixtimestamp, pagination_mode):
+        checkpoint_state = written["checkpoints"][-1].state or {"completed_shards": 0}
+        started.append(len(started) - checkpoint_state["completed_shards"])
+        if len(started) == 1:
+            # Every later shard finishes before the first one, which has to be written first
+            time.sleep(0.5)
+        return fetch_shard(event_names, api_key_pool, start_unixtimestamp, end_unixtimestamp, pagination_mode)
+
+    monkeypatch.setattr(defi_events, "fetch_shard", slow_first_shard)
+    try:
+        defi_events.backfill_data(
+            EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=30, max_workers=3, max_shards_in_flight=4
+        )
+    finally:
+        stub.__exit__(None, None, None)
+
+    assert len(started) == 30
+    # Shards started but not persisted yet whenever another one is submitted
+    assert max(started) <= 4
+    assert written_rows(written)[KEY_COLUMNS].equals(expected_rows(events)[KEY_COLUMNS])
+
+
+@pytest.mark.benchmark
+def test_benchmark_backfill_against_a_serial_run_on_a_slow_endpoint(monkeypatch, written, events):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.05)
+    try:
+        start = time.time()
+        defi_events.stream_data(EVENT_NAMES, api_key_pool(), flush_rows=500)
+        serial_seconds = time.time() - start
+        start = time.time()
+        defi_events.backfill_data(EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=10, max_workers=5)
+        backfill_seconds = time.time() - start
+    finally:
+        stub.__exit__(None, None, None)
+
+    print(f"\n{len(events)} events: serial stream {serial_seconds:.2f}s, backfill {backfill_seconds:.2f}s")
+    assert backfill_seconds < serial_seconds / 2
+
+
+def fail_on_write(monkeypatch, written: dict, write_number: int) -> None:
+    """Makes the ``write_number``-th raw table write raise, after the previous ones were persisted."""
+    insert_incoming_data_to_data_lake = defi_events.insert_incoming_data_to_data_lake
+    writes = []
+
+    def failing_insert(incoming_data_df, event_name):
+        writes.append(event_name)
+        if len(writes) == write_number:
+            raise RuntimeError("injected write failure")
+        insert_incoming_data_to_data_lake(incoming_data_df, event_name)
+
+    monkeypatch.setattr(defi_events, "insert_incoming_data_to_data_lake", failing_insert)
+
+
+@pytest.mark.parametrize("pagination_mode", defi_events.PAGINATION_MODES)
+def test_stream_resumes_after_a_failure_between_two_table_writes(monkeypatch, written, events, pagination_mode):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.0)
+    fail_on_write(monkeypatch, written, write_number=13)
+    try:
+        with pytest.raises(RuntimeError):
+            defi_events.stream_data(EVENT_NAMES, api_key_pool(), pagination_mode=pagination_mode, flush_rows=500)
+        stub.requested_windows.clear()
+        defi_events.stream_data(EVENT_NAMES, api_key_pool(), pagination_mode=pagination_mode, flush_rows=500)
+    finally:
+        stub.__exit__(None, None, None)
+
+    # The retry does not start the window over, and neither skips nor duplicates rows
+    assert min(stub.requested_windows) > START_UNIXTIMESTAMP
+    rows = written_rows(written)
+    assert not rows.duplicated(KEY_COLUMNS).any()
+    assert rows[KEY_COLUMNS].equals(expected_rows(events)[KEY_COLUMNS])
+
+
+def test_backfill_resumes_after_a_failure_between_two_table_writes(monkeypatch, written, events):
+    stub = transpose_stub(monkeypatch, events, latency_seconds=0.0)
+    fail_on_write(monkeypatch, written, write_number=18)
+    try:
+        with pytest.raises(RuntimeError):
+            defi_events.backfill_data(EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=10)
+        defi_events.backfill_data(EVENT_NAMES, api_key_pool(), window_days=WINDOW_DAYS, shards=10)
+    finally:
+        stub.__exit__(None, None, None)
+
+    rows = written_rows(written)
+    assert not rows.duplicated(KEY_COLUMNS).any()
+    assert rows[KEY_COLUMNS].equals(expected_rows(events)[KEY_COLUMNS])
@@ -0,0 +1,123 @@
+import functools
+import shutil
+
+import pyarrow as pa
+import pytest
+
+from src.pipelines import work_queue
+from src.pipelines.analytics import historical_market_data_and_account_positions as market_positions
+from src.pipelines.analytics.positions_merge import ANALYTICS_DATABASE, ANALYTICS_TABLE
+from src.pipelines.stage import historical_account_positions as stage_positions
+from src.pipelines.watermarks import get_watermark_store
+from tests.local_lake import generate_account_positions, generate_market_data, write_table
+
+
+BLOCKS = list(range(1000, 1600, 10))
+PROTOCOLS = ["aave", "compound"]
+PARTITIONS = [(2023, 1), (2023, 2)]
+ADDRESS_PARTITIONS = tuple(f"{partition:02x}" for partition in range(256))
+FIRST_BLOCK_NUMBER = 1020
+DEAD_LETTERED_BLOCK = {"protocol": "aave", "block_number": 1050, "year": "23", "month": "01"}
+
+
+def raw_account_positions(positions) -> pa.Table:
+    """``db_raw_prod.the_graph_historical_account_positions`` rows, as fetched from the subgraph."""
+    return pa.table(
+        {
+            "balance": positions["balance"].astype(str),
+            "id": positions["id"],
+            "iscollateral": positions["is_collateral"],
+            "market": pa.StructArray.from_arrays(
+                [pa.array(positions["market"]), pa.array(positions["market_id"])], names=["name", "id"]
+            ),
+            "side": positions["side"],
+            "account": pa.StructArray.from_arrays([pa.array(positions["account"])], names=["id"]),
+            "block_number": positions["block_number"],
+            "protocol": positions["protocol"],
+            "timestamp": positions["block_timestamp"],
+            "year": positions["year"],
+            "month": positions["month"],
+        }
+    )
+
+
+def analytics_ids(engine) -> list:
+    """The ids of the analytics table, then removed so the next merge starts from an empty table."""
+    merged = engine.read_sql_query(
+        f"SELECT id FROM {ANALYTICS_DATABASE}.{ANALYTICS_TABLE}", database=ANALYTICS_DATABASE
+    )
+    shutil.rmtree(engine.table_location(ANALYTICS_DATABASE, ANALYTICS_TABLE))
+    return sorted(merged["id"])
+
+
+@pytest.fixture
+def replay_lake(local_lake, tmp_path, monkeypatch):
+    replayed_block_store = functools.partial(work_queue.ReplayedBlockStore, location=str(tmp_path / "dead_letters"))
+    for module in [stage_positions, market_positions]:
+        monkeypatch.setattr(module, "ReplayedBlockStore", replayed_block_store)
+        monkeypatch.setattr(module, "plan_block_partitions", lambda after_block, until_block: PARTITIONS)
+    return local_lake
+
+
+def test_replayed_blocks_reach_the_stage_and_analytics_tables(replay_lake):
+    positions = generate_account_positions(5000, BLOCKS, PROTOCOLS, markets=15)
+    dead_lettered = (positions["protocol"] == DEAD_LETTERED_BLOCK["protocol"]) & (
+        positions["block_number"] == DEAD_LETTERED_BLOCK["block_number"]
+    )
+    assert dead_lettered.sum() > 0
+    write_table(
+        replay_lake,
+        "db_stage_prod.the_graph_historical_market_data",
+        generate_market_data(BLOCKS, PROTOCOLS, markets=15),
+        partition_cols=["year", "month"],
+    )
+    write_table(
+        replay_lake,
+        "db_stage_prod.the_graph_historical_account_positions",
+        positions[positions["block_number"] <= FIRST_BLOCK_NUMBER],
+        partition_cols=["year", "month"],
+    )
+    write_table(
+        replay_lake,
+        "db_raw_prod.the_graph_historical_account_positions",
+        raw_account_positions(positions[~dead_lettered]),
+        partition_cols=["year", "month"],
+    )
+    watermark_store = get_watermark_store()
+    watermark_store.write(
+        "db_raw_prod.the_graph_historical_account_positions", {protocol: max(BLOCKS) for protocol in PROTOCOLS}
+    )
+    for table_name in [market_positions.STAGE_TABLE_NAME, market_positions.TABLE_NAME]:
+        watermark_store.write(table_name, {protocol: FIRST_BLOCK_NUMBER for protocol in PROTOCOLS})
+    stage_positions.update_stage()
+    market_positions.run_insert_in_parallell()
+
+    # The block is replayed into the raw table once both watermarks are past it
+    write_table(
+        replay_lake,
+        "db_raw_prod.the_graph_historical_account_positions",
+        raw_account_positions(positions[dead_lettered]),
+        partition_cols=["year", "month"],
+    )
+    stage_positions.ReplayedBlockStore("db_raw_prod.the_graph_historical_account_positions").add([DEAD_LETTERED_BLOCK])
+    stage_positions.update_stage()
+    market_positions.run_insert_in_parallell()
+    stage_ids = replay_lake.read_sql_query(
+        f"SELECT id FROM {market_positions.STAGE_TABLE_NAME}", database="db_stage_prod"
+    )["id"]
+    assert set(stage_ids) == set(positions["id"][~dead_lettered])
+
+    stage_positions.replay_blocks()
+    market_positions.replay_blocks()
+
+    stage_ids = replay_lake.read_sql_query(
+        f"SELECT id FROM {market_positions.STAGE_TABLE_NAME}", database="db_stage_prod"
+    )["id"]
+    assert sorted(stage_ids) == sorted(positions["id"])
+    replayed_ids = analytics_ids(replay_lake)
+    market_positions.insert_data_into_table(ADDRESS_PARTITIONS, FIRST_BLOCK_NUMBER, max(BLOCKS))
+    assert replayed_ids == analytics_ids(replay_lake)
+    assert set(positions["id"][dead_lettered]) & set(replayed_ids)
+    for table_name in ["db_raw_prod", "db_stage_prod"]:
+        store = stage_positions.ReplayedBlockStore(f"{table_name}.the_graph_historical_account_positions")
+        assert store.blocks() == []
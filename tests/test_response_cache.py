@@ -0,0 +1,21 @@
+from src.pipelines.response_cache import ResponseCache
+
+
+def test_warm_downloads_the_shared_responses_up_to_max_bytes(tmp_path):
+    shared = ResponseCache(directory=str(tmp_path / "shared"), max_bytes=10**9, s3_prefix=None)
+    for block_number in range(40):
+        shared.put(f"key{block_number:02d}", {"data": {"block": block_number, "rows": ["x" * 100] * block_number}})
+    # Responses of a previous run are not downloaded again
+    local = ResponseCache(directory=str(tmp_path / "local"), max_bytes=shared.total_bytes // 2, s3_prefix=None)
+    local.put("key00", shared.get("key00"))
+
+    downloaded = ResponseCache(
+        directory=str(tmp_path / "local"), max_bytes=shared.total_bytes // 2, s3_prefix=str(tmp_path / "shared")
+    ).warm(workers=8)
+
+    warmed = ResponseCache(directory=str(tmp_path / "local"), max_bytes=shared.total_bytes // 2, s3_prefix=None)
+    assert 0 < downloaded < 39
+    assert len(warmed.index) == downloaded + 1
+    assert warmed.total_bytes <= shared.total_bytes // 2
+    for key in list(warmed.index):
+        assert warmed.get(key) == shared.get(key)
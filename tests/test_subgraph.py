@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+
+from src.pipelines import subgraph
+from src.pipelines.http_client import AsyncHttpClient
+from src.pipelines.subgraph import ID_UPPER_BOUND, MultiBlockBatcher, fetch_keyset_ranges, id_ranges
+from tests.subgraph_stub import SubgraphStub, generate_positions
+
+
+QUERY = open("src/pipelines/raw/queries/historical_account_positions.graphql").read()
+
+
+pytestmark = pytest.mark.usefixtures("local_subgraph")
+
+
+def fetch_block_positions(stub: SubgraphStub, ranges: list, max_in_flight: int, split_after_pages: int) -> tuple:
+    """Returns the positions of one block fetched from ``stub`` and the seconds it took."""
+
+    async def fetch() -> list:
+        async with AsyncHttpClient() as client:
+            return await fetch_keyset_ranges(
+                http_client=client,
+                url=stub.url("positions"),
+                query=QUERY,
+                variables={"block_number": 17000000},
+                entity="positions",
+                ranges=ranges,
+                max_in_flight=max_in_flight,
+                split_after_pages=split_after_pages,
+            )
+
+    start = time.time()
+    positions = asyncio.run(fetch())
+    return positions, time.time() - start
+
+
+@pytest.mark.parametrize("id_prefix", ["", "0a"])
+def test_fetch_keyset_ranges_returns_every_position_once(id_prefix):
+    positions = generate_positions(accounts=8000, positions_per_account=[0, 1, 2, 5], id_prefix=id_prefix)
+    with SubgraphStub({"positions": positions}) as stub:
+        fetched, _ = fetch_block_positions(stub, id_ranges(4), max_in_flight=4, split_after_pages=2)
+
+    # With every id in one range ("0a" prefix), that range is split to fetch it concurrently
+    assert sorted(position["id"] for position in fetched) == [position["id"] for position in positions]
+
+
+class SlowGatewayClient(object):
+    """Answers every multi-block query after ``latency_seconds``, with one market per aliased block."""
+
+    def __init__(self, latency_seconds: float) -> None:
+        self.latency_seconds = latency_seconds
+        self.answered = 0
+
+    async def post_json(self, url: str, json: dict) -> dict:
+        await asyncio.sleep(self.latency_seconds)
+        self.answered += 1
+        aliases = [line.split(":")[0] for line in json["query"].splitlines() if line.startswith("b")]
+        return {"data": {alias: [{"id": alias}] for alias in aliases}}
+
+
+def test_multi_block_batcher_close_waits_for_the_requests_in_flight():
+    single_block_query = (
+        "query q($block_number: Int) {\n  first_results: markets(block: {number: $block_number}) { id }\n}"
+    )
+
+    async def fetch_and_close() -> tuple:
+        client = SlowGatewayClient(latency_seconds=0.05)
+        batcher = MultiBlockBatcher(client, url="local", query=single_block_query, field="first_results", batch_size=2)
+        fetched = await asyncio.gather(*(batcher.fetch(block_number) for block_number in range(4)))
+        # A request sent after its caller stopped waiting is still finished by close()
+        abandoned = asyncio.ensure_future(batcher.fetch(4))
+        await asyncio.sleep(batcher.linger_seconds * 2)
+        abandoned.cancel()
+        in_flight = len(batcher.tasks)
+        await batcher.close()
+        return fetched, in_flight, len(batcher.tasks), client.answered
+
+    fetched, in_flight, left_in_flight, answered = asyncio.run(fetch_and_close())
+
+    assert fetched == [[{"id": f"b{block_number}"}] for block_number in range(4)]
+    assert (in_flight, left_in_flight, answered) == (1, 0, 3)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("id_prefix", ["", "0a"])
+def test_benchmark_keyset_ranges_rows_per_second(id_prefix):
+    positions = generate_positions(accounts=100000, positions_per_account=[1, 2, 3, 4], id_prefix=id_prefix)
+    with SubgraphStub({"positions": positions}, latency_seconds=0.2) as stub:
+        serial, serial_seconds = fetch_block_positions(
+            stub, [("", ID_UPPER_BOUND)], max_in_flight=1, split_after_pages=10**9
+        )
+        parallel, parallel_seconds = fetch_block_positions(
+            stub,
+            id_ranges(subgraph.settings.POSITIONS_ID_RANGES),
+            max_in_flight=subgraph.settings.POSITIONS_REQUESTS_PER_BLOCK,
+            split_after_pages=subgraph.settings.POSITIONS_SPLIT_AFTER_PAGES,
+        )
+
+    print(
+        f"\n{len(positions)} positions, ids prefixed by {id_prefix!r}: one keyset walk "
+        f"{len(serial) / serial_seconds:.0f} rows/s, id ranges {len(parallel) / parallel_seconds:.0f} rows/s"
+    )
+    assert len(serial) == len(parallel) == len(positions)
+    assert parallel_seconds < serial_seconds / 2
@@ -0,0 +1,114 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+
+KEY_COLUMNS = ["timestamp_unixtimestamp", "block_number", "log_index"]
+
+
+def generate_lending_events(
+    event_names: list, start_unixtimestamp: int, days: int, rows: int, seed: int = 0
+) -> pd.DataFrame:
+    """Random ``ethereum.lending_events`` rows, many of them sharing a timestamp and a block."""
+    random = np.random.default_rng(seed)
+    timestamps = np.sort(random.integers(start_unixtimestamp, start_unixtimestamp + days * 86400, rows))
+    # A few seconds apart at most, so that pages often end in the middle of a timestamp
+    timestamps = timestamps - timestamps % 7
+    events = pd.DataFrame(
+        {
+            "timestamp_unixtimestamp": timestamps,
+            "block_number": timestamps // 12,
+            "category": random.choice(event_names, rows),
+            "protocol_name": random.choice(["aave", "compound"], rows),
+            "quantity": random.integers(1, 10**12, rows).astype(str),
+        }
+    )
+    events["log_index"] = events.groupby("block_number").cumcount()
+    events["timestamp"] = pd.to_datetime(events["timestamp_unixtimestamp"], unit="s").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return events
+
+
+class TransposeStub(object):
+    """Local mock of the Transpose ``/sql`` endpoint answering the lending events queries of ``raw/defi_events``.
+
+    The window, categories, page size and page position are read back from the SQL and its parameters, and
+    every response is delayed by ``latency_seconds`` to mimic the server.
+
+    Args:
+        events (pd.DataFrame): Rows of ``ethereum.lending_events``, as returned by ``generate_lending_events``.
+        latency_seconds (float): Delay of every response.
+    """
+
+    def __init__(self, events: pd.DataFrame, latency_seconds: float = 0.0) -> None:
+        self.events = events.sort_values(KEY_COLUMNS, ignore_index=True)
+        self.latency_seconds = latency_seconds
+        # Window starts answered once with a 400, to make a shard fail
+        self.fail_windows = set()
+        self.requested_windows = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, body = stub.answer(request["sql"], request["parameters"])
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/sql"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, sql: str, parameters: dict) -> tuple:
+        time.sleep(self.latency_seconds)
+        start_unixtimestamp = int(re.search(r"EXTRACT\(EPOCH FROM TIMESTAMP\) > (\d+)", sql).group(1))
+        end_unixtimestamp = int(re.search(r"EXTRACT\(EPOCH FROM TIMESTAMP\) <= (\d+)", sql).group(1))
+        categories = re.findall(r"'(\w+)'", re.search(r"category IN \(([^)]*)\)", sql).group(1))
+        limit = int(re.search(r"LIMIT (\d+)", sql).group(1))
+        with self.lock:
+            self.requested_windows.append(start_unixtimestamp)
+            if start_unixtimestamp in self.fail_windows:
+                self.fail_windows.discard(start_unixtimestamp)
+                return 400, {"status": "error", "message": "injected failure"}
+
+        events = self.events
+        events = events[
+            events["category"].isin(categories)
+            & (events["timestamp_unixtimestamp"] > start_unixtimestamp)
+            & (events["timestamp_unixtimestamp"] <= end_unixtimestamp)
+        ]
+        if "last_unixtimestamp" in parameters:
+            last_key = (
+                float(parameters["last_unixtimestamp"]),
+                int(parameters["last_block_number"]),
+                int(parameters["last_log_index"]),
+            )
+            after_last_key = [tuple(key) > last_key for key in events[KEY_COLUMNS].itertuples(index=False)]
+            page = events[after_last_key].head(limit)
+        else:
+            offset = int(parameters["offset_amount"])
+            page = events.iloc[offset : offset + limit]
+        # EXTRACT(EPOCH FROM ...) is a numeric, decoded as a float
+        page = page.assign(timestamp_unixtimestamp=page["timestamp_unixtimestamp"].astype(float))
+        return 200, {"status": "success", "results": page.to_dict(orient="records")}